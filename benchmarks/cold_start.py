@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""Report and check the import-time cold start of each Trellis function.
+
+Runs `python -X importtime` importing main in a fresh interpreter, in a
+copy of each function directory with the files its cloudbuild.yaml
+copies in, and reports the median total and the slowest direct imports.
+By default main is imported with ENVIRONMENT=google-cloud, as deployed,
+with the Cloud Logging client stubbed out; --environment local imports
+the local branch instead. Exits non-zero if a function exceeds its
+budget in cold_start_budget.yaml, imports a module that should be
+deferred to first use or starts a background thread while importing.
+
+Usage:
+    python benchmarks/cold_start.py [--repeat 5] [--top 10] [--environment local] [function ...]
+"""
+
+import os
+import sys
+import json
+import yaml
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+FUNCTIONS_DIR = os.path.join(BENCHMARK_DIR, '..', 'functions')
+REPO_DIR = os.path.join(BENCHMARK_DIR, '..')
+BUDGET_FILE = os.path.join(BENCHMARK_DIR, 'cold_start_budget.yaml')
+
+GOOGLE_CLOUD = 'google-cloud'
+
+# Runtime variables read at import by the google-cloud branches
+GOOGLE_CLOUD_ENV = {
+                    'ENVIRONMENT': GOOGLE_CLOUD,
+                    'PROJECT_ID': 'cold-start-benchmark',
+                    'CREDENTIALS_BUCKET': 'cold-start-benchmark',
+                    'CREDENTIALS_BLOB': 'trellis-configuration.yaml',
+                    'TOPIC_DB_QUERY': 'trellis-db-query',
+                    'ENABLE_JOB_LAUNCH': 'false',
+}
+
+# Replaces the Cloud Logging client, which needs credentials, imports
+# main and reports the threads still running after the import
+IMPORT_SCRIPT = """
+import sys, json, types, threading
+if sys.argv[1] == 'google-cloud':
+    import google.cloud
+    cloud_logging = types.ModuleType('google.cloud.logging')
+    cloud_logging.Client = type('Client', (), {'setup_logging': lambda self, **kwargs: None})
+    sys.modules['google.cloud.logging'] = google.cloud.logging = cloud_logging
+import main
+print(json.dumps([thread.name for thread in threading.enumerate() if thread is not threading.main_thread()]))
+"""
+
+
+def parse_importtime(stderr):
+    """Parse -X importtime output.
+
+    Args:
+        stderr (str): Standard error of the interpreter.
+    Returns:
+        (list): (module, depth, self us, cumulative us) tuples, in output order.
+    """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        fields = line[len('import time:'):].split('|')
+        self_us, cumulative_us, name = fields[0], fields[1], fields[2]
+        depth = (len(name) - len(name.lstrip(' '))) // 2
+        imports.append((name.strip(), depth, int(self_us), int(cumulative_us)))
+    return imports
+
+
+def copy_build_files(function_name, build_dir):
+    """Copy files into a function directory like its cloudbuild.yaml does.
+
+    Args:
+        function_name (str): Function directory name.
+        build_dir (str): Copy of the function directory.
+    """
+    with open(os.path.join(FUNCTIONS_DIR, function_name, 'cloudbuild.yaml'), 'r') as file_handle:
+        steps = yaml.safe_load(file_handle)['steps']
+    for step in steps:
+        args = step.get('args', [])
+        if len(args) != 3 or args[0] != 'cp' or '$' in args[1]:
+            continue
+        shutil.copy(os.path.join(REPO_DIR, args[1]), build_dir)
+
+
+def measure_import(build_dir, function_name, environment):
+    """Import a function's main module once in a fresh interpreter.
+
+    Returns:
+        (list): Parsed importtime records.
+    Raises:
+        RuntimeError: If the module fails to import or starts threads,
+            whose imports would also garble the importtime output.
+    """
+    env = dict(os.environ)
+    env.pop('ENVIRONMENT', None)
+    if environment == GOOGLE_CLOUD:
+        env.update(GOOGLE_CLOUD_ENV, K_SERVICE=f"trellis-{function_name}")
+    process = subprocess.run(
+                             [sys.executable, '-X', 'importtime', '-c', IMPORT_SCRIPT, environment],
+                             cwd = build_dir,
+                             env = env,
+                             capture_output = True,
+                             text = True,
+                             timeout = 120)
+    if process.returncode != 0:
+        error = process.stderr.strip().splitlines()[-1]
+        raise RuntimeError(f"{function_name}: import failed: {error}")
+    threads = json.loads(process.stdout.strip().splitlines()[-1])
+    if threads:
+        raise RuntimeError(f"{function_name}: starts threads at cold start: {threads}")
+    return parse_importtime(process.stderr)
+
+
+def profile_function(function_name, repeat, environment=GOOGLE_CLOUD):
+    """
+    Returns:
+        (tuple): (median total ms, direct imports of main sorted by
+            cumulative ms, set of imported module names)
+    """
+    totals = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        build_dir = os.path.join(temp_dir, function_name)
+        shutil.copytree(
+                        os.path.join(FUNCTIONS_DIR, function_name),
+                        build_dir,
+                        ignore = shutil.ignore_patterns('__pycache__'))
+        copy_build_files(function_name, build_dir)
+        for _ in range(repeat):
+            imports = measure_import(build_dir, function_name, environment)
+            main_index = max(index for index, record in enumerate(imports) if record[0] == 'main' and record[1] == 0)
+            totals.append(imports[main_index][3] / 1000)
+
+    # Imports of main are listed before main itself, after the
+    # previous top-level import (interpreter startup modules)
+    start = main_index
+    while start > 0 and imports[start - 1][1] > 0:
+        start -= 1
+    direct_imports = sorted(
+                            [(name, cumulative / 1000) for name, depth, _, cumulative in imports[start:main_index] if depth == 1],
+                            key = lambda record: record[1],
+                            reverse = True)
+    module_names = {name for name, _, _, _ in imports}
+    return statistics.median(totals), direct_imports, module_names
+
+
+def main_benchmark(function_names, repeat, top, environment=GOOGLE_CLOUD):
+    with open(BUDGET_FILE, 'r') as file_handle:
+        budget = yaml.safe_load(file_handle)
+    budgets = budget['functions']
+    deferred_modules = budget.get('deferred_modules', [])
+
+    failures = []
+    for function_name in function_names or sorted(budgets):
+        try:
+            total, direct_imports, module_names = profile_function(function_name, repeat, environment)
+        except RuntimeError as error:
+            failures.append(str(error))
+            print(f"\n{error}")
+            continue
+
+        limit = budgets.get(function_name)
+        status = 'ok' if limit is None or total <= limit else 'OVER BUDGET'
+        print(f"\n{function_name}: {total:.1f} ms (budget {limit} ms) {status}")
+        for name, cumulative in direct_imports[:top]:
+            print(f"    {cumulative:>8.1f} ms  {name}")
+
+        if status != 'ok':
+            failures.append(f"{function_name}: {total:.1f} ms exceeds budget of {limit} ms")
+        for module in deferred_modules:
+            if module in module_names:
+                failures.append(f"{function_name}: imports {module} at cold start")
+
+    if failures:
+        print('\nFailures:')
+        for failure in failures:
+            print(f"    {failure}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('functions', nargs='*', help='Function directories; default all in the budget file.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument(
+                        '--environment',
+                        choices = [GOOGLE_CLOUD, 'local'],
+                        default = GOOGLE_CLOUD,
+                        help = 'Import branch of the functions to measure.')
+    args = parser.parse_args()
+    sys.exit(main_benchmark(args.functions, args.repeat, args.top, args.environment))
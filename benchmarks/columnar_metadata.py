@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""Compare columnar metadata extraction against get_name_fields/get_time_fields.
+
+Usage:
+    python benchmarks/columnar_metadata.py [--objects 1000000] [--repeat 1]
+"""
+
+import os
+import sys
+import random
+import timeit
+import argparse
+
+FUNCTION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'functions', 'parse-object-metadata')
+# Shared modules are copied into the function directory at build time
+sys.path.insert(0, os.path.join(FUNCTION_DIR, '..', 'shared'))
+sys.path.insert(0, FUNCTION_DIR)
+
+import main
+import columnar_metadata
+
+
+def make_events(count, seed=42):
+    """Generate object listings shaped like a sequencing delivery bucket."""
+    rng = random.Random(seed)
+    extensions = ['fastq.gz', 'bam', 'bam.bai', 'vcf.gz', 'txt', 'json']
+    events = []
+    for index in range(count):
+        sample = f"SAMPLE{rng.randrange(10000)}"
+        extension = rng.choice(extensions)
+        milliseconds = rng.randrange(1000)
+        events.append({
+                       'bucket': 'gcp-bucket-mvp-test-from-personalis',
+                       'name': f"va_mvp_phase2/PLATE{index % 96}/{sample}/FASTQ/{sample}_{index}.{extension}",
+                       'timeCreated': f"2020-02-19T01:{rng.randrange(60):02d}:{rng.randrange(60):02d}.{milliseconds:03d}Z",
+                       'updated': f"2022-02-28T21:{rng.randrange(60):02d}:{rng.randrange(60):02d}.{milliseconds:03d}Z",
+        })
+    return events
+
+
+def scalar_metadata(events):
+    records = []
+    for event in events:
+        record = main.get_name_fields(
+                                      event_name = event['name'],
+                                      event_bucket = event['bucket'])
+        record.update(main.get_time_fields(event))
+        records.append(record)
+    return records
+
+
+def columnar_records(events):
+    columns = columnar_metadata.get_metadata_columns(events)
+    return list(columnar_metadata.iterate_records(columns))
+
+
+def main_benchmark(object_count, repeat):
+    events = make_events(object_count)
+
+    sample = events[:1000]
+    assert columnar_records(sample) == scalar_metadata(sample)
+
+    scalar_time = min(timeit.repeat(lambda: scalar_metadata(events), number=1, repeat=repeat))
+    columns_time = min(timeit.repeat(lambda: columnar_metadata.get_metadata_columns(events), number=1, repeat=repeat))
+    records_time = min(timeit.repeat(lambda: columnar_records(events), number=1, repeat=repeat))
+
+    print(f"{'path':>18} {'seconds':>8} {'objects/s':>11} {'speedup':>8}")
+    for label, elapsed in [
+            ('scalar loop', scalar_time),
+            ('columns', columns_time),
+            ('columns + dicts', records_time)]:
+        print(f"{label:>18} {elapsed:>8.2f} {object_count / elapsed:>11.0f} {scalar_time / elapsed:>7.1f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--objects', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=1)
+    args = parser.parse_args()
+    main_benchmark(args.objects, args.repeat)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""Compare one transaction per query with batched UNWIND transactions.
+
+Runs the mergeFastq and relateFastqToReadGroup queries from
+config/database-queries.yaml against a local Neo4j database, first one
+parameter set per transaction with query_database() and then in batches
+with query_database_batch(), and reports transactions/sec and rows/sec.
+Fastq nodes created by the benchmark have the bucket 'trellis-benchmark'
+and ReadGroup nodes a 'BENCHMARK' sample; both are deleted before every run.
+
+Start a local database first, e.g.:
+    docker run --rm -p 7687:7687 -e NEO4J_AUTH=neo4j/test neo4j:4.4
+
+Usage:
+    python benchmarks/db_query_batch.py [--uri bolt://localhost:7687]
+        [--password test] [--rows 2000] [--batch-sizes 10,100,500]
+"""
+
+import os
+import sys
+import time
+import yaml
+import argparse
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+FUNCTION_DIR = os.path.join(REPO_DIR, 'functions', 'db-query')
+QUERIES_FILE = os.path.join(REPO_DIR, 'config', 'database-queries.yaml')
+
+sys.path.insert(0, os.path.join(REPO_DIR, 'functions', 'shared'))
+sys.path.insert(0, FUNCTION_DIR)
+
+BUCKET = 'trellis-benchmark'
+SAMPLE_PREFIX = 'BENCHMARK'
+
+
+def load_main():
+    # main.py loads sample-queries.yaml from the working directory
+    cwd = os.getcwd()
+    os.chdir(FUNCTION_DIR)
+    try:
+        import main
+    finally:
+        os.chdir(cwd)
+    return main
+
+
+def load_queries():
+    import trellisdata  # registers the !DatabaseQuery YAML tag
+    with open(QUERIES_FILE) as file_handle:
+        return {query.name: query for query in yaml.load_all(file_handle, Loader=yaml.FullLoader)}
+
+
+def make_fastq_parameters(query, index):
+    sample = f"{SAMPLE_PREFIX}{index // 16}"
+    parameters = {}
+    for key, type_name in query.required_parameters.items():
+        parameters[key] = index if type_name == 'int' else f"{key}-{index}"
+    parameters.update({
+                       'bucket': BUCKET,
+                       'uri': f"gs://{BUCKET}/{sample}/{sample}_{index % 16}_R1.fastq.gz",
+                       'sample': sample,
+                       'readGroup': index % 8})
+    return parameters
+
+
+def make_read_group_parameters(index):
+    return {'sample': f"{SAMPLE_PREFIX}{index // 16}", 'read_group': index % 8}
+
+
+def clear_database(driver):
+    with driver.session() as session:
+        session.run(
+                    "MATCH (node) WHERE node.bucket = $bucket OR " +
+                    "(node:ReadGroup AND node.sample STARTS WITH $sample_prefix) DETACH DELETE node",
+                    bucket=BUCKET,
+                    sample_prefix=SAMPLE_PREFIX).consume()
+
+
+def run_single(main, driver, query, parameter_sets):
+    start = time.perf_counter()
+    for parameters in parameter_sets:
+        main.query_database(driver, query, parameters)
+    return len(parameter_sets), time.perf_counter() - start
+
+
+def run_batched(main, driver, query, parameter_sets, batch_size):
+    start = time.perf_counter()
+    transactions = 0
+    for offset in range(0, len(parameter_sets), batch_size):
+        results = main.query_database_batch(driver, query, parameter_sets[offset:offset + batch_size])
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            raise errors[0]
+        transactions += 1
+    return transactions, time.perf_counter() - start
+
+
+def report(name, mode, rows, transactions, seconds):
+    print(
+          f"{name:>24} {mode:>12} {transactions:>12} {seconds:>8.2f} " +
+          f"{transactions / seconds:>10.1f} {rows / seconds:>10.1f}")
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--uri', default='bolt://localhost:7687')
+    parser.add_argument('--user', default='neo4j')
+    parser.add_argument('--password', default='test')
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--batch-sizes', default='10,100,500')
+    args = parser.parse_args(argv)
+    batch_sizes = [int(size) for size in args.batch_sizes.split(',')]
+
+    from neo4j import GraphDatabase
+    main = load_main()
+    queries = load_queries()
+    merge_fastq = queries['mergeFastq']
+    relate_read_group = queries['relateFastqToReadGroup']
+
+    fastq_parameters = [make_fastq_parameters(merge_fastq, index) for index in range(args.rows)]
+    read_group_parameters = [make_read_group_parameters(index) for index in range(args.rows)]
+
+    driver = GraphDatabase.driver(args.uri, auth=(args.user, args.password))
+    print(f"{args.rows} rows")
+    print(f"{'query':>24} {'mode':>12} {'transactions':>12} {'seconds':>8} {'tx/sec':>10} {'rows/sec':>10}")
+    try:
+        modes = [('single', None)] + [(f"batch {size}", size) for size in batch_sizes]
+        for mode, batch_size in modes:
+            clear_database(driver)
+            for query, parameter_sets in [
+                                          (merge_fastq, fastq_parameters),
+                                          (relate_read_group, read_group_parameters)]:
+                if batch_size is None:
+                    transactions, seconds = run_single(main, driver, query, parameter_sets)
+                else:
+                    transactions, seconds = run_batched(main, driver, query, parameter_sets, batch_size)
+                report(query.name, mode, len(parameter_sets), transactions, seconds)
+        clear_database(driver)
+    finally:
+        driver.close()
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""Compare LabelClassifier against per-pattern re.fullmatch() label assignment.
+
+Usage:
+    python benchmarks/label_classifier.py [--objects 20000] [--repeat 3]
+"""
+
+import os
+import re
+import sys
+import random
+import timeit
+import argparse
+import importlib.util
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT_DIR, 'functions', 'check-object-triggers'))
+
+from compiled_patterns import LabelClassifier
+
+CONFIG_DIR = os.path.join(ROOT_DIR, 'config', 'phase3')
+
+PATH_TEMPLATES = [
+    "va_mvp_phase2/{plate}/{sample}/FASTQ/{sample}_{index}_R1.fastq.gz",
+    "va_mvp_phase2/{plate}/{sample}/Microarray/{sample}.idat",
+    "va_mvp_phase2/{plate}/{sample}/{sample}.json",
+    "{plate}/{sample}/gatk-5-dollar/190522-131015-{index}-abc/output/{sample}.g.vcf.gz",
+    "{plate}/{sample}/bam-fastqc/190522-131015-{index}-abc/output/{sample}.bam",
+    "{plate}/{sample}/fastq-to-vcf/190522-131015-{index}-abc/logs/stderr",
+    "dsub/vcfstats/rtg-tools/objects/{sample}_vcfstats.txt",
+    "dsub/fastqc-bam/text-to-table/objects/{sample}.fastqc_data.txt.csv",
+]
+
+
+def load_node_kinds(data_group):
+    spec = importlib.util.spec_from_file_location(
+                                                  data_group.replace('-', '_'),
+                                                  os.path.join(CONFIG_DIR, data_group, 'create-node-config.py'))
+    node_module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(node_module)
+    return node_module.NodeKinds()
+
+
+def make_paths(count, seed=42):
+    rng = random.Random(seed)
+    return [
+            rng.choice(PATH_TEMPLATES).format(
+                                              plate = f"PLATE{rng.randrange(100)}",
+                                              sample = f"SAMPLE{rng.randrange(10000)}",
+                                              index = rng.randrange(10))
+            for _ in range(count)]
+
+
+def assign_labels_loop(path, match_patterns, node_kinds):
+    """Label assignment as done by assign_labels_and_metadata()."""
+    labels = []
+    for label, patterns in match_patterns.items():
+        for pattern in patterns:
+            if re.fullmatch(pattern, path):
+                labels.append(label)
+                break
+    return labels, node_kinds.get_label_functions(labels) if hasattr(node_kinds, 'get_label_functions') else None
+
+
+def main_benchmark(object_count, repeat):
+    paths = make_paths(object_count)
+    print(f"{'config':>30} {'patterns':>8} {'loop us/path':>13} {'classifier us/path':>19} {'speedup':>8}")
+    for data_group in sorted(os.listdir(CONFIG_DIR)):
+        node_kinds = load_node_kinds(data_group)
+        match_patterns = node_kinds.match_patterns
+        classifier = LabelClassifier(node_kinds)
+        pattern_count = sum(len(patterns) for patterns in match_patterns.values())
+
+        def run_loop():
+            for path in paths:
+                assign_labels_loop(path, match_patterns, node_kinds)
+
+        def run_classifier():
+            for path in paths:
+                labels, groups = classifier.classify(path)
+                classifier.get_label_functions(labels)
+
+        loop_time = min(timeit.repeat(run_loop, number=1, repeat=repeat)) / object_count
+        classifier_time = min(timeit.repeat(run_classifier, number=1, repeat=repeat)) / object_count
+        print(f"{data_group:>30} {pattern_count:>8} {loop_time * 1e6:>13.2f} {classifier_time * 1e6:>19.2f} {loop_time / classifier_time:>7.1f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--objects', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    main_benchmark(args.objects, args.repeat)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""Compare sequential and concurrent label functions with a slow blob reader.
+
+NodeEntry objects are built for PersonalisSequencing and Checksum objects
+from config/phase3/from-personalis, with every GCS read delayed by a
+fixed latency instead of reaching GCS.
+
+Usage:
+    python benchmarks/node_entry_io.py [--objects 200] [--latency 0.05]
+"""
+
+import io
+import os
+import json
+import time
+import argparse
+import contextlib
+import importlib.util
+
+from concurrent.futures import ThreadPoolExecutor
+
+CONFIG_FILE = os.path.join(
+                           os.path.dirname(os.path.abspath(__file__)),
+                           '..', 'config', 'phase3', 'from-personalis', 'create-node-config.py')
+
+CHECKSUM_MANIFEST = b"abc123\t./FASTQ/SAMPLE0_0_R1.fastq.gz\nabc124\t./FASTQ/SAMPLE0_0_R2.fastq.gz\n"
+
+
+def load_node_module():
+    spec = importlib.util.spec_from_file_location('create_node_config', CONFIG_FILE)
+    node_module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(node_module)
+    return node_module
+
+
+class SlowBlobReader:
+    """Stands in for BlobReader, sleeping for every read like a GCS round trip."""
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def read(self, bucket, path, generation=None):
+        time.sleep(self.latency)
+        return json.dumps({'sequencingPlatform': 'NovaSeq'}).encode()
+
+    def open(self, bucket, path, generation=None, size=None, chunk_size=None):
+        time.sleep(self.latency)
+        return io.BytesIO(CHECKSUM_MANIFEST)
+
+
+def make_entries(node_module, count):
+    node_kinds = node_module.NodeKinds()
+    entries = []
+    for index in range(count):
+        if index % 2:
+            name, label = f"va_mvp_phase2/PLATE0/SAMPLE{index}/SAMPLE{index}.json", 'PersonalisSequencing'
+        else:
+            name, label = f"va_mvp_phase2/PLATE0/SAMPLE{index}/checksum.txt", 'Checksum'
+        event = {
+                 'bucket': 'gcp-bucket-mvp-test-from-personalis',
+                 'name': name,
+                 'generation': str(1582075915288601 + index),
+                 'size': str(len(CHECKSUM_MANIFEST)),
+                 'timeCreated': '2020-02-19T01:31:55.288Z',
+                 'updated': '2022-02-28T21:13:19.739Z',
+                 'metadata': {},
+        }
+        labels = ['Blob', label]
+        groupdict = {'plate': 'PLATE0', 'sample': f"SAMPLE{index}"}
+        entries.append((event, None, labels, node_kinds.get_label_functions(labels), groupdict))
+    return entries
+
+
+def build_sequential(node_module, entries):
+    """Previous NodeEntry behaviour: every label function in turn."""
+    db_dicts = []
+    for event, context, labels, label_functions, groupdict in entries:
+        db_dict = node_module.NodeEntry._get_standard_fields(event, labels)
+        for function in label_functions:
+            db_dict.update(function(db_dict, groupdict))
+        db_dicts.append(db_dict)
+    return db_dicts
+
+
+def main_benchmark(object_count, latency, threads):
+    node_module = load_node_module()
+    node_module.BLOB_READER = SlowBlobReader(latency)
+    entries = make_entries(node_module, object_count)
+    executor = ThreadPoolExecutor(max_workers=threads)
+
+    # Label functions print their inputs
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            expected = build_sequential(node_module, entries)
+            sequential_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            single = [node_module.NodeEntry(*entry, executor=executor) for entry in entries]
+            single_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            batch = node_module.NodeEntry.build_batch(entries, executor=executor)
+            batch_time = time.perf_counter() - start
+
+    assert [node.get_db_dict() for node in single] == expected
+    assert [node.get_db_dict() for node in batch] == expected
+
+    print(f"{object_count} objects, {latency * 1000:.0f} ms per read, {threads} threads")
+    print(f"{'mode':>22} {'seconds':>8} {'speedup':>8}")
+    for label, elapsed in [
+            ('sequential', sequential_time),
+            ('NodeEntry per object', single_time),
+            ('NodeEntry.build_batch', batch_time)]:
+        print(f"{label:>22} {elapsed:>8.2f} {sequential_time / elapsed:>7.1f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--objects', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--threads', type=int, default=16)
+    args = parser.parse_args()
+    main_benchmark(args.objects, args.latency, args.threads)
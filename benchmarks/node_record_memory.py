@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""Measure memory per node for NodeEntry and NodeRecord with tracemalloc.
+
+Events are created before tracing starts, so only the memory added by
+building the nodes is counted. All nodes are kept alive, as when they
+are collected for a bulk load.
+
+Usage:
+    python benchmarks/node_record_memory.py [--nodes 1000000]
+"""
+
+import gc
+import os
+import time
+import argparse
+import contextlib
+import tracemalloc
+import importlib.util
+
+CONFIG_FILE = os.path.join(
+                           os.path.dirname(os.path.abspath(__file__)),
+                           '..', 'config', 'phase3', 'from-personalis', 'create-node-config.py')
+
+
+def load_node_module():
+    spec = importlib.util.spec_from_file_location('create_node_config', CONFIG_FILE)
+    node_module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(node_module)
+    return node_module
+
+
+def make_events(count):
+    """GCS object events with the fields of a storage notification."""
+    events = []
+    for index in range(count):
+        name = f"va_mvp_phase2/PLATE{index % 96}/SAMPLE{index}/FASTQ/SAMPLE{index}_0_R1.fastq.gz"
+        generation = str(1582075915288601 + index)
+        events.append({
+                       'bucket': 'gcp-bucket-mvp-test-from-personalis',
+                       'contentType': 'application/octet-stream',
+                       'crc32c': 'ftNG8w==',
+                       'etag': 'CJmAwYe83OcCEAs=',
+                       'generation': generation,
+                       'id': f"gcp-bucket-mvp-test-from-personalis/{name}/{generation}",
+                       'kind': 'storage#object',
+                       'md5Hash': 'kTfnFQ3sGSWbbVwDGkjDhg==',
+                       'metadata': {'trellis-uuid': f"uuid-{index}"},
+                       'metageneration': '1',
+                       'name': name,
+                       'size': '5955984357',
+                       'storageClass': 'REGIONAL',
+                       'timeCreated': '2020-02-19T01:31:55.288Z',
+                       'updated': '2022-02-28T21:13:19.739Z',
+        })
+    return events
+
+
+def measure(build, events):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    nodes = [build(event) for event in events]
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del nodes
+    gc.collect()
+    return current / len(events), peak / len(events), elapsed
+
+
+def main_benchmark(node_count):
+    node_module = load_node_module()
+    events = make_events(node_count)
+    labels = ['Blob', 'Fastq']
+
+    results = []
+    # NodeEntry prints its label functions for every node
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        results.append(('NodeEntry',) + measure(lambda event: node_module.NodeEntry(event, None, labels), events))
+        results.append(('NodeRecord',) + measure(lambda event: node_module.NodeRecord(event, labels), events))
+
+    print(f"{node_count} nodes")
+    print(f"{'class':>10} {'bytes/node':>11} {'peak bytes/node':>16} {'seconds':>8}")
+    for name, current, peak, elapsed in results:
+        print(f"{name:>10} {current:>11.0f} {peak:>16.0f} {elapsed:>8.2f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--nodes', type=int, default=1000000)
+    args = parser.parse_args()
+    main_benchmark(args.nodes)
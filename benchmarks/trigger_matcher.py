@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Compare TriggerMatcher against the re.search() loop in match_object_triggers.
+
+Usage:
+    python benchmarks/trigger_matcher.py [--objects 200] [--repeat 3]
+"""
+
+import os
+import sys
+import random
+import timeit
+import argparse
+
+FUNCTION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'functions', 'check-object-triggers')
+# Shared modules are copied into the function directory at build time
+sys.path.insert(0, os.path.join(FUNCTION_DIR, '..', 'shared'))
+sys.path.insert(0, FUNCTION_DIR)
+
+import main
+from compiled_patterns import TriggerMatcher
+
+PATTERN_COUNTS = [3, 10, 100, 1000]
+
+
+def make_object_triggers(count):
+    """Generate trigger patterns shaped like the ones used for cohort onboarding."""
+    object_triggers = {}
+    for index in range(count):
+        kind = index % 4
+        if kind == 0:
+            pattern = rf"^cohort{index}/(?P<plate>\w+)/(?P<sample>\w+)/FASTQ/(?P<name>\w+)\.fastq\.gz$"
+        elif kind == 1:
+            pattern = rf"(?P<sample>[a-zA-Z0-9]+)_(?P<read_group>\d+)\.cohort{index}\.ubam$"
+        elif kind == 2:
+            pattern = rf"(?P<sample_name>SAMN\d+)/HAS_READ_GROUP_{index}/(?P<read_group_name>ERR\d+)"
+        else:
+            pattern = rf"(?P<sample>[a-zA-Z0-9]+)_(?P<mate_pair>[1-2])\.c{index}.fastq.gz$"
+        object_triggers[f"query{index}"] = pattern
+    return object_triggers
+
+
+def make_object_names(count, pattern_count, seed=42):
+    rng = random.Random(seed)
+    names = []
+    for _ in range(count):
+        index = rng.randrange(pattern_count)
+        sample = f"SAMPLE{rng.randrange(1000)}"
+        kind = index % 4
+        if kind == 0:
+            names.append(f"cohort{index}/PLATE0/{sample}/FASTQ/{sample}_0_R1.fastq.gz")
+        elif kind == 1:
+            names.append(f"cohort/{sample}/{sample}_3.cohort{index}.ubam")
+        elif kind == 2:
+            names.append(f"SAMN{rng.randrange(10**6)}/HAS_READ_GROUP_{index}/ERR{rng.randrange(10**6)}")
+        else:
+            names.append(f"cohort/{sample}/{sample}_1.c{index}.fastq.gz")
+    return names
+
+
+def main_benchmark(object_count, repeat):
+    metadata = {'size': '5955984357', 'crc32c': 'ftNG8w=='}
+    print(f"{'patterns':>8} {'loop us/object':>15} {'matcher us/object':>18} {'speedup':>8}")
+    for pattern_count in PATTERN_COUNTS:
+        object_triggers = make_object_triggers(pattern_count)
+        names = make_object_names(object_count, pattern_count)
+        matcher = TriggerMatcher(object_triggers)
+
+        for name in names:
+            expected = main.match_object_triggers(name, metadata, object_triggers)
+            assert matcher.match(name, metadata) == expected
+
+        def run_loop():
+            for name in names:
+                main.match_object_triggers(name, metadata, object_triggers)
+
+        def run_matcher():
+            for name in names:
+                matcher.match(name, metadata)
+
+        loop_time = min(timeit.repeat(run_loop, number=1, repeat=repeat)) / object_count
+        matcher_time = min(timeit.repeat(run_matcher, number=1, repeat=repeat)) / object_count
+        print(f"{pattern_count:>8} {loop_time * 1e6:>15.2f} {matcher_time * 1e6:>18.2f} {loop_time / matcher_time:>7.1f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--objects', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    main_benchmark(args.objects, args.repeat)
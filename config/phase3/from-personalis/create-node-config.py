@@ -1,10 +1,15 @@
+import io
 import re
 import json
 import pytz
 import uuid
 import iso8601
+import threading
 
 from datetime import datetime
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 
 from google.cloud import storage
 
@@ -123,6 +128,134 @@ def get_standard_time_fields(event):
     }
     return time_fields
 
+class BlobReader:
+
+    def __init__(self, max_cache_bytes=64 * 1024 * 1024, max_entry_bytes=8 * 1024 * 1024):
+        """Read object content for label functions.
+
+        Holds one storage client for all label functions and addresses
+        objects with client.bucket().blob(), which doesn't fetch bucket
+        metadata first. Content of a specific object generation is kept
+        in a size-bounded LRU cache, so processing the same object again
+        (Pub/Sub redelivery, backfills) doesn't download it again.
+
+        Args:
+            max_cache_bytes (int): Total size of cached content.
+            max_entry_bytes (int): Larger objects are never cached.
+        """
+        self.max_cache_bytes = max_cache_bytes
+        self.max_entry_bytes = max_entry_bytes
+
+        self.hits = 0
+        self.misses = 0
+
+        self._client = None
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                self._client = storage.Client()
+            return self._client
+
+    def _get_blob(self, bucket, path, generation):
+        # Pin the generation so cached content matches what was read
+        if generation is not None:
+            generation = int(generation)
+        return self.client.bucket(bucket).blob(path, generation=generation)
+
+    def _get_cached(self, key):
+        with self._lock:
+            data = self._cache.get(key)
+            if data is None:
+                self.misses += 1
+            else:
+                self._cache.move_to_end(key)
+                self.hits += 1
+            return data
+
+    def _add_to_cache(self, key, data):
+        if len(data) > self.max_entry_bytes:
+            return
+        with self._lock:
+            if key in self._cache:
+                return
+            self._cache[key] = data
+            self._cache_bytes += len(data)
+            while self._cache_bytes > self.max_cache_bytes:
+                _, evicted = self._cache.popitem(last=False)
+                self._cache_bytes -= len(evicted)
+
+    def read(self, bucket, path, generation=None):
+        """Download object content, from the cache if possible.
+
+        Args:
+            bucket (str): Name of the GCS bucket.
+            path (str): Object path.
+            generation (str): Object generation. Content is only cached
+                when the generation is known.
+        Returns:
+            (bytes): Object content.
+        """
+        if generation is None:
+            return self._get_blob(bucket, path, None).download_as_bytes()
+
+        key = (bucket, path, str(generation))
+        data = self._get_cached(key)
+        if data is None:
+            data = self._get_blob(bucket, path, generation).download_as_bytes()
+            self._add_to_cache(key, data)
+        return data
+
+    def open(self, bucket, path, generation=None, size=None, chunk_size=256 * 1024):
+        """Get a binary reader over object content.
+
+        Objects small enough to cache are read in one piece through
+        read(); larger or unknown-size objects are streamed in chunks.
+
+        Args:
+            size (int): Object size in bytes, if known.
+            chunk_size (int): Bytes requested per read when streaming.
+        Returns:
+            (file-like): Binary reader; use as a context manager.
+        """
+        if generation is not None and size is not None and int(size) <= self.max_entry_bytes:
+            return io.BytesIO(self.read(bucket, path, generation))
+        return self._get_blob(bucket, path, generation).open('rb', chunk_size=chunk_size)
+
+
+# Shared by all label functions of a function instance
+BLOB_READER = BlobReader()
+
+
+def io_bound(function):
+    """Mark a label function as I/O-bound.
+
+    NodeEntry runs I/O-bound label functions concurrently on a thread
+    pool. They get the standard metadata fields but not the fields added
+    by other label functions.
+    """
+    function.io_bound = True
+    return function
+
+
+# Threads for I/O-bound label functions, created on first use
+LABEL_FUNCTION_THREADS = 16
+_label_function_executor = None
+_label_function_executor_lock = threading.Lock()
+
+def get_label_function_executor():
+    global _label_function_executor
+    with _label_function_executor_lock:
+        if _label_function_executor is None:
+            _label_function_executor = ThreadPoolExecutor(
+                                                          max_workers = LABEL_FUNCTION_THREADS,
+                                                          thread_name_prefix = 'label-function')
+        return _label_function_executor
+
 ## Functions for paring custom metadata from blob metadata
 
 def trellis_metadata_groupdict(db_dict, groupdict):
@@ -153,6 +286,7 @@ def read_group_name_1(db_dict, groupdict):
     return {'readGroup': int(index)}  
 
 
+@io_bound
 def read_json(db_dict, groupdict):
     """For a json object, get and return json data.
 
@@ -162,14 +296,73 @@ def read_json(db_dict, groupdict):
         groupdict(dict): Properties generated by match() operation
             to determine whether object path matches a node pattern.
     """
-    json_content = storage.Client() \
-        .get_bucket(db_dict['bucket']) \
-        .blob(db_dict['path']) \
-        .download_as_string()
+    json_content = BLOB_READER.read(
+                                    db_dict['bucket'],
+                                    db_dict['path'],
+                                    db_dict.get('generation'))
     json_data = json.loads(json_content)
     return json_data
 
 
+# One pattern for both kinds of manifest lines; equivalent to separate
+# re.fullmatch() calls because a line can't match both alternatives.
+CHECKSUM_LINE_PATTERN = re.compile(
+    r"(?P<checksum>\w+)\t+.(?:/FASTQ/(?P<fastq>.*\.fastq\.gz)|/Microarray/(?P<microarray>.*))")
+
+# Bytes requested from GCS per read while streaming a manifest
+CHECKSUM_CHUNK_SIZE = 256 * 1024
+
+
+def parse_checksum_manifest(reader, collect_checksums=False):
+    """Count the FASTQ and Microarray entries of a checksum manifest.
+
+    Reads the manifest line by line, so memory use doesn't depend on
+    manifest size (unless checksums are collected). As before, only the
+    last non-blank line has trailing whitespace removed.
+
+    Args:
+        reader (file-like): Binary reader over checksum.txt.
+        collect_checksums (bool): Also return the checksum of each file.
+    Returns:
+        (tuple): ({'fastqCount': int, 'microarrayCount': int}, checksums)
+            where checksums is None or {'fastq': {basename: checksum},
+            'microarray': {basename: checksum}}.
+    """
+    counts = {'fastq': 0, 'microarray': 0}
+    checksums = {'fastq': {}, 'microarray': {}} if collect_checksums else None
+
+    def classify(line):
+        match = CHECKSUM_LINE_PATTERN.fullmatch(line)
+        if not match:
+            return
+        kind = 'fastq' if match.group('fastq') is not None else 'microarray'
+        counts[kind] += 1
+        if collect_checksums:
+            checksums[kind][match.group(kind)] = match.group('checksum')
+
+    # Hold back the latest non-blank line until we know whether it is
+    # the last one, which is matched with trailing whitespace stripped.
+    pending = None
+    for raw_line in reader:
+        line = raw_line.decode("utf-8")
+        if line.endswith('\n'):
+            line = line[:-1]
+        if not line.strip():
+            continue
+        if pending is not None:
+            classify(pending)
+        pending = line
+    if pending is not None:
+        classify(pending.rstrip())
+
+    json_data = {
+                 'fastqCount': counts['fastq'],
+                 'microarrayCount': counts['microarray'],
+    }
+    return json_data, checksums
+
+
+@io_bound
 def read_checksum(db_dict, groupdict):
     """Parse data from a checksum.txt object from Personalis.
 
@@ -179,42 +372,15 @@ def read_checksum(db_dict, groupdict):
         groupdict(dict): Properties generated by match() operation
             to determine whether object path matches a node pattern.
     """
-    data = storage.Client() \
-        .get_bucket(db_dict['bucket']) \
-        .blob(db_dict['path']) \
-        .download_as_string()
-    decoded_data = data.decode("utf-8")
-    # Strip trailing newline
-    stripped_data = decoded_data.rstrip()
-    split_data = stripped_data.split('\n')
-
-    # Count the number of fastqs & microarray data
-    fastq_pattern = r"(?P<checksum>\w+)\t+./FASTQ/(?P<basename>.*\.fastq\.gz)"
-    microarray_pattern = r"(?P<checksum>\w+)\t+./Microarray/(?P<basename>.*)"
-    
-    fastq_counter = 0
-    microarray_counter = 0
-
-    json_data = {}
-    for line in split_data:
-        fastq_match = re.fullmatch(fastq_pattern, line)
-        if fastq_match:
-            # Increment counter value for 'fastqCount' field
-            fastq_counter +=1
-            # Add basename/checksum as individual field (ERROR: INVALID KEY NAME)
-            #json_data[fastq_match.group('basename')] = fastq_match.group('checksum')
-            #checksums.append({fastq_match.group('basename'): fastq_match.group('checksum')})
-
-        microarray_match = re.fullmatch(microarray_pattern, line)
-        if microarray_match:
-            microarray_counter +=1
-            # Add basename/checksum as individual field (ERROR: INVALID KEY NAME)
-            #json_data[microarray_match.group('basename')] = microarray_match.group('checksum')
-            #checksums.append({microarray_match.group('basename'): microarray_match.group('checksum')})
-
-    json_data['fastqCount'] = fastq_counter
-    json_data['microarrayCount'] = microarray_counter
-    #json_data['data'] = stripped_data
+    # Large manifests are streamed instead of downloaded in one piece
+    reader = BLOB_READER.open(
+                              db_dict['bucket'],
+                              db_dict['path'],
+                              generation = db_dict.get('generation'),
+                              size = db_dict.get('size'),
+                              chunk_size = CHECKSUM_CHUNK_SIZE)
+    with reader:
+        json_data, _ = parse_checksum_manifest(reader)
     print(f"JSON data: {json_data}")
 
     return json_data
@@ -232,17 +398,54 @@ def relate_job_to_output(db_dict):
 
 class NodeEntry:
 
-    def __init__(self, event, context, labels, label_functions=[]):
+    def __init__(self, event, context, labels, label_functions=[], groupdict=None, executor=None):
         """
         Args:
             event (dict): Blob metadata generated by GCP REST API
             context (dict): Event context generated by GCP REST API
             labels (list): List of database node labels
             label_functions (list): List of functions used to get custom metadata
+            groupdict (dict): Named groups from matching the label patterns
+            executor (concurrent.futures.Executor): Runs I/O-bound label
+                functions; defaults to a shared thread pool.
         
         Returns:
 
         """
+        db_dict = self._get_standard_fields(event, labels)
+        pending = self._submit_io_bound(db_dict, label_functions, groupdict, executor)
+        self._apply_label_functions(event, db_dict, label_functions, groupdict, pending)
+
+    @classmethod
+    def build_batch(cls, entries, executor=None):
+        """Create node entries for many objects at once.
+
+        I/O-bound label functions of all objects are started before any
+        results are merged, so their downloads overlap across objects.
+
+        Args:
+            entries (iterable): (event, context, labels, label_functions,
+                groupdict) tuples.
+            executor (concurrent.futures.Executor): Runs I/O-bound label
+                functions; defaults to a shared thread pool.
+        Returns:
+            (list): NodeEntry objects, in input order.
+        """
+        prepared = []
+        for event, context, labels, label_functions, groupdict in entries:
+            db_dict = cls._get_standard_fields(event, labels)
+            pending = cls._submit_io_bound(db_dict, label_functions, groupdict, executor)
+            prepared.append((event, db_dict, label_functions, groupdict, pending))
+
+        node_entries = []
+        for event, db_dict, label_functions, groupdict, pending in prepared:
+            node_entry = cls.__new__(cls)
+            node_entry._apply_label_functions(event, db_dict, label_functions, groupdict, pending)
+            node_entries.append(node_entry)
+        return node_entries
+
+    @staticmethod
+    def _get_standard_fields(event, labels):
         db_dict = clean_metadata_dict(event)
 
         name_fields = get_standard_name_fields(event['name'])
@@ -253,10 +456,36 @@ class NodeEntry:
 
         # This custom metadata field gets added to all nodes
         db_dict['labels'] = labels
+        return db_dict
+
+    @staticmethod
+    def _submit_io_bound(db_dict, label_functions, groupdict, executor):
+        """Start I/O-bound label functions with a snapshot of db_dict.
 
+        Returns:
+            (dict): Label function index mapped to its future.
+        """
+        io_bound_indices = [
+                            index for index, function in enumerate(label_functions)
+                            if getattr(function, 'io_bound', False)]
+        if not io_bound_indices:
+            return {}
+        if executor is None:
+            executor = get_label_function_executor()
+
+        standard_fields = dict(db_dict)
+        return {
+                index: executor.submit(label_functions[index], standard_fields, groupdict or {})
+                for index in io_bound_indices}
+
+    def _apply_label_functions(self, event, db_dict, label_functions, groupdict, pending):
         print(f'>> Label functions: {label_functions}.')
-        for function in label_functions:
-            custom_fields = function(db_dict)
+        # Merge in declared order so results don't depend on timing
+        for index, function in enumerate(label_functions):
+            if index in pending:
+                custom_fields = pending[index].result()
+            else:
+                custom_fields = function(db_dict, groupdict or {})
             db_dict.update(custom_fields)
 
         self.db_dict = db_dict
@@ -277,6 +506,130 @@ class NodeEntry:
     def get_trellis_metadata(self):
         return(self.trellis_metadata)
 
+class _PropertySchema:
+    """Property names shared by all node records with the same fields."""
+
+    __slots__ = ('keys', 'index')
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.index = {key: position for position, key in enumerate(keys)}
+
+
+# Node records built from the same kind of object share one schema
+_PROPERTY_SCHEMAS = {}
+
+def _get_property_schema(keys):
+    schema = _PROPERTY_SCHEMAS.get(keys)
+    if schema is None:
+        schema = _PROPERTY_SCHEMAS.setdefault(keys, _PropertySchema(keys))
+    return schema
+
+
+class _PropertiesView(Mapping):
+    """Read-only mapping over the property values of a NodeRecord."""
+
+    __slots__ = ('_schema', '_values', '_exclude')
+
+    def __init__(self, schema, values, exclude=None):
+        self._schema = schema
+        self._values = values
+        self._exclude = exclude
+
+    def __getitem__(self, key):
+        if self._exclude is not None and key in self._exclude:
+            raise KeyError(key)
+        return self._values[self._schema.index[key]]
+
+    def __iter__(self):
+        if self._exclude is None:
+            return iter(self._schema.keys)
+        exclude = self._exclude
+        return (key for key in self._schema.keys if key not in exclude)
+
+    def __len__(self):
+        if self._exclude is None:
+            return len(self._values)
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class NodeRecord:
+    """Compact alternative to NodeEntry for bulk ingestion.
+
+    Property names are stored once per distinct set of fields and each
+    record only keeps a tuple of values and the event it was built from,
+    instead of three dicts. Properties, GCP metadata and Trellis metadata
+    are exposed as views. Provides the same getters as NodeEntry.
+    """
+
+    __slots__ = ('_schema', '_values', 'gcp_metadata')
+
+    def __init__(self, event, labels, label_functions=(), groupdict=None, executor=None):
+        """
+        Args:
+            event (dict): Blob metadata generated by GCP REST API
+            labels (list): List of database node labels
+            label_functions (list): List of functions used to get custom metadata
+            groupdict (dict): Named groups from matching the label patterns
+            executor (concurrent.futures.Executor): Runs I/O-bound label
+                functions; defaults to a shared thread pool.
+        """
+        # Same fields as clean_metadata_dict() plus the standard fields.
+        # This dict is only used while building the record.
+        properties = {key: value for key, value in event.items() if not isinstance(value, dict)}
+        properties['size'] = int(properties['size'])
+
+        name = event['name']
+        dirname, _, basename = name.rpartition('/')
+        base_name, _, extension = basename.partition('.')
+        properties['path'] = name
+        properties['dirname'] = dirname
+        properties['basename'] = basename
+        properties['name'] = base_name
+        properties['extension'] = extension
+
+        properties.update(get_standard_time_fields(event))
+        properties['labels'] = labels
+
+        if label_functions:
+            groupdict = groupdict or {}
+            pending = NodeEntry._submit_io_bound(properties, label_functions, groupdict, executor)
+            for index, function in enumerate(label_functions):
+                if index in pending:
+                    properties.update(pending[index].result())
+                else:
+                    properties.update(function(properties, groupdict))
+
+        self._schema = _get_property_schema(tuple(properties))
+        self._values = tuple(properties.values())
+        self.gcp_metadata = event
+
+    @property
+    def properties(self):
+        return _PropertiesView(self._schema, self._values)
+
+    @property
+    def trellis_metadata(self):
+        # Key, value pairs not in the GCP metadata are trellis metadata
+        return _PropertiesView(self._schema, self._values, exclude=self.gcp_metadata)
+
+    def get_db_dict(self):
+        """
+        Returns:
+            (dict): New dict of node properties.
+        """
+        return dict(zip(self._schema.keys, self._values))
+
+    def get_gcp_metadata(self):
+        return self.gcp_metadata
+
+    def get_trellis_metadata(self):
+        return self.trellis_metadata
+
+
 class NodeKinds:
 
     def __init__(self):
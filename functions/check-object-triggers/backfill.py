@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+"""Re-ingest existing objects by replaying them through the trigger pipeline.
+
+Streams an object listing from GCS or from a local JSON/JSONL manifest,
+derives the metadata that parse-object-metadata would add to each object,
+matches it against the object triggers and writes the resulting query
+requests to a JSONL file or publishes them to the db-query topic.
+
+Progress is checkpointed after every chunk, so a crashed run resumes after
+the last committed object. Run from this directory, like the tests.
+
+Examples:
+    python backfill.py --bucket my-bucket --prefix va_mvp_phase2/ \
+        --output requests.jsonl --checkpoint va_mvp_phase2.checkpoint.json
+    python backfill.py --manifest objects.jsonl --publish \
+        --project my-project --topic trellis-db-query --checkpoint run.json
+"""
+
+import os
+import sys
+import json
+import uuid
+import yaml
+import logging
+import argparse
+import importlib.util
+
+from itertools import islice
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from google.cloud import storage
+from google.cloud import pubsub
+
+import main
+
+from compiled_patterns import TriggerMatcher
+
+SENDER = 'check-object-triggers-backfill'
+
+PARSE_OBJECT_METADATA_DIR = os.path.join(
+                                         os.path.dirname(os.path.abspath(__file__)),
+                                         '..', 'parse-object-metadata')
+
+
+def _load_parse_object_metadata(module_name, file_name):
+    # Both functions name their module "main", so load it under its own name
+    spec = importlib.util.spec_from_file_location(
+                                                  module_name,
+                                                  os.path.join(PARSE_OBJECT_METADATA_DIR, file_name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+parse_object_metadata = _load_parse_object_metadata('parse_object_metadata', 'main.py')
+columnar_metadata = _load_parse_object_metadata('columnar_metadata', 'columnar_metadata.py')
+
+
+def configure_pipeline(triggers_file=None):
+    """Set the sender name and, optionally, a different trigger file.
+
+    Also used as the worker process initializer.
+    """
+    main.FUNCTION_NAME = SENDER
+    if triggers_file:
+        with open(triggers_file, 'r') as file_handle:
+            main.OBJECT_TRIGGERS = yaml.safe_load(file_handle)
+        main.TRIGGER_MATCHER = TriggerMatcher(main.OBJECT_TRIGGERS)
+
+
+def _add_object_fields(metadata_fields, gcs_object):
+    existing_metadata = gcs_object.get('metadata') or {}
+    trellis_uuid = existing_metadata.get('trellisUuid')
+    if not trellis_uuid:
+        trellis_uuid = uuid.uuid5(uuid.NAMESPACE_URL, gcs_object['id'])
+    metadata_fields['trellisUuid'] = trellis_uuid
+
+    metadata_fields['size'] = gcs_object['size']
+    metadata_fields['crc32c'] = gcs_object['crc32c']
+    metadata_fields['gcsId'] = gcs_object['id']
+    return {key: str(value) for key, value in metadata_fields.items()}
+
+
+def get_object_metadata(gcs_object):
+    """Derive the metadata parse-object-metadata adds to an object.
+
+    Values are converted to strings, as they are after a round trip
+    through GCS custom metadata. Objects without a trellisUuid get one
+    derived from their GCS ID so that reruns produce the same value.
+
+    Args:
+        gcs_object (dict): GCS object resource.
+    Returns:
+        (dict): Object metadata as seen by check-object-triggers.
+    """
+    metadata_fields = {}
+    metadata_fields.update(parse_object_metadata.get_name_fields(
+                                                                 event_name = gcs_object['name'],
+                                                                 event_bucket = gcs_object['bucket']))
+    metadata_fields.update(parse_object_metadata.get_time_fields(gcs_object))
+    return _add_object_fields(metadata_fields, gcs_object)
+
+
+def get_objects_metadata(gcs_objects):
+    """Batch version of get_object_metadata() using columnar extraction.
+
+    Args:
+        gcs_objects (list): GCS object resources.
+    Returns:
+        (list): Object metadata dicts, in object order.
+    """
+    columns = columnar_metadata.get_metadata_columns(gcs_objects)
+    return [
+            _add_object_fields(metadata_fields, gcs_object)
+            for metadata_fields, gcs_object
+            in zip(columnar_metadata.iterate_records(columns), gcs_objects)]
+
+
+def process_chunk(gcs_objects):
+    """Create the query requests for a chunk of objects.
+
+    Args:
+        gcs_objects (list): GCS object resources.
+    Returns:
+        (list): Query request messages, in object order.
+    """
+    messages = []
+    for gcs_object, object_metadata in zip(gcs_objects, get_objects_metadata(gcs_objects)):
+        event = {
+                 'name': gcs_object['name'],
+                 'metadata': object_metadata,
+        }
+        for query_name, message in main.create_query_requests(event, gcs_object['generation']):
+            messages.append(message)
+    return messages
+
+
+def iterate_chunks(gcs_objects, chunk_size):
+    iterator = iter(gcs_objects)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def process_objects(gcs_objects, workers, chunk_size, triggers_file=None):
+    """Run chunks through a worker pool and yield results in listing order.
+
+    At most two chunks per worker are in flight, so memory use does not
+    depend on the length of the listing.
+
+    Yields:
+        (tuple): (object count, last object name, messages) per chunk.
+    """
+    chunks = iterate_chunks(gcs_objects, chunk_size)
+    if workers <= 1:
+        for chunk in chunks:
+            yield len(chunk), chunk[-1]['name'], process_chunk(chunk)
+        return
+
+    with ProcessPoolExecutor(
+                             max_workers = workers,
+                             initializer = configure_pipeline,
+                             initargs = (triggers_file,)) as executor:
+        pending = deque()
+        for chunk in chunks:
+            future = executor.submit(process_chunk, chunk)
+            pending.append((len(chunk), chunk[-1]['name'], future))
+            if len(pending) >= workers * 2:
+                count, last_name, future = pending.popleft()
+                yield count, last_name, future.result()
+        while pending:
+            count, last_name, future = pending.popleft()
+            yield count, last_name, future.result()
+
+
+def list_gcs_objects(bucket_name, prefix, start_after=None):
+    """Stream object resources from a bucket listing.
+
+    Args:
+        bucket_name (str): Name of the GCS bucket.
+        prefix (str): Only list objects under this prefix.
+        start_after (str): Skip objects up to and including this name.
+    Yields:
+        (dict): GCS object resources, in lexicographic name order.
+    """
+    blobs = storage.Client().list_blobs(
+                                        bucket_name,
+                                        prefix = prefix,
+                                        start_offset = start_after)
+    for blob in blobs:
+        if start_after is not None and blob.name <= start_after:
+            continue
+        yield blob._properties
+
+
+def read_manifest(path, skip=0):
+    """Stream object resources from a JSON array or JSON Lines manifest.
+
+    JSON arrays are loaded in full; use JSON Lines for large listings.
+
+    Args:
+        path (str): Path to the manifest.
+        skip (int): Number of objects to skip from the start.
+    Yields:
+        (dict): GCS object resources.
+    """
+    if path.endswith('.json'):
+        with open(path, 'r') as file_handle:
+            gcs_objects = json.load(file_handle)
+        yield from islice(gcs_objects, skip, None)
+        return
+
+    with open(path, 'r') as file_handle:
+        records = (json.loads(line) for line in file_handle if line.strip())
+        yield from islice(records, skip, None)
+
+
+class Checkpoint:
+
+    def __init__(self, path, source):
+        """Progress of a backfill run, stored as a JSON file.
+
+        Args:
+            path (str): Checkpoint file; loaded if it already exists.
+            source (str): Description of the listing being processed.
+                Resuming against a different source is an error.
+        """
+        self.path = path
+        self.source = source
+        self.objects = 0
+        self.requests = 0
+        self.last_name = None
+        self.output_offset = 0
+
+        if path and os.path.exists(path):
+            with open(path, 'r') as file_handle:
+                state = json.load(file_handle)
+            if state['source'] != source:
+                raise ValueError(
+                                 f"Checkpoint {path} belongs to '{state['source']}', " +
+                                 f"not '{source}'.")
+            self.objects = state['objects']
+            self.requests = state['requests']
+            self.last_name = state['last_name']
+            self.output_offset = state['output_offset']
+
+    def save(self):
+        if not self.path:
+            return
+        state = {
+                 'source': self.source,
+                 'objects': self.objects,
+                 'requests': self.requests,
+                 'last_name': self.last_name,
+                 'output_offset': self.output_offset,
+        }
+        # Replace the file atomically so a crash never leaves it half written
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, 'w') as file_handle:
+            json.dump(state, file_handle)
+            file_handle.flush()
+            os.fsync(file_handle.fileno())
+        os.replace(temporary_path, self.path)
+
+
+class JsonlSink:
+
+    def __init__(self, path, offset=0):
+        """Write query request messages to a JSON Lines file.
+
+        On resume the file is truncated to the last checkpointed offset,
+        dropping any requests written after it.
+
+        Raises:
+            ValueError: If the checkpoint has an offset but the file is missing.
+        """
+        if offset and not os.path.exists(path):
+            raise ValueError(
+                             f"Checkpoint offset {offset} but output {path} is missing; " +
+                             "pass --restart to start over.")
+        mode = 'r+b' if offset else 'wb'
+        self.file_handle = open(path, mode)
+        self.file_handle.truncate(offset)
+        self.file_handle.seek(offset)
+
+    def write(self, messages):
+        for message in messages:
+            line = json.dumps(message, sort_keys=True, default=str) + '\n'
+            self.file_handle.write(line.encode('utf-8'))
+
+    def commit(self):
+        self.file_handle.flush()
+        os.fsync(self.file_handle.fileno())
+        return self.file_handle.tell()
+
+    def close(self):
+        self.file_handle.close()
+
+
+class PubSubSink:
+
+    def __init__(self, publisher, project_id, topic):
+        """Publish query request messages to a Pub/Sub topic."""
+        self.publisher = publisher
+        self.project_id = project_id
+        self.topic = topic
+
+    def write(self, messages):
+        main.publish_messages(
+                              publisher = self.publisher,
+                              project_id = self.project_id,
+                              topic = self.topic,
+                              messages = messages)
+
+    def commit(self):
+        # publish_messages() only returns once every message is published
+        return 0
+
+    def close(self):
+        pass
+
+
+def run_backfill(gcs_objects, sink, checkpoint, workers=1, chunk_size=1000, triggers_file=None):
+    """Process a listing and write query requests, checkpointing per chunk.
+
+    Args:
+        gcs_objects (iterable): GCS object resources, already positioned
+            after the last checkpointed object.
+        sink (JsonlSink, PubSubSink): Destination for query requests.
+        checkpoint (Checkpoint): Progress record updated after each chunk.
+        workers (int): Number of worker processes.
+        chunk_size (int): Objects per chunk and per checkpoint.
+        triggers_file (str): Trigger YAML to use instead of the default.
+    Returns:
+        (Checkpoint): Final progress.
+    """
+    for count, last_name, messages in process_objects(gcs_objects, workers, chunk_size, triggers_file):
+        sink.write(messages)
+        checkpoint.output_offset = sink.commit()
+        checkpoint.objects += count
+        checkpoint.requests += len(messages)
+        checkpoint.last_name = last_name
+        checkpoint.save()
+        logging.info(
+                     f"> backfill: Processed {checkpoint.objects} objects, " +
+                     f"{checkpoint.requests} query requests; last object: {last_name}.")
+    return checkpoint
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--bucket', help='List objects from this GCS bucket.')
+    source.add_argument('--manifest', help='Read objects from a local JSON/JSONL manifest.')
+    parser.add_argument('--prefix', default='', help='Only list objects under this prefix.')
+
+    sink = parser.add_mutually_exclusive_group(required=True)
+    sink.add_argument('--output', help='Write query requests to this JSONL file.')
+    sink.add_argument('--publish', action='store_true', help='Publish query requests to Pub/Sub.')
+    parser.add_argument('--project', help='Google Cloud project for --publish.')
+    parser.add_argument('--topic', help='db-query topic for --publish.')
+
+    parser.add_argument('--checkpoint', help='Checkpoint file used to resume runs.')
+    parser.add_argument('--restart', action='store_true', help='Ignore the checkpoint and start from the first object.')
+    parser.add_argument('--triggers', help='Trigger YAML (default: 1000-genomes-triggers.yaml).')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    if args.publish and not (args.project and args.topic):
+        parser.error('--publish requires --project and --topic.')
+    return args
+
+
+def main_cli(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    configure_pipeline(args.triggers)
+
+    if args.bucket:
+        source = f"gs://{args.bucket}/{args.prefix}"
+    else:
+        source = os.path.abspath(args.manifest)
+    if args.restart and args.checkpoint and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+    checkpoint = Checkpoint(args.checkpoint, source)
+    if checkpoint.objects:
+        logging.info(f"> backfill: Resuming after {checkpoint.objects} objects ({checkpoint.last_name}).")
+
+    if args.bucket:
+        gcs_objects = list_gcs_objects(args.bucket, args.prefix, start_after=checkpoint.last_name)
+    else:
+        gcs_objects = read_manifest(args.manifest, skip=checkpoint.objects)
+
+    if args.publish:
+        sink = PubSubSink(pubsub.PublisherClient(), args.project, args.topic)
+    else:
+        sink = JsonlSink(args.output, offset=checkpoint.output_offset)
+
+    try:
+        run_backfill(
+                     gcs_objects,
+                     sink,
+                     checkpoint,
+                     workers = args.workers,
+                     chunk_size = args.chunk_size,
+                     triggers_file = args.triggers)
+    finally:
+        sink.close()
+    logging.info(f"> backfill: Done. {checkpoint.objects} objects, {checkpoint.requests} query requests.")
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
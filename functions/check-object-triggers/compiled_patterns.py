@@ -0,0 +1,336 @@
+import re
+
+try:
+    # Python >= 3.11
+    from re import _parser as sre_parse
+    from re import _constants as sre_constants
+except ImportError:
+    import sre_parse
+    import sre_constants
+
+# Only required literals at least this long are worth a lookup in the
+# combined literal scanner; shorter ones match almost every object name.
+MIN_REQUIRED_LITERAL = 3
+
+# With fewer patterns, searching each compiled pattern in turn is faster
+# than looking up and scanning for their literals.
+SEQUENTIAL_PATTERN_LIMIT = 12
+
+
+def _literal_run(tokens):
+    """Join consecutive LITERAL tokens into a string.
+
+    Args:
+        tokens (list): Parsed regex tokens as produced by sre_parse.
+    Returns:
+        (str): Literal characters up to the first non-literal token.
+    """
+    characters = []
+    for opcode, value in tokens:
+        if opcode is not sre_constants.LITERAL:
+            break
+        characters.append(chr(value))
+    return ''.join(characters)
+
+
+def _longest_literal(tokens):
+    """Return the longest run of literal tokens in a token sequence.
+
+    Every top-level token of a pattern has to match, so any literal run
+    found at the top level must appear in the searched string.
+    """
+    longest = ''
+    current = []
+    for opcode, value in tokens:
+        if opcode is sre_constants.LITERAL:
+            current.append(chr(value))
+            continue
+        if len(current) > len(longest):
+            longest = ''.join(current)
+        current = []
+    if len(current) > len(longest):
+        longest = ''.join(current)
+    return longest
+
+
+def analyze_pattern(regex_pattern):
+    """Find literal text that any match of a pattern must contain.
+
+    Args:
+        regex_pattern (str): Regular expression used with re.search().
+    Returns:
+        (tuple): (kind, literal) where kind is one of 'prefix', 'suffix',
+            'required' or None when no usable literal was found.
+    """
+    parsed = sre_parse.parse(regex_pattern)
+    # Global flags such as (?i) or (?m) change how literals and
+    # anchors behave, so those patterns are always searched.
+    if parsed.state.flags & ~sre_constants.SRE_FLAG_UNICODE:
+        return None, None
+
+    tokens = list(parsed)
+    if not tokens:
+        return None, None
+
+    # Pick the longest literal; anchored literals win ties because
+    # they are looked up directly instead of being scanned for.
+    candidates = []
+    start_opcode, start_value = tokens[0]
+    if start_opcode is sre_constants.AT and start_value in (
+            sre_constants.AT_BEGINNING, sre_constants.AT_BEGINNING_STRING):
+        candidates.append(('prefix', _literal_run(tokens[1:])))
+
+    end_opcode, end_value = tokens[-1]
+    if end_opcode is sre_constants.AT and end_value in (
+            sre_constants.AT_END, sre_constants.AT_END_STRING):
+        candidates.append(('suffix', _literal_run(reversed(tokens[:-1]))[::-1]))
+
+    required = _longest_literal(tokens)
+    if len(required) >= MIN_REQUIRED_LITERAL:
+        candidates.append(('required', required))
+
+    candidates = [candidate for candidate in candidates if candidate[1]]
+    if not candidates:
+        return None, None
+    return max(candidates, key=lambda candidate: len(candidate[1]))
+
+
+class TriggerMatcher:
+
+    def __init__(self, object_triggers, sequential_limit=SEQUENTIAL_PATTERN_LIMIT):
+        """Compile object trigger patterns into a dispatch structure.
+
+        Patterns are compiled once and bucketed by literal text that
+        any match must contain, so an object name is only searched with
+        patterns that could possibly match it:
+            * anchored literal prefixes, looked up by name[:length]
+            * anchored literal suffixes, looked up by name[-length:]
+            * other required literals, found with one combined
+              alternation over all of them
+        Patterns without a usable literal are searched for every object.
+        Fewer than sequential_limit patterns are not bucketed; every
+        object is searched with each of them.
+
+        Args:
+            object_triggers (dict): Query names mapped to regex patterns,
+                as loaded from the triggers YAML.
+            sequential_limit (int): Smallest number of patterns that is
+                bucketed.
+        """
+        self.queries = list(object_triggers.keys())
+        self.patterns = [re.compile(pattern) for pattern in object_triggers.values()]
+
+        self.prefix_buckets = {}
+        self.suffix_buckets = {}
+        self.literal_buckets = {}
+        unfiltered = []
+
+        for index, regex_pattern in enumerate(object_triggers.values()):
+            if len(self.patterns) < sequential_limit:
+                unfiltered.append(index)
+                continue
+            kind, literal = analyze_pattern(regex_pattern)
+            if kind == 'prefix':
+                buckets = self.prefix_buckets
+            elif kind == 'suffix':
+                buckets = self.suffix_buckets
+            elif kind == 'required':
+                buckets = self.literal_buckets
+            else:
+                unfiltered.append(index)
+                continue
+            buckets.setdefault(literal, []).append(index)
+
+        self.unfiltered = tuple(unfiltered)
+        self.prefix_lengths = sorted({len(literal) for literal in self.prefix_buckets})
+        self.suffix_lengths = sorted({len(literal) for literal in self.suffix_buckets})
+
+        # One alternation over all required literals. Longest literals are
+        # listed first so the alternation reports the longest literal found
+        # at each position; shorter literals found at the same position are
+        # always prefixes of it and are resolved from literal_prefixes.
+        self.literal_scanner = None
+        self.literal_prefixes = {}
+        if self.literal_buckets:
+            literals = sorted(self.literal_buckets, key=len, reverse=True)
+            alternation = '|'.join(re.escape(literal) for literal in literals)
+            self.literal_scanner = re.compile(f"(?=({alternation}))", re.DOTALL)
+            for literal in literals:
+                self.literal_prefixes[literal] = [
+                    other for other in literals if literal.startswith(other)]
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def candidates(self, event_name):
+        """Get the indices of patterns that could match an object name.
+
+        Args:
+            event_name (str): Object path.
+        Returns:
+            (list): Sorted pattern indices, in trigger file order; a tuple
+                when the patterns are searched sequentially.
+        """
+        if len(self.unfiltered) == len(self.patterns):
+            return self.unfiltered
+
+        candidates = set(self.unfiltered)
+
+        for length in self.prefix_lengths:
+            bucket = self.prefix_buckets.get(event_name[:length])
+            if bucket:
+                candidates.update(bucket)
+
+        # '$' also matches before a trailing newline
+        names = [event_name]
+        if event_name.endswith('\n'):
+            names.append(event_name[:-1])
+        for name in names:
+            for length in self.suffix_lengths:
+                bucket = self.suffix_buckets.get(name[-length:])
+                if bucket:
+                    candidates.update(bucket)
+
+        if self.literal_scanner:
+            found = {match.group(1) for match in self.literal_scanner.finditer(event_name)}
+            for longest in found:
+                for literal in self.literal_prefixes[longest]:
+                    candidates.update(self.literal_buckets[literal])
+
+        return sorted(candidates)
+
+    def match(self, event_name, object_metadata):
+        """Match an object name against all trigger patterns.
+
+        Args:
+            event_name (str): Object path.
+            object_metadata (dict): Metadata added to the parameters of
+                every matched query.
+        Returns:
+            (dict): Same {query: parameters} result as match_object_triggers().
+        """
+        queries_to_request = {}
+        for index in self.candidates(event_name):
+            match = self.patterns[index].search(event_name)
+            if match:
+                query_parameters = match.groupdict()
+                query_parameters.update(object_metadata)
+                queries_to_request[self.queries[index]] = query_parameters
+        return queries_to_request
+
+
+def _has_group_references(tokens):
+    """Check parsed regex tokens for backreferences and conditionals.
+
+    Those refer to groups by number, which changes when patterns are
+    combined, so such patterns are matched on their own.
+    """
+    for opcode, value in tokens:
+        if opcode in (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS):
+            return True
+        stack = [value]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, sre_parse.SubPattern):
+                if _has_group_references(item):
+                    return True
+            elif isinstance(item, (list, tuple)):
+                stack.extend(item)
+    return False
+
+
+class LabelClassifier:
+
+    def __init__(self, node_kinds):
+        """Assign node labels with a single regex match per object path.
+
+        All NodeKinds.match_patterns are combined into one regex made of
+        optional lookaheads, one per pattern, each anchored like
+        re.fullmatch(). Named groups are renamed per pattern so patterns
+        can reuse the same group names. Patterns using backreferences or
+        global flags can't be combined and are matched separately.
+
+        Args:
+            node_kinds (NodeKinds): Instance from a create-node-config module.
+        """
+        self.node_kinds = node_kinds
+        self.labels = []
+        # (label, marker group or compiled pattern, {group: combined group})
+        self._label_patterns = []
+        self._function_cache = {}
+
+        alternatives = []
+        for label, patterns in node_kinds.match_patterns.items():
+            self.labels.append(label)
+            for regex_pattern in patterns:
+                index = len(self._label_patterns)
+                parsed = sre_parse.parse(regex_pattern)
+                if parsed.state.flags & ~sre_constants.SRE_FLAG_UNICODE or _has_group_references(parsed):
+                    self._label_patterns.append((label, re.compile(regex_pattern), None))
+                    continue
+
+                group_names = {name: f"_p{index}_{name}" for name in parsed.state.groupdict}
+                renamed_pattern = re.sub(
+                                         r"\(\?P<(\w+)>",
+                                         lambda match: f"(?P<{group_names[match.group(1)]}>",
+                                         regex_pattern)
+                marker = f"_p{index}"
+                alternatives.append(f"(?:(?=(?:{renamed_pattern})\\Z)(?P<{marker}>))?")
+                self._label_patterns.append((label, marker, group_names))
+
+        self.combined_pattern = re.compile(''.join(alternatives))
+
+    def classify(self, path):
+        """Get every label whose patterns fully match a path.
+
+        Equivalent to calling re.fullmatch() with each pattern and keeping
+        the first matching pattern of each label.
+
+        Args:
+            path (str): Object path.
+        Returns:
+            (tuple): (labels, groups) where labels is a tuple in
+                match_patterns order and groups the named groups of all
+                matching patterns merged, earlier labels first. Groups
+                that did not participate in a match don't replace values.
+        """
+        combined_match = self.combined_pattern.match(path)
+        labels = []
+        groups = {}
+        for label, matcher, group_names in self._label_patterns:
+            if labels and labels[-1] == label:
+                # Only the first matching pattern of each label is used
+                continue
+            if group_names is None:
+                match = matcher.fullmatch(path)
+                if not match:
+                    continue
+                label_groups = match.groupdict()
+            else:
+                if combined_match.group(matcher) is None:
+                    continue
+                label_groups = {name: combined_match.group(combined_name) for name, combined_name in group_names.items()}
+            labels.append(label)
+            for name, value in label_groups.items():
+                if groups.get(name) is None:
+                    groups[name] = value
+        return tuple(labels), groups
+
+    def get_label_functions(self, labels):
+        """NodeKinds.get_label_functions(), cached per label tuple.
+
+        Args:
+            labels (tuple): Labels returned by classify().
+        Returns:
+            (list): Label functions, shared between calls; don't modify.
+        """
+        label_functions = self._function_cache.get(labels)
+        if label_functions is None:
+            if hasattr(self.node_kinds, 'get_label_functions'):
+                label_functions = self.node_kinds.get_label_functions(labels)
+            else:
+                label_functions = []
+                for label in labels:
+                    label_functions.extend(self.node_kinds.label_functions.get(label, []))
+            self._function_cache[labels] = label_functions
+        return label_functions
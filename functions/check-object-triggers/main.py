@@ -1,18 +1,14 @@
 import os
 import re
-import pdb
 import json
 import uuid
 import yaml
-import iso8601
-import importlib
 
+import event_dedup
+import lazy_clients
 import trellisdata as trellis
 
-from collections import deque
-
-from google.cloud import storage
-from google.cloud import pubsub
+from compiled_patterns import TriggerMatcher
 
 ENVIRONMENT = os.environ.get('ENVIRONMENT', 'Environment variable not set')
 if ENVIRONMENT == 'google-cloud':
@@ -30,13 +26,29 @@ if ENVIRONMENT == 'google-cloud':
     PROJECT_ID = os.environ['PROJECT_ID']
     TOPIC_DB_QUERY = os.environ['TOPIC_DB_QUERY']
 
-    PUBLISHER = pubsub.PublisherClient()
+    # Clients are created on first use
+    PUBLISHER = lazy_clients.PUBLISHER
     # Storage client is used for adding UUIDs to blobs
-    STORAGE_CLIENT = storage.Client()
+    STORAGE_CLIENT = lazy_clients.STORAGE_CLIENT
+else:
+    import logging
+
+    FUNCTION_NAME = 'check-object-triggers-local'
+    TOPIC_DB_QUERY = os.environ.get('TOPIC_DB_QUERY')
+
+# Only deduplicate locally when DEDUP_DATABASE is set. Triggered on
+# metadata updates, so updates of the same generation are not repeats.
+EVENT_DEDUPLICATOR = event_dedup.get_deduplicator(
+                                                  namespace = FUNCTION_NAME,
+                                                  enabled = ENVIRONMENT == 'google-cloud',
+                                                  key_fields = event_dedup.METAGENERATION_FIELDS)
 
-    triggers_file = '1000-genomes-triggers.yaml'
-    with open(triggers_file, 'r') as file_handle:
-        OBJECT_TRIGGERS = yaml.safe_load(file_handle)
+# Next to this module, wherever it is imported from
+triggers_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), '1000-genomes-triggers.yaml')
+with open(triggers_file, 'r') as file_handle:
+    OBJECT_TRIGGERS = yaml.safe_load(file_handle)
+# Compile trigger patterns once per function instance
+TRIGGER_MATCHER = TriggerMatcher(OBJECT_TRIGGERS)
 
 class OldNodeKinds:
 
@@ -108,6 +120,160 @@ def match_object_triggers(event_name, object_metadata, object_triggers):
             queries_to_request[query] = query_parameters
     return queries_to_request
 
+def create_query_requests(event, seed_id):
+    """Match an object event against the triggers and format query requests.
+
+    Args:
+        event (dict): GCS object event payload.
+        seed_id (str): Event ID of the object event.
+    Returns:
+        (list): (query name, query request message) tuples.
+    """
+    queries_to_request = TRIGGER_MATCHER.match(
+                                               event_name = event['name'], 
+                                               object_metadata = event['metadata'])
+
+    query_requests = []
+    for query_name, parameters in queries_to_request.items():
+        # Create query request
+        query_request = trellis.QueryRequestWriter(
+            sender = FUNCTION_NAME,
+            seed_id = seed_id,
+            previous_event_id = seed_id,
+            query_name = query_name,
+            query_parameters = parameters)
+        query_requests.append((query_name, query_request.format_json_message()))
+    return query_requests
+
+def publish_messages(publisher, project_id, topic, messages):
+    """Publish messages without waiting on each one.
+
+    Messages are encoded the same way as trellis.utils.publish_to_pubsub_topic()
+    but all publish futures are collected first, so the client can batch
+    them, and resolved together afterwards.
+
+    Args:
+        publisher (pubsub.PublisherClient): Pub/Sub client
+        project_id (str): Google Cloud Project ID
+        topic (str): Pub/Sub topic name
+        messages (list): Dictionaries with header and body fields.
+    Returns:
+        (list): Published message IDs, in message order.
+    """
+    topic_path = publisher.topic_path(project_id, topic)
+    futures = []
+    for message in messages:
+        json_message = json.dumps(message, indent=4, sort_keys=True, default=str).encode('utf-8')
+        futures.append(publisher.publish(topic_path, data=json_message))
+    return [future.result() for future in futures]
+
+def read_events_from_jsonl(path):
+    """Read object events from a JSON Lines file.
+
+    Each line is either {"event": {...}, "context": {"event_id": ...}} or
+    a bare GCS object resource. Bare resources use the object generation
+    as the event ID.
+
+    Args:
+        path (str): Path to the JSONL file.
+    Yields:
+        (tuple): (event, context) pairs for check_object_triggers_batch().
+    """
+    with open(path, 'r') as file_handle:
+        for line in file_handle:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if 'event' in record:
+                event = record['event']
+                context = trellis.utils.Struct(**record['context'])
+            else:
+                event = record
+                context = trellis.utils.Struct(
+                                               event_id = event['generation'],
+                                               timestamp = event.get('updated'))
+            yield event, context
+
+def read_events_from_pubsub(received_messages):
+    """Convert pulled Pub/Sub storage notifications into object events.
+
+    Args:
+        received_messages (list): pubsub_v1.types.ReceivedMessage objects
+            returned by SubscriberClient.pull().
+    Yields:
+        (tuple): (event, context) pairs for check_object_triggers_batch().
+    """
+    for received_message in received_messages:
+        message = received_message.message
+        event = json.loads(message.data)
+        context = trellis.utils.Struct(
+                                       event_id = message.message_id,
+                                       timestamp = message.publish_time)
+        yield event, context
+
+def check_object_triggers_batch(events, dry_run=False):
+    """Process many object events in one pass and publish in bulk.
+
+    Produces the same query requests as calling check_object_triggers()
+    once per event, but publishes them grouped per query name without
+    waiting on each message.
+
+    Args:
+        events (iterable): (event, context) pairs.
+        dry_run (bool): Format messages without publishing them or
+            recording the events as processed.
+    Returns:
+        (dict): Query names mapped to their query request messages.
+    """
+    # Dry runs don't record events, so the real run processes them
+    deduplicator = None if dry_run else EVENT_DEDUPLICATOR
+    query_requests = {}
+    # Claimed events that matched each query name
+    query_events = {}
+    event_count = 0
+    claimed_count = 0
+    for event, context in events:
+        event_count += 1
+        if deduplicator:
+            if deduplicator.is_duplicate(event):
+                continue
+            claimed_count += 1
+        for query_name, message in create_query_requests(event, context.event_id):
+            query_requests.setdefault(query_name, []).append(message)
+            query_events.setdefault(query_name, []).append(event)
+
+    request_counts = {name: len(messages) for name, messages in query_requests.items()}
+    logging.info(f"> check-object-triggers: Batch of {event_count} events matched: {request_counts}.")
+    if deduplicator:
+        logging.info(f"> check-object-triggers: Skipped {event_count - claimed_count} duplicate events. Deduplication stats: {deduplicator.stats()}.")
+    if dry_run:
+        return query_requests
+
+    if ENVIRONMENT == 'google-cloud':
+        published_queries = set()
+        try:
+            for query_name, messages in query_requests.items():
+                results = publish_messages(
+                    publisher = PUBLISHER,
+                    project_id = PROJECT_ID,
+                    topic = TOPIC_DB_QUERY,
+                    messages = messages)
+                published_queries.add(query_name)
+                logging.info(f"> check-object-triggers: Published {len(results)} '{query_name}' requests to {TOPIC_DB_QUERY}.")
+        except Exception:
+            # Let redelivered events through again, unless all of their
+            # requests were published
+            if deduplicator:
+                for query_name, matched_events in query_events.items():
+                    if query_name not in published_queries:
+                        for event in matched_events:
+                            deduplicator.forget(event)
+            raise
+    else:
+        logging.warning("> check-object-triggers: Could not determine environment. Messages were not published.")
+    return query_requests
+
+@event_dedup.skip_duplicates(EVENT_DEDUPLICATOR)
 def check_object_triggers(event, context, test=False):
     """When object created in bucket, add metadata to database.
     Args:
@@ -122,22 +288,10 @@ def check_object_triggers(event, context, test=False):
     seed_id = context.event_id
 
     logging.info(f"> check-object-triggers: Matching database query patterns.")
-    queries_to_request = match_object_triggers(
-                                               event_name = event['name'], 
-                                               object_metadata = event['metadata'],
-                                               object_triggers = OBJECT_TRIGGERS)
-
-    logging.info(f"> check-object-triggers: Object matched {len(queries_to_request)} trigger patterns: {queries_to_request.keys()}.")
-    for query_name, parameters in queries_to_request.items():
-        # Create query request
-        query_request = trellis.QueryRequestWriter(
-            sender = FUNCTION_NAME,
-            seed_id = seed_id,
-            previous_event_id = seed_id,
-            query_name = query_name,
-            query_parameters = parameters)
+    query_requests = create_query_requests(event, seed_id)
 
-        message = query_request.format_json_message()
+    logging.info(f"> check-object-triggers: Object matched {len(query_requests)} trigger patterns: {[name for name, _ in query_requests]}.")
+    for query_name, message in query_requests:
         logging.info(f"> check-object-triggers: Publishing message '{message}' to topic '{TOPIC_DB_QUERY}'.")
         if ENVIRONMENT == 'google-cloud':
             result = trellis.utils.publish_to_pubsub_topic(
@@ -148,4 +302,4 @@ def check_object_triggers(event, context, test=False):
             logging.info(f"> check-object-triggers: Published message to {TOPIC_DB_QUERY} with result: {result}.")
         else:
             logging.warning("> check-object-triggers: Could not determine environment. Message was not published.")
-            return(message)
\ No newline at end of file
+            return(message)
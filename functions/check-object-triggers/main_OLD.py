@@ -9,7 +9,8 @@ import importlib
 
 import trellisdata as trellis
 
-from collections import deque
+from taxonomy_index import TaxonomyIndex
+from compiled_patterns import LabelClassifier
 
 from google.cloud import storage
 from google.cloud import pubsub
@@ -35,12 +36,11 @@ if ENVIRONMENT == 'google-cloud':
     # Storage client is used for adding UUIDs to blobs
     STORAGE_CLIENT = storage.Client()
 
-    TAXONOMY_PARSER = read_from_json('label-taxonomy.json')
 else:
     import logging
 
-    TAXONOMY_PARSER = trellis.utils.TaxonomyParser()
-    TAXONOMY_PARSER.read_from_json('label-taxonomy.json')
+# Ancestor sets are computed once per function instance
+TAXONOMY_INDEX = TaxonomyIndex.from_json('label-taxonomy.json')
 
 class OldNodeKinds:
 
@@ -278,26 +278,40 @@ def assign_labels_and_metadata(query_parameters, label_patterns, label_functions
                 break
     return query_parameters, labels
 
-def get_leaf_labels(labels, taxonomy_parser):
+# Label classifiers compiled per create-node-config module
+LABEL_CLASSIFIERS = {}
+
+def get_label_classifier(node_module):
+    label_classifier = LABEL_CLASSIFIERS.get(node_module.__name__)
+    if not label_classifier:
+        label_classifier = LabelClassifier(node_module.NodeKinds())
+        LABEL_CLASSIFIERS[node_module.__name__] = label_classifier
+    return label_classifier
+
+def assign_labels_and_metadata_compiled(query_parameters, label_classifier):
+    """Single-pass version of assign_labels_and_metadata().
+
+    Label functions get the named groups of all matching patterns merged
+    instead of only the groups of their own label's pattern.
+
+    Args:
+        query_parameters (dict): Object metadata, including 'path'.
+        label_classifier (LabelClassifier): Compiled NodeKinds patterns.
+    Returns:
+        (tuple): (query_parameters, labels)
+    """
+    labels, groupdict = label_classifier.classify(query_parameters['path'])
+    for metadata_function in label_classifier.get_label_functions(labels):
+        custom_fields = metadata_function(query_parameters, groupdict)
+        query_parameters.update(custom_fields)
+    return query_parameters, list(labels)
+
+def get_leaf_labels(labels, taxonomy_index):
     # Get only the shallowest labels of a branch of the taxonomy that should be applied 
     # to the node. The point of the taxonomy is so that we can retain lineage information
     # without applying multiple labels to a node.
-    common_parents = []
-    for label in labels:
-        node = taxonomy_parser.find_by_name(label)
-        # https://docs.python.org/3/library/collections.html#collections.deque
-        parents = deque(node.path)
-
-        parents.popleft() # Remove the arbitrary root node
-        parents.pop()     # Remove the current label
-        common_parents.extend(parents)
-    common_parents = set(common_parents) # Only keep unique nodes
-    
     # If a label is a parent of another label, exclude it
-    for label in labels:
-        if label in [parent.name for parent in common_parents]:
-            labels.remove(label)
-    return labels
+    return taxonomy_index.get_leaf_labels(labels)
 
 def create_blob_node(event, context, test=False):
     """When object created in bucket, add metadata to database.
@@ -335,10 +349,8 @@ def create_blob_node(event, context, test=False):
         import test_create_node_config as node_module
     """
 
-    node_kinds = node_module.NodeKinds()
-    label_patterns = node_kinds.match_patterns
-    label_functions = node_kinds.label_functions
-    logging.debug(f"> create-blob: Label patterns: {len(label_patterns)}, label functions: {len(label_functions)}.")
+    label_classifier = get_label_classifier(node_module)
+    logging.debug(f"> create-blob: Labels: {len(label_classifier.labels)}.")
 
     # Create dict of metadata to add to database node
     #gcp_metadata = event
@@ -378,10 +390,10 @@ def create_blob_node(event, context, test=False):
 
     # Populate query_parameters with metadata about object
     logging.debug(f"> create-blob: Query parameter 'path': {query_parameters['path']}.")
-    query_parameters, labels = assign_labels_and_metadata(query_parameters, label_patterns, label_functions)
+    query_parameters, labels = assign_labels_and_metadata_compiled(query_parameters, label_classifier)
     logging.debug(f"> create-blob: Labels assigned to node: {labels}.")
 
-    labels = get_leaf_labels(labels, TAXONOMY_PARSER)
+    labels = get_leaf_labels(labels, TAXONOMY_INDEX)
     logging.info(f"> create-blob: Leaf labels (expect one): {labels}.")
 
     if 'Log' in labels:
@@ -0,0 +1,82 @@
+import json
+
+
+class TaxonomyIndex:
+
+    def __init__(self, taxonomy, level_prefix='L'):
+        """Precomputed lookups over the label taxonomy.
+
+        The taxonomy is a dict of levels ("L0", "L1", ...), each a list of
+        {"name": ..., "parent": ...} entries, as in label-taxonomy.json.
+        Ancestor sets and depths are computed once here, so resolving
+        the labels of a node is a set operation instead of a tree walk.
+
+        Args:
+            taxonomy (dict): Taxonomy levels.
+            level_prefix (str): Prefix of the level keys.
+        Raises:
+            ValueError: If a label is defined more than once or its
+                parent is not defined in a previous level.
+        """
+        self.parents = {}
+        self.depths = {}
+        self.ancestors = {}
+        self.children = {}
+
+        level_count = len(taxonomy)
+        root_entries = taxonomy[f"{level_prefix}0"]
+        if len(root_entries) != 1:
+            raise ValueError(f"Taxonomy level {level_prefix}0 must have a single root, found {len(root_entries)}.")
+        self.root = root_entries[0]['name']
+        self._add_label(self.root, None, 0)
+
+        for depth in range(1, level_count):
+            for entry in taxonomy[f"{level_prefix}{depth}"]:
+                name = entry['name']
+                parent = entry['parent']
+                if parent not in self.depths:
+                    raise ValueError(f"Parent '{parent}' of label '{name}' is not defined in a previous level.")
+                self._add_label(name, parent, depth)
+
+        # Labels without children are the most specific ones
+        self.leaves = frozenset(
+                                label for label in self.depths
+                                if not self.children[label])
+
+    def _add_label(self, name, parent, depth):
+        if name in self.depths:
+            raise ValueError(f"Label '{name}' is defined in duplicate.")
+        self.parents[name] = parent
+        self.depths[name] = depth
+        self.children[name] = []
+        if parent is None:
+            self.ancestors[name] = frozenset()
+        else:
+            self.children[parent].append(name)
+            # The root is an arbitrary node, not a label
+            self.ancestors[name] = (self.ancestors[parent] | {parent}) - {self.root}
+
+    @classmethod
+    def from_json(cls, path, level_prefix='L'):
+        with open(path, 'r') as file_handle:
+            taxonomy = json.load(file_handle)
+        return cls(taxonomy, level_prefix)
+
+    def __contains__(self, label):
+        return label in self.depths
+
+    def get_leaf_labels(self, labels):
+        """Drop labels that are ancestors of other labels in the list.
+
+        Args:
+            labels (list): Labels assigned to a node.
+        Returns:
+            (list): Labels that are not a parent of another assigned
+                label, in input order.
+        Raises:
+            KeyError: If a label is not in the taxonomy.
+        """
+        common_ancestors = set()
+        for label in labels:
+            common_ancestors |= self.ancestors[label]
+        return [label for label in labels if label not in common_ancestors]
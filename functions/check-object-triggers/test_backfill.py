@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import tempfile
+
+from unittest import TestCase
+
+import backfill
+
+
+def make_gcs_object(index):
+	name = f"SAMN{index:04d}/HAS_READ_GROUP/ERR{index:04d}/HAS_FASTQ/ERR{index:04d}_1.fastq.gz"
+	return {
+		'bucket': 'gcp-bucket-1000-genomes',
+		'name': name,
+		'id': f"gcp-bucket-1000-genomes/{name}/16000000000{index:05d}",
+		'generation': f"16000000000{index:05d}",
+		'size': '5955984357',
+		'crc32c': 'ftNG8w==',
+		'timeCreated': '2020-02-19T01:31:55.288Z',
+		'updated': '2022-02-28T21:13:19.739Z',
+		'metadata': {},
+	}
+
+
+class FailingSink(backfill.JsonlSink):
+
+	def __init__(self, path, offset=0, fail_after=1):
+		super().__init__(path, offset)
+		self.chunks = 0
+		self.fail_after = fail_after
+
+	def write(self, messages):
+		if self.chunks == self.fail_after:
+			# Leave a partially written chunk behind
+			super().write(messages[:1])
+			self.file_handle.flush()
+			raise RuntimeError("Simulated crash")
+		super().write(messages)
+		self.chunks += 1
+
+
+class TestBackfill(TestCase):
+
+	gcs_objects = [make_gcs_object(index) for index in range(10)]
+
+	def setUp(cls):
+		cls.directory = tempfile.TemporaryDirectory()
+		cls.manifest = os.path.join(cls.directory.name, 'objects.jsonl')
+		with open(cls.manifest, 'w') as file_handle:
+			for gcs_object in cls.gcs_objects:
+				file_handle.write(json.dumps(gcs_object) + '\n')
+
+	def tearDown(cls):
+		cls.directory.cleanup()
+
+	def run_to_file(cls, output, checkpoint_path, sink=None):
+		checkpoint = backfill.Checkpoint(checkpoint_path, cls.manifest)
+		if not sink:
+			sink = backfill.JsonlSink(output, offset=checkpoint.output_offset)
+		try:
+			backfill.run_backfill(
+				backfill.read_manifest(cls.manifest, skip=checkpoint.objects),
+				sink,
+				checkpoint,
+				workers = 1,
+				chunk_size = 3)
+		finally:
+			sink.close()
+		return checkpoint
+
+	def test_object_metadata(cls):
+		metadata = backfill.get_object_metadata(cls.gcs_objects[0])
+
+		assert metadata['basename'] == 'ERR0000_1.fastq.gz'
+		assert metadata['gcsId'] == cls.gcs_objects[0]['id']
+		assert metadata['timeCreatedEpoch'] == '1582075915.288'
+		assert metadata['trellisUuid'] == backfill.get_object_metadata(cls.gcs_objects[0])['trellisUuid']
+
+	def test_batch_object_metadata(cls):
+		expected = [backfill.get_object_metadata(gcs_object) for gcs_object in cls.gcs_objects]
+		assert backfill.get_objects_metadata(cls.gcs_objects) == expected
+
+	def test_resume_after_crash(cls):
+		expected_output = os.path.join(cls.directory.name, 'expected.jsonl')
+		checkpoint = cls.run_to_file(expected_output, None)
+		assert checkpoint.objects == 10
+		# relateSampleToReadGroup, relateReadGroupToFastq, mergeFastq
+		assert checkpoint.requests == 30
+
+		output = os.path.join(cls.directory.name, 'requests.jsonl')
+		checkpoint_path = os.path.join(cls.directory.name, 'checkpoint.json')
+		crashing_sink = FailingSink(output, fail_after=2)
+		with cls.assertRaises(RuntimeError):
+			cls.run_to_file(output, checkpoint_path, sink=crashing_sink)
+
+		with open(checkpoint_path, 'r') as file_handle:
+			assert json.load(file_handle)['objects'] == 6
+
+		checkpoint = cls.run_to_file(output, checkpoint_path)
+		assert checkpoint.objects == 10
+		assert checkpoint.last_name == cls.gcs_objects[-1]['name']
+		with open(output, 'r') as file_handle, open(expected_output, 'r') as expected_handle:
+			assert file_handle.read() == expected_handle.read()
+
+	def test_checkpoint_source_mismatch(cls):
+		checkpoint_path = os.path.join(cls.directory.name, 'checkpoint.json')
+		backfill.Checkpoint(checkpoint_path, cls.manifest).save()
+
+		with cls.assertRaises(ValueError):
+			backfill.Checkpoint(checkpoint_path, 'gs://other-bucket/')
+
+	def test_resume_without_output(cls):
+		output = os.path.join(cls.directory.name, 'missing.jsonl')
+		with cls.assertRaises(ValueError):
+			backfill.JsonlSink(output, offset=100)
+		assert not os.path.exists(output)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import mock
+import tempfile
+
+import trellisdata as trellis
+
+from unittest import TestCase
+
+import main
+
+
+class TestCheckObjectTriggersBatch(TestCase):
+
+	fastq_event = {
+		'bucket': 'gcp-bucket-1000-genomes',
+		'generation': '1582075915288601',
+		'metadata': {'size': '5955984357', 'crc32c': 'ftNG8w=='},
+		'name': 'SAMN01/HAS_READ_GROUP/ERR02/HAS_FASTQ/ERR02_1.fastq.gz',
+	}
+	other_event = {
+		'bucket': 'gcp-bucket-1000-genomes',
+		'generation': '1582075915288602',
+		'metadata': {'size': '10', 'crc32c': 'AAAAAA=='},
+		'name': 'SAMN01/README.txt',
+	}
+
+	def test_batch_matches_single_events(cls):
+		contexts = [mock.Mock(event_id='1001'), mock.Mock(event_id='1002'), mock.Mock(event_id='1003')]
+		events = [cls.fastq_event, cls.other_event, cls.fastq_event]
+
+		query_requests = main.check_object_triggers_batch(zip(events, contexts), dry_run=True)
+
+		expected = {}
+		for event, context in zip(events, contexts):
+			for query_name, message in main.create_query_requests(event, context.event_id):
+				expected.setdefault(query_name, []).append(message)
+		assert query_requests == expected
+		assert len(query_requests['mergeFastq']) == 2
+		assert [message['header']['seedId'] for message in query_requests['mergeFastq']] == ['1001', '1003']
+
+	def test_publish_messages_encoding(cls):
+		publisher = mock.Mock()
+		message = main.create_query_requests(cls.fastq_event, '1001')[0][1]
+
+		trellis.utils.publish_to_pubsub_topic(publisher, 'project', 'topic', message)
+		single_data = publisher.publish.call_args.kwargs['data']
+
+		main.publish_messages(publisher, 'project', 'topic', [message])
+		assert publisher.publish.call_args.kwargs['data'] == single_data
+
+	def test_read_events_from_jsonl(cls):
+		with tempfile.NamedTemporaryFile('w', suffix='.jsonl', delete=False) as file_handle:
+			file_handle.write(json.dumps(cls.fastq_event) + '\n\n')
+			file_handle.write(json.dumps({'event': cls.other_event, 'context': {'event_id': '42'}}) + '\n')
+
+		events = list(main.read_events_from_jsonl(file_handle.name))
+		os.remove(file_handle.name)
+
+		assert [event['name'] for event, context in events] == [cls.fastq_event['name'], cls.other_event['name']]
+		assert [context.event_id for event, context in events] == ['1582075915288601', '42']
+
+	def test_batch_skips_duplicate_events(cls):
+		event = dict(cls.fastq_event, id=f"gcp-bucket-1000-genomes/{cls.fastq_event['name']}/1582075915288601")
+		contexts = [mock.Mock(event_id='1001'), mock.Mock(event_id='1002')]
+		deduplicator = main.event_dedup.EventDeduplicator('check-object-triggers-test')
+
+		with mock.patch.object(main, 'EVENT_DEDUPLICATOR', deduplicator), cls.assertLogs(level='WARNING'):
+			query_requests = main.check_object_triggers_batch(zip([event, event], contexts))
+
+		assert [message['header']['seedId'] for message in query_requests['mergeFastq']] == ['1001']
+		assert deduplicator.stats()['hits'] == 1
+		assert deduplicator.stats()['misses'] == 1
+
+	def test_dry_run_does_not_claim_events(cls):
+		event = dict(cls.fastq_event, id=f"gcp-bucket-1000-genomes/{cls.fastq_event['name']}/1582075915288601")
+		deduplicator = main.event_dedup.EventDeduplicator('check-object-triggers-test')
+
+		with mock.patch.object(main, 'EVENT_DEDUPLICATOR', deduplicator):
+			main.check_object_triggers_batch([(event, mock.Mock(event_id='1001'))], dry_run=True)
+		assert deduplicator.is_duplicate(event) == False
+
+	def test_publish_failure_forgets_unpublished_events(cls):
+		fastq_event = dict(cls.fastq_event, id='fastq')
+		# Only matches mergeFastq
+		other_event = dict(cls.fastq_event, id='other', name='SAMPLE1_2.fastq.gz')
+		deduplicator = main.event_dedup.EventDeduplicator('check-object-triggers-test')
+		published = []
+
+		def publish_messages(publisher, project_id, topic, messages):
+			if messages[0]['body']['queryName'] == 'mergeFastq':
+				raise RuntimeError('Publish failed')
+			published.extend(messages)
+			return ['1'] * len(messages)
+
+		with mock.patch.multiple(
+								 main,
+								 create = True,
+								 EVENT_DEDUPLICATOR = deduplicator,
+								 ENVIRONMENT = 'google-cloud',
+								 PUBLISHER = mock.Mock(),
+								 PROJECT_ID = 'project',
+								 TOPIC_DB_QUERY = 'topic',
+								 publish_messages = publish_messages):
+			with cls.assertRaises(RuntimeError):
+				main.check_object_triggers_batch([
+					(fastq_event, mock.Mock(event_id='1001')),
+					(other_event, mock.Mock(event_id='1002'))])
+
+		assert len(published) == 2
+		# Both matched the unpublished mergeFastq requests
+		assert deduplicator.is_duplicate(fastq_event) == False
+		assert deduplicator.is_duplicate(other_event) == False
+
+	def test_publish_failure_keeps_published_events(cls):
+		fastq_event = dict(cls.fastq_event, id='fastq')
+		other_event = dict(cls.fastq_event, id='other', name='SAMPLE1_2.fastq.gz')
+		deduplicator = main.event_dedup.EventDeduplicator('check-object-triggers-test')
+
+		def publish_messages(publisher, project_id, topic, messages):
+			if messages[0]['body']['queryName'] == 'relateReadGroupToFastq':
+				raise RuntimeError('Publish failed')
+			return ['1'] * len(messages)
+
+		with mock.patch.multiple(
+								 main,
+								 create = True,
+								 EVENT_DEDUPLICATOR = deduplicator,
+								 ENVIRONMENT = 'google-cloud',
+								 PUBLISHER = mock.Mock(),
+								 PROJECT_ID = 'project',
+								 TOPIC_DB_QUERY = 'topic',
+								 publish_messages = publish_messages):
+			with cls.assertRaises(RuntimeError):
+				# mergeFastq requests are published first
+				main.check_object_triggers_batch([
+					(other_event, mock.Mock(event_id='1002')),
+					(fastq_event, mock.Mock(event_id='1001'))])
+
+		assert deduplicator.is_duplicate(fastq_event) == False
+		# All of its requests were published
+		assert deduplicator.is_duplicate(other_event) == True
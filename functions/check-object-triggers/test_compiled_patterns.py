@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import mock
+import yaml
+
+from unittest import TestCase
+
+import main
+
+from compiled_patterns import TriggerMatcher, LabelClassifier
+from test_create_node_config import CONFIG_DIR, load_create_node_config
+
+
+class TestTriggerMatcher(TestCase):
+
+	object_triggers = {
+		'relateSampleToReadGroup': r"(?P<sample_name>SAMN\d+)/HAS_READ_GROUP/(?P<read_group_name>ERR\d+)",
+		'relateReadGroupToFastq': r"(?P<read_group_name>ERR\d+)/HAS_FASTQ/(?P<fastq_name>ERR\d+_[1-2])\.fastq.gz$",
+		'mergeFastq': r"(?P<sample>[a-zA-Z0-9]+)_(?P<mate_pair>[1-2])\.fastq.gz$",
+		'mergePhase2Blob': r"^va_mvp_phase2/(?P<plate>\w+)/(?P<sample>\w+)/",
+		'mergeChecksum': r"checksum\.txt\Z",
+		'mergeVcf': r"(?i)\.VCF$",
+		'mergeAnyJson': r".*\.json",
+	}
+	object_metadata = {'size': '100', 'crc32c': 'ftNG8w=='}
+	object_names = [
+		'SAMN01/HAS_READ_GROUP/ERR02/HAS_FASTQ/ERR02_1.fastq.gz',
+		'SAMN01/HAS_READ_GROUP/ERR02/HAS_FASTQ/ERR02_1.fastq.gz\n',
+		'va_mvp_phase2/PLATE0/SAMPLE0/FASTQ/SAMPLE0_0_R1.fastq.gz',
+		'va_mvp_phase2/PLATE0/SAMPLE0/checksum.txt',
+		'va_mvp_phase2/PLATE0/SAMPLE0/checksum.txt\n',
+		'va_mvp_phase2/PLATE0/SAMPLE0/SAMPLE0.json',
+		'dsub/vcfstats/SAMPLE0.vcf',
+		'va_mvp_phase1/PLATE0/SAMPLE0/SAMPLE0_1.fastq.gz',
+		'',
+	]
+
+	def test_literal_buckets(cls):
+		matcher = TriggerMatcher(cls.object_triggers, sequential_limit=0)
+
+		assert matcher.prefix_buckets == {'va_mvp_phase2/': [3]}
+		assert matcher.suffix_buckets == {'checksum.txt': [4]}
+		assert matcher.literal_buckets == {
+			'/HAS_READ_GROUP/': [0],
+			'/HAS_FASTQ/': [1],
+			'.fastq': [2],
+			'.json': [6]}
+		assert matcher.unfiltered == (5,)
+
+	def test_sequential_below_limit(cls):
+		matcher = TriggerMatcher(cls.object_triggers, sequential_limit=len(cls.object_triggers) + 1)
+
+		assert matcher.prefix_buckets == matcher.suffix_buckets == matcher.literal_buckets == {}
+		assert matcher.unfiltered == tuple(range(len(cls.object_triggers)))
+
+	def test_matches_search_loop(cls):
+		for sequential_limit in (0, len(cls.object_triggers) + 1):
+			matcher = TriggerMatcher(cls.object_triggers, sequential_limit=sequential_limit)
+
+			for name in cls.object_names:
+				expected = main.match_object_triggers(name, cls.object_metadata, cls.object_triggers)
+				result = matcher.match(name, cls.object_metadata)
+				assert result == expected
+				assert list(result.keys()) == list(expected.keys())
+
+	def test_matches_1000_genomes_triggers(cls):
+		with open('1000-genomes-triggers.yaml', 'r') as file_handle:
+			object_triggers = yaml.safe_load(file_handle)
+		matcher = TriggerMatcher(object_triggers)
+
+		name = 'SAMN01/HAS_READ_GROUP/ERR02/HAS_FASTQ/ERR02_1.fastq.gz'
+		queries_to_request = matcher.match(name, cls.object_metadata)
+
+		assert list(queries_to_request.keys()) == [
+			'relateSampleToReadGroup',
+			'relateReadGroupToFastq',
+			'mergeFastq']
+		assert queries_to_request['mergeFastq']['sample'] == 'ERR02'
+		assert queries_to_request['mergeFastq']['size'] == '100'
+
+
+class TestLabelClassifier(TestCase):
+
+	class NodeKinds:
+
+		def __init__(self):
+			self.match_patterns = {
+				"Blob": [r"^va_mvp_phase2\/(?P<plate>\w+)\/(?P<sample>\w+)\/.*"],
+				"Fastq": [r"^va_mvp_phase2\/(?P<plate>\w+)\/(?P<sample>\w+)\/FASTQ\/.*\.fastq\.gz$"],
+				"Index": [".*\\.bai$", ".*\\.tbi$"],
+				"Doubled": [r"^(?P<part>\w+)/(?P=part)/.*"],
+				"Json": [r"(?i).*\.JSON$"],
+			}
+			self.label_functions = {
+				"Fastq": [lambda db_dict, groupdict: {'plate': groupdict['plate']}],
+				"Index": [lambda db_dict, groupdict: {'index': True}],
+			}
+
+		def get_label_functions(self, labels):
+			all_functions = []
+			for label in labels:
+				all_functions.extend(self.label_functions.get(label, []))
+			return all_functions
+
+	paths = [
+		'va_mvp_phase2/PLATE0/SAMPLE0/FASTQ/SAMPLE0_0_R1.fastq.gz',
+		'va_mvp_phase2/PLATE0/SAMPLE0/SAMPLE0.bam.bai',
+		'va_mvp_phase2/PLATE0/SAMPLE0/SAMPLE0.json',
+		'dsub/dsub/vcfstats/SAMPLE0.vcf.gz.tbi',
+		'va_mvp_phase2/PLATE0/SAMPLE0/FASTQ/SAMPLE0_0_R1.fastq.gz\n',
+		'other/SAMPLE0.txt',
+	]
+
+	def assign_labels(cls, path, match_patterns):
+		labels = []
+		groups = {}
+		for label, patterns in match_patterns.items():
+			for pattern in patterns:
+				match = re.fullmatch(pattern, path)
+				if match:
+					labels.append(label)
+					for name, value in match.groupdict().items():
+						groups.setdefault(name, value)
+					break
+		return tuple(labels), groups
+
+	def test_matches_fullmatch_loop(cls):
+		node_kinds = cls.NodeKinds()
+		classifier = LabelClassifier(node_kinds)
+
+		for path in cls.paths:
+			assert classifier.classify(path) == cls.assign_labels(path, node_kinds.match_patterns)
+
+		assert classifier.classify(cls.paths[0]) == (('Blob', 'Fastq'), {'plate': 'PLATE0', 'sample': 'SAMPLE0'})
+		assert classifier.classify(cls.paths[3]) == (('Index', 'Doubled'), {'part': 'dsub'})
+
+	def test_label_functions_cached(cls):
+		node_kinds = cls.NodeKinds()
+		node_kinds.get_label_functions = mock.Mock(wraps=node_kinds.get_label_functions)
+		classifier = LabelClassifier(node_kinds)
+
+		labels, groups = classifier.classify(cls.paths[0])
+		functions = classifier.get_label_functions(labels)
+		assert classifier.get_label_functions(labels) is functions
+		assert [function({}, groups) for function in functions] == [{'plate': 'PLATE0'}]
+		node_kinds.get_label_functions.assert_called_once_with(('Blob', 'Fastq'))
+
+	def test_create_node_configs(cls):
+		for data_group in sorted(os.listdir(CONFIG_DIR)):
+			node_kinds = load_create_node_config(data_group).NodeKinds()
+			classifier = LabelClassifier(node_kinds)
+
+			for path in cls.paths + [
+					'PLATE0/SAMPLE0/gatk-5-dollar/190522-131015-123-abc/output/SAMPLE0.g.vcf.gz',
+					'dsub/vcfstats/rtg-tools/objects/SAMPLE0_vcfstats.txt',
+					'dsub/fastqc-bam/text-to-table/objects/SAMPLE0.fastqc_data.txt.csv']:
+				assert classifier.classify(path) == cls.assign_labels(path, node_kinds.match_patterns)
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import re
+import time
+import mock
+import importlib.util
+
+from unittest import TestCase
+
+CONFIG_DIR = os.path.join('..', '..', 'config', 'phase3')
+
+def load_create_node_config(data_group):
+	# Config modules have hyphenated file names, so load them by path
+	spec = importlib.util.spec_from_file_location(
+		data_group.replace('-', '_'),
+		os.path.join(CONFIG_DIR, data_group, 'create-node-config.py'))
+	node_module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(node_module)
+	return node_module
+
+mock_context = mock.Mock()
+mock_context.event_id = '617187464135194'
+mock_context.timestamp = '2019-07-15T22:09:03.761Z'
+
+
+class TestChecksumManifest(TestCase):
+
+	node_module = load_create_node_config('from-personalis')
+
+	manifests = [
+		b"abc123\t./FASTQ/SAMPLE0_0_R1.fastq.gz\nabc124\t./FASTQ/SAMPLE0_0_R2.fastq.gz\ndef456\t\t./Microarray/SAMPLE0.idat\n",
+		b"abc123\t./FASTQ/SAMPLE0_0_R1.fastq.gz \n\n  \nabc124\t./FASTQ/SAMPLE0_0_R2.fastq.gz \r\n\n\t\n",
+		b"abc123\t./FASTQ/SAMPLE0_0_R1.fastq.gz\r\ndef456\t./Microarray/SAMPLE0.idat\r\n",
+		b"def456\t./Microarray/SAMPLE0.idat\nnot a checksum line\nabc123\t./BAM/SAMPLE0.bam",
+		b"",
+	]
+
+	def parse_in_memory(cls, data):
+		# Previous implementation of read_checksum()
+		split_data = data.decode("utf-8").rstrip().split('\n')
+		fastq_counter = 0
+		microarray_counter = 0
+		for line in split_data:
+			if re.fullmatch(r"(?P<checksum>\w+)\t+./FASTQ/(?P<basename>.*\.fastq\.gz)", line):
+				fastq_counter += 1
+			if re.fullmatch(r"(?P<checksum>\w+)\t+./Microarray/(?P<basename>.*)", line):
+				microarray_counter += 1
+		return {'fastqCount': fastq_counter, 'microarrayCount': microarray_counter}
+
+	def test_matches_in_memory_parser(cls):
+		for manifest in cls.manifests:
+			json_data, checksums = cls.node_module.parse_checksum_manifest(io.BytesIO(manifest))
+			assert json_data == cls.parse_in_memory(manifest)
+			assert checksums == None
+
+	def test_collect_checksums(cls):
+		json_data, checksums = cls.node_module.parse_checksum_manifest(
+			io.BytesIO(cls.manifests[0]),
+			collect_checksums = True)
+
+		assert json_data == {'fastqCount': 2, 'microarrayCount': 1}
+		assert checksums == {
+			'fastq': {'SAMPLE0_0_R1.fastq.gz': 'abc123', 'SAMPLE0_0_R2.fastq.gz': 'abc124'},
+			'microarray': {'SAMPLE0.idat': 'def456'}}
+
+	def test_read_checksum_streams_blob(cls):
+		blob_reader = cls.node_module.BlobReader(max_entry_bytes=16)
+		blob_reader._client = mock.Mock()
+		blob = blob_reader._client.bucket.return_value.blob.return_value
+		blob.open.return_value = io.BytesIO(cls.manifests[0])
+		db_dict = {'bucket': 'bucket', 'path': 'SAMPLE0/checksum.txt', 'generation': '2', 'size': len(cls.manifests[0])}
+
+		with mock.patch.object(cls.node_module, 'BLOB_READER', blob_reader):
+			json_data = cls.node_module.read_checksum(db_dict, {})
+
+		assert json_data == {'fastqCount': 2, 'microarrayCount': 1}
+		blob.open.assert_called_once_with('rb', chunk_size=cls.node_module.CHECKSUM_CHUNK_SIZE)
+		blob.download_as_bytes.assert_not_called()
+
+
+class TestBlobReader(TestCase):
+
+	node_module = load_create_node_config('from-personalis')
+
+	def create_reader(cls, **kwargs):
+		blob_reader = cls.node_module.BlobReader(**kwargs)
+		blob_reader._client = mock.Mock()
+		blob_reader._client.bucket.return_value.blob.return_value.download_as_bytes.side_effect = (
+			lambda: f"content-{len(blob_reader._client.bucket.mock_calls)}".encode())
+		return blob_reader
+
+	def test_generation_keyed_cache(cls):
+		blob_reader = cls.create_reader()
+
+		first = blob_reader.read('bucket', 'SAMPLE0.json', '1')
+		assert blob_reader.read('bucket', 'SAMPLE0.json', '1') == first
+		assert blob_reader.read('bucket', 'SAMPLE0.json', '2') != first
+		assert (blob_reader.hits, blob_reader.misses) == (1, 2)
+		blob_reader._client.get_bucket.assert_not_called()
+		blob_reader._client.bucket.return_value.blob.assert_called_with('SAMPLE0.json', generation=2)
+
+	def test_size_bounded_eviction(cls):
+		blob_reader = cls.create_reader(max_cache_bytes=20, max_entry_bytes=10)
+
+		for generation in ['1', '2', '3']:
+			blob_reader.read('bucket', 'SAMPLE0.json', generation)
+		assert list(blob_reader._cache.keys()) == [('bucket', 'SAMPLE0.json', '2'), ('bucket', 'SAMPLE0.json', '3')]
+		assert blob_reader._cache_bytes <= 20
+
+	def test_read_json_uses_shared_reader(cls):
+		blob_reader = cls.create_reader()
+		blob_reader._client.bucket.return_value.blob.return_value.download_as_bytes.side_effect = None
+		blob_reader._client.bucket.return_value.blob.return_value.download_as_bytes.return_value = b'{"sample": "SAMPLE0"}'
+		db_dict = {'bucket': 'bucket', 'path': 'SAMPLE0.json', 'generation': '1'}
+
+		with mock.patch.object(cls.node_module, 'BLOB_READER', blob_reader):
+			assert cls.node_module.read_json(db_dict, {}) == {'sample': 'SAMPLE0'}
+			assert cls.node_module.read_json(db_dict, {}) == {'sample': 'SAMPLE0'}
+		assert blob_reader._client.bucket.return_value.blob.return_value.download_as_bytes.call_count == 1
+
+
+class TestNodeEntry(TestCase):
+
+	node_module = load_create_node_config('from-personalis')
+
+	event = {
+		'bucket': 'gcp-bucket-mvp-test-from-personalis',
+		'generation': '1582075915288601',
+		'metadata': {'gcf-update-metadata': '2696298877621712'},
+		'name': 'va_mvp_phase2/PLATE0/SAMPLE0/SAMPLE0.json',
+		'size': '100',
+		'timeCreated': '2020-02-19T01:31:55.288Z',
+		'updated': '2022-02-28T21:13:19.739Z',
+	}
+	groupdict = {'plate': 'PLATE0', 'sample': 'SAMPLE0'}
+
+	def label_functions(cls):
+		@cls.node_module.io_bound
+		def slow_first(db_dict, groupdict):
+			time.sleep(0.05)
+			return {'source': 'slow_first', 'slow': db_dict['basename']}
+
+		@cls.node_module.io_bound
+		def fast_second(db_dict, groupdict):
+			return {'source': 'fast_second'}
+
+		def local_third(db_dict, groupdict):
+			return {'sourceSeen': db_dict['source']}
+
+		return [cls.node_module.trellis_metadata_groupdict, slow_first, fast_second, local_third]
+
+	def test_merges_in_declared_order(cls):
+		node_entry = cls.node_module.NodeEntry(
+			cls.event,
+			mock_context,
+			['Blob', 'PersonalisSequencing'],
+			cls.label_functions(),
+			cls.groupdict)
+		db_dict = node_entry.get_db_dict()
+
+		assert db_dict['plate'] == 'PLATE0'
+		assert db_dict['slow'] == 'SAMPLE0.json'
+		assert db_dict['source'] == 'fast_second'
+		assert db_dict['sourceSeen'] == 'fast_second'
+		assert node_entry.get_trellis_metadata()['source'] == 'fast_second'
+
+	def test_build_batch(cls):
+		label_functions = cls.label_functions()
+		events = [dict(cls.event, name=f"va_mvp_phase2/PLATE0/SAMPLE{index}/SAMPLE{index}.json") for index in range(8)]
+		entries = [(event, mock_context, ['Blob'], label_functions, cls.groupdict) for event in events]
+
+		start = time.perf_counter()
+		node_entries = cls.node_module.NodeEntry.build_batch(entries)
+		elapsed = time.perf_counter() - start
+
+		expected = [cls.node_module.NodeEntry(*entry).get_db_dict() for entry in entries]
+		assert [node_entry.get_db_dict() for node_entry in node_entries] == expected
+		# The 50 ms reads overlap across objects
+		assert elapsed < 8 * 0.05
+
+	def test_read_functions_are_io_bound(cls):
+		assert cls.node_module.read_json.io_bound
+		assert cls.node_module.read_checksum.io_bound
+
+	def test_node_record_matches_node_entry(cls):
+		label_functions = cls.label_functions()
+		for event in [cls.event, dict(cls.event, name='checksum.txt'), dict(cls.event, name='a/b.c/d')]:
+			node_entry = cls.node_module.NodeEntry(event, mock_context, ['Blob'], label_functions, cls.groupdict)
+			node_record = cls.node_module.NodeRecord(event, ['Blob'], label_functions, cls.groupdict)
+
+			assert node_record.get_db_dict() == node_entry.get_db_dict()
+			assert node_record.get_gcp_metadata() is event
+			assert dict(node_record.get_trellis_metadata()) == node_entry.get_trellis_metadata()
+
+	def test_node_record_views(cls):
+		node_record = cls.node_module.NodeRecord(cls.event, ['Blob'])
+		trellis_metadata = node_record.get_trellis_metadata()
+
+		assert not hasattr(node_record, '__dict__')
+		assert trellis_metadata['path'] == cls.event['name']
+		assert 'bucket' not in trellis_metadata
+		with cls.assertRaises(KeyError):
+			trellis_metadata['generation']
+		assert node_record.properties['bucket'] == cls.event['bucket']
+		assert len(trellis_metadata) == len(list(trellis_metadata))
+		other_record = cls.node_module.NodeRecord(dict(cls.event, name='SAMPLE1.json'), ['Blob'])
+		assert other_record._schema is node_record._schema
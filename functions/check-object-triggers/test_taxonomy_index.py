@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+import json
+
+from unittest import TestCase
+
+from taxonomy_index import TaxonomyIndex
+
+
+class TestTaxonomyIndex(TestCase):
+
+	taxonomy = {
+		"L0": [{"name": "root"}],
+		"L1": [
+			{"name": "Blob", "parent": "root"},
+			{"name": "Dstat", "parent": "root"}],
+		"L2": [
+			{"name": "Bam", "parent": "Blob"},
+			{"name": "Fastq", "parent": "Blob"}],
+		"L3": [
+			{"name": "Cram", "parent": "Bam"}],
+	}
+
+	def test_precomputed_tables(cls):
+		index = TaxonomyIndex(cls.taxonomy)
+
+		assert index.ancestors['Cram'] == {'Blob', 'Bam'}
+		assert index.ancestors['Blob'] == set()
+		assert index.depths['Cram'] == 3
+		assert index.leaves == {'Dstat', 'Fastq', 'Cram'}
+		assert 'Bam' in index
+		assert 'Firewall' not in index
+
+	def test_get_leaf_labels(cls):
+		index = TaxonomyIndex(cls.taxonomy)
+
+		assert index.get_leaf_labels(['Blob', 'Fastq']) == ['Fastq']
+		assert index.get_leaf_labels(['Blob', 'Bam', 'Cram']) == ['Cram']
+		assert index.get_leaf_labels(['Dstat', 'Blob', 'Fastq']) == ['Dstat', 'Fastq']
+
+	def test_duplicate_label(cls):
+		taxonomy = json.loads(json.dumps(cls.taxonomy))
+		taxonomy['L1'].append({"name": "Dstat", "parent": "root"})
+
+		with cls.assertRaisesRegex(ValueError, "'Dstat' is defined in duplicate"):
+			TaxonomyIndex(taxonomy)
+
+	def test_undefined_parent(cls):
+		taxonomy = json.loads(json.dumps(cls.taxonomy))
+		taxonomy['L2'].append({"name": "Gvcf", "parent": "Vcf"})
+
+		with cls.assertRaisesRegex(ValueError, "Parent 'Vcf'"):
+			TaxonomyIndex(taxonomy)
+
+	def test_label_taxonomy_file(cls):
+		index = TaxonomyIndex.from_json('label-taxonomy.json')
+
+		assert index.get_leaf_labels(['Blob', 'Json', 'PersonalisSequencing']) == ['PersonalisSequencing']
+		assert index.depths['PersonalisSequencing'] == 3
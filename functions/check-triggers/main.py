@@ -1,16 +1,12 @@
 import os
-import re
-import pdb
 import json
 import yaml
 import base64
 import logging
-import importlib
+import lazy_clients
+import response_chunks
 import trellisdata as trellis
 
-from google.cloud import storage
-from google.cloud import pubsub
-
 # Get runtime variables from cloud storage bucket
 # https://www.sethvargo.com/secrets-in-serverless/
 ENVIRONMENT = os.environ.get('ENVIRONMENT')
@@ -30,14 +26,10 @@ if ENVIRONMENT == 'google-cloud':
     FUNCTION_NAME = os.environ['K_SERVICE']
     PROJECT_ID = os.environ['PROJECT_ID']
 
-    config_doc = storage.Client() \
-                .get_bucket(os.environ['CREDENTIALS_BUCKET']) \
-                .get_blob(os.environ['CREDENTIALS_BLOB']) \
-                .download_as_string()
-    # https://stackoverflow.com/questions/6866600/how-to-parse-read-a-yaml-file-into-a-python-object
-    TRELLIS = yaml.safe_load(config_doc)
+    # Downloaded from GCS on first use
+    TRELLIS = lazy_clients.TRELLIS
 
-    PUBLISHER = pubsub.PublisherClient()
+    PUBLISHER = lazy_clients.PUBLISHER
 
     # DEPRECATED: Need to pull this from GCS
     #trigger_document = storage.Client() \
@@ -51,6 +43,13 @@ if ENVIRONMENT == 'google-cloud':
         trigger_document = file_handle.read()
     TRIGGER_CONTROLLER = trellis.TriggerController(trigger_document)
 
+    # Parts of aggregate query responses are collected until all arrive
+    PART_BUFFER = response_chunks.PartBuffer(
+                                             storage_client = lazy_clients.STORAGE_CLIENT,
+                                             bucket_name = os.environ['CREDENTIALS_BUCKET'])
+else:
+    PART_BUFFER = None
+
 def main(event, context, dry_run=False):
     """When object created in bucket, add metadata to database.
     Args:
@@ -58,10 +57,21 @@ def main(event, context, dry_run=False):
         context (google.cloud.functions.Context): Metadata for the event.
     """
 
-    query_response = trellis.QueryResponseReader(
-                        context = context,
-                        event = event)
+    # Also reads compressed aggregate responses; responses split into
+    # parts are evaluated once all parts have arrived
+    response_chunks.handle_query_response(
+                                          context = context,
+                                          event = event,
+                                          function = lambda query_response: check_triggers(query_response, dry_run),
+                                          part_buffer = PART_BUFFER)
+
 
+def check_triggers(query_response, dry_run=False):
+    """Publish query requests for the triggers activated by a response.
+    Args:
+        query_response (response_chunks.QueryResponsePart): Complete query response.
+        dry_run (bool): Log query requests instead of publishing them.
+    """
     logging.info(
                  f"> check-triggers: Received query response; " +
                  f"event ID : {query_response.event_id}, " +
@@ -0,0 +1,283 @@
+"""Client-side admission control and retries for Neo4j queries.
+
+AIMDLimiter limits how many queries a function instance or worker runs
+at once. The limit grows by one while queries succeed within the latency
+target and is multiplied by backoff_ratio when a query fails with a
+transient error or its result takes longer than the target, so instances back off together
+when the database is saturated instead of adding to the load.
+
+AdmissionController runs queries within the limit and retries transient
+errors (lost connections, deadlocks, leader changes) with jittered
+exponential backoff until a deadline, then raises the last error so the
+request is not silently dropped. Writes that create entities are only
+retried on errors the database reports before committing: after a lost
+connection the commit may have succeeded, and running them again would
+create the entities twice. The driver's own transaction retries are
+turned off (see connection_pool.py), so only this deadline applies.
+"""
+
+import re
+import time
+import random
+import logging
+import threading
+
+from urllib3.exceptions import ProtocolError
+from neo4j.exceptions import Neo4jError, ServiceUnavailable, SessionExpired, TransientError
+from neobolt.exceptions import ServiceUnavailable as BoltServiceUnavailable
+
+# Errors that can succeed when the query is run again
+RETRYABLE_ERRORS = (
+                    ServiceUnavailable,
+                    BoltServiceUnavailable,
+                    SessionExpired,
+                    TransientError,
+                    ProtocolError,
+                    ConnectionResetError)
+
+
+# CREATE clauses, but not MERGE ... ON CREATE SET
+CREATE_PATTERN = re.compile(r"(?<!\bON\s)\bCREATE\b", re.IGNORECASE)
+
+
+class AdmissionTimeout(Exception):
+    """No query slot became available before the deadline."""
+
+
+def is_retryable(error):
+    """
+    Args:
+        error (Exception): Error raised by a query.
+    Returns:
+        (bool): Whether running the query again can succeed.
+    """
+    if isinstance(error, Neo4jError) and hasattr(error, 'is_retryable'):
+        # Newer drivers classify server errors, e.g. deadlocks are
+        # retryable but terminated transactions are not
+        return error.is_retryable()
+    return isinstance(error, RETRYABLE_ERRORS)
+
+
+def is_retryable_before_commit(error):
+    """
+    Args:
+        error (Exception): Error raised by a query.
+    Returns:
+        (bool): Whether the database rolled back the transaction and
+            running it again can succeed. Connection errors are not,
+            because the commit may have succeeded before they happened.
+    """
+    if isinstance(error, Neo4jError) and hasattr(error, 'is_retryable'):
+        return error.is_retryable()
+    return isinstance(error, TransientError)
+
+
+def get_retry_check(query):
+    """Choose the errors to retry a query on.
+
+    Args:
+        query (trellis.DatabaseQuery): Query to run.
+    Returns:
+        (callable): is_retryable for reads and writes without CREATE
+            clauses, is_retryable_before_commit for other writes.
+    """
+    if query.write_transaction and CREATE_PATTERN.search(query.cypher):
+        return is_retryable_before_commit
+    return is_retryable
+
+
+class AIMDLimiter:
+
+    def __init__(
+                 self,
+                 initial_limit=10,
+                 min_limit=1,
+                 max_limit=100,
+                 latency_target_ms=300,
+                 backoff_ratio=0.9):
+        """Additive-increase, multiplicative-decrease concurrency limit.
+
+        Args:
+            initial_limit (int): Queries allowed at once to start with.
+            min_limit (int): Lowest limit.
+            max_limit (int): Highest limit.
+            latency_target_ms (float): Slower queries decrease the limit.
+            backoff_ratio (float): Multiplier applied on decrease.
+        """
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target_ms = latency_target_ms
+        self.backoff_ratio = backoff_ratio
+
+        self._limit = float(initial_limit)
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+        self.successes = 0
+        self.drops = 0
+        self.rejections = 0
+        self.last_latency_ms = None
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def acquire(self, timeout=None):
+        """Wait for a query slot.
+
+        Args:
+            timeout (float): Seconds to wait; None waits indefinitely.
+        Returns:
+            (bool): False if no slot became available in time.
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._in_flight < self.limit, timeout=timeout):
+                self.rejections += 1
+                return False
+            self._in_flight += 1
+            return True
+
+    def release(self, latency_ms=None, dropped=False):
+        """Free a query slot and update the limit.
+
+        Args:
+            latency_ms (float): Time until the query result was available.
+            dropped (bool): Whether the query failed.
+        """
+        with self._condition:
+            # Only raise the limit when it is actually being used
+            limited = self._in_flight >= self.limit / 2
+            self._in_flight -= 1
+            self.last_latency_ms = latency_ms
+
+            if dropped or (latency_ms is not None and latency_ms > self.latency_target_ms):
+                self.drops += dropped
+                self._limit = max(self.min_limit, self._limit * self.backoff_ratio)
+            else:
+                self.successes += 1
+                if limited:
+                    self._limit = min(self.max_limit, self._limit + 1)
+            self._condition.notify_all()
+
+    def stats(self):
+        """
+        Returns:
+            (dict): Limiter state for logging and metrics.
+        """
+        with self._condition:
+            return {
+                    'limit': self.limit,
+                    'inFlight': self._in_flight,
+                    'successes': self.successes,
+                    'drops': self.drops,
+                    'rejections': self.rejections,
+                    'lastLatencyMs': self.last_latency_ms,
+            }
+
+
+class AdmissionController:
+
+    def __init__(
+                 self,
+                 limiter=None,
+                 deadline=60,
+                 base_delay=0.1,
+                 max_delay=5,
+                 sleep=time.sleep,
+                 clock=time.monotonic):
+        """Run queries within a concurrency limit, retrying transient errors.
+
+        Args:
+            limiter (AIMDLimiter): Shared concurrency limit.
+            deadline (float): Seconds from the first attempt after which
+                no further attempt is started.
+            base_delay (float): Backoff before the first retry, in seconds.
+            max_delay (float): Largest backoff, in seconds.
+        """
+        self.limiter = limiter or AIMDLimiter()
+        self.deadline = deadline
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self.retries = 0
+        self.failures = 0
+
+    def get_backoff(self, attempt):
+        """Full-jitter exponential backoff for a retry attempt (0-based)."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def run(self, function, *args, latency=None, retryable=is_retryable, **kwargs):
+        """Call function(*args, **kwargs) once a query slot is available.
+
+        Args:
+            function (callable): Runs the query, e.g. main.query_database.
+            latency (callable): Gets the result availability time in ms
+                from the return value. Defaults to the call duration.
+            retryable (callable): Whether to retry after an error, e.g.
+                from get_retry_check().
+        Returns:
+            The value returned by function.
+        Raises:
+            AdmissionTimeout: No query slot was available before the deadline.
+            Exception: The last error, if it is not retryable or the
+                deadline passed.
+        """
+        start = self.clock()
+        attempt = 0
+        while True:
+            remaining = self.deadline - (self.clock() - start)
+            if not self.limiter.acquire(timeout=max(remaining, 0)):
+                with self._lock:
+                    self.failures += 1
+                raise AdmissionTimeout(
+                                       f"> db-query: No query slot available within {self.deadline} seconds " +
+                                       f"(limit {self.limiter.limit}).")
+
+            call_start = self.clock()
+            try:
+                result = function(*args, **kwargs)
+            except Exception as error:
+                if is_retryable(error):
+                    self.limiter.release(dropped=True)
+                else:
+                    # Invalid parameters, syntax or constraint errors say
+                    # nothing about the load on the database
+                    self.limiter.release(latency_ms=(self.clock() - call_start) * 1000)
+                delay = self.get_backoff(attempt)
+                if not retryable(error) or self.clock() - start + delay > self.deadline:
+                    with self._lock:
+                        self.failures += 1
+                    raise
+                logging.warning(
+                                f"> db-query: Retrying query after {type(error).__name__} " +
+                                f"in {delay:.2f} seconds (attempt {attempt + 1}): {error}.")
+                with self._lock:
+                    self.retries += 1
+                self.sleep(delay)
+                attempt += 1
+                continue
+
+            if latency is not None:
+                latency_ms = latency(result)
+            else:
+                latency_ms = (self.clock() - call_start) * 1000
+            self.limiter.release(latency_ms=latency_ms)
+            return result
+
+    def stats(self):
+        """
+        Returns:
+            (dict): Limiter state and retry counts for logging and metrics.
+        """
+        stats = self.limiter.stats()
+        with self._lock:
+            stats['retries'] = self.retries
+            stats['failures'] = self.failures
+        return stats
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""Merge registered custom query segments into the query catalogues.
+
+db-query stores each new custom query in its own segment object (see
+query_catalogue.py). Compacting merges those segments into the catalogue
+object and deletes them, so function instances load one object plus the
+segments written since the last compaction. Safe to run while db-query is
+running: the catalogue is only replaced if it hasn't changed, and segments
+written during compaction are kept. Run from this directory, like the tests,
+after copying functions/shared/lazy_clients.py here.
+
+Examples:
+    python compact_query_catalogue.py --bucket my-credentials-bucket \
+        --catalogue create-blob-queries.yaml --catalogue create-job-queries.yaml
+"""
+
+import sys
+import logging
+import argparse
+
+import query_catalogue
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--bucket', required=True, help='Bucket with the query catalogues.')
+    parser.add_argument(
+                        '--catalogue',
+                        action='append',
+                        required=True,
+                        help='Catalogue object path, e.g. create-blob-queries.yaml. Can be repeated.')
+    return parser.parse_args(argv)
+
+
+def main_cli(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    failed = []
+    for blob_name in args.catalogue:
+        catalogue = query_catalogue.QueryCatalogue(args.bucket, blob_name)
+        merged = catalogue.compact()
+        if merged is None:
+            failed.append(blob_name)
+            continue
+        logging.info(f"> compact: {blob_name}: merged {merged} segments, {len(catalogue)} queries.")
+
+    if failed:
+        logging.error(f"> compact: Catalogues changed during compaction, run again: {failed}.")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
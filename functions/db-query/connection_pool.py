@@ -0,0 +1,214 @@
+"""Neo4j driver connection pool configuration, warm-up and timing.
+
+Pool settings are read from the Trellis configuration so they can be
+tuned without a redeploy. Unset settings keep the driver defaults. Every
+transaction is timed in two parts: the wait for a pooled connection and
+the query itself, so pool starvation can be told apart from slow Cypher.
+"""
+
+import time
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+# Trellis configuration keys and the driver settings they set
+DRIVER_CONFIG_KEYS = {
+                      'NEO4J_MAX_CONNECTION_POOL_SIZE': 'max_connection_pool_size',
+                      'NEO4J_MAX_CONNECTION_LIFETIME': 'max_connection_lifetime',
+                      'NEO4J_CONNECTION_ACQUISITION_TIMEOUT': 'connection_acquisition_timeout',
+                      'NEO4J_LIVENESS_CHECK_TIMEOUT': 'liveness_check_timeout',
+                      'NEO4J_MAX_TRANSACTION_RETRY_TIME': 'max_transaction_retry_time',
+}
+
+# Used when the Trellis configuration does not set a value. Transactions
+# are retried by admission.AdmissionController, which knows which writes
+# are safe to run again, so the driver runs each transaction once.
+DEFAULT_DRIVER_CONFIG = {
+                         'max_connection_pool_size': 10,
+                         'max_transaction_retry_time': 0,
+}
+
+# Connections opened when the driver is created
+WARM_CONNECTIONS_KEY = 'NEO4J_WARM_CONNECTIONS'
+WARM_UP_TIMEOUT = 10
+
+# Waiting longer than this for a connection is logged as pool starvation
+ACQUIRE_WARNING_MS = 100
+
+
+def get_driver_config(trellis_config):
+    """
+    Args:
+        trellis_config (dict): Trellis configuration.
+    Returns:
+        (dict): Keyword arguments for GraphDatabase.driver().
+    """
+    driver_config = dict(DEFAULT_DRIVER_CONFIG)
+    for config_key, driver_key in DRIVER_CONFIG_KEYS.items():
+        value = trellis_config.get(config_key)
+        if value is not None and value != '':
+            driver_config[driver_key] = value
+    return driver_config
+
+
+def create_driver(trellis_config):
+    """Create the Neo4j driver and warm its connection pool.
+
+    Args:
+        trellis_config (dict): Trellis configuration with the database
+            address, credentials and pool settings.
+    Returns:
+        (neo4j.Driver): Driver with NEO4J_WARM_CONNECTIONS open connections.
+    """
+    from neo4j import GraphDatabase
+
+    driver_config = get_driver_config(trellis_config)
+    driver = GraphDatabase.driver(
+        f"{trellis_config['NEO4J_SCHEME']}://{trellis_config['NEO4J_IP_ADDRESS']}:{trellis_config['NEO4J_PORT']}",
+        auth=("neo4j", trellis_config["NEO4J_PASSPHRASE"]),
+        **driver_config)
+    # More sessions than pooled connections would wait for each other
+    connections = min(
+                      int(trellis_config.get(WARM_CONNECTIONS_KEY) or 0),
+                      int(driver_config['max_connection_pool_size']))
+    if connections:
+        warm_up(driver, connections)
+    return driver
+
+
+def warm_up(driver, connections, timeout=WARM_UP_TIMEOUT):
+    """Open pooled connections before the first requests need them.
+
+    Sessions hold their connections until all of them are open, so each
+    one gets a new connection instead of reusing the first.
+
+    Args:
+        driver (neo4j.Driver): Driver to warm.
+        connections (int): Connections to open.
+        timeout (float): Seconds to wait for the connections.
+    Returns:
+        (int): Connections opened.
+    """
+    barrier = threading.Barrier(connections)
+
+    def open_connection():
+        try:
+            with driver.session() as session:
+                session.run("RETURN 1").consume()
+                try:
+                    barrier.wait(timeout=timeout)
+                except threading.BrokenBarrierError:
+                    pass
+        except Exception:
+            # Release the sessions waiting for this one right away
+            barrier.abort()
+            raise
+        return True
+
+    start = time.perf_counter()
+    opened = 0
+    with ThreadPoolExecutor(max_workers=connections) as executor:
+        futures = [executor.submit(open_connection) for _ in range(connections)]
+        for future in futures:
+            try:
+                opened += future.result()
+            except Exception as error:
+                # The pool fills on demand instead
+                logging.warning(f"> db-query: Could not open database connection during warm-up: {error}.")
+    logging.info(
+                 f"> db-query: Opened {opened} database connections " +
+                 f"in {(time.perf_counter() - start) * 1000:.0f} ms.")
+    return opened
+
+
+class TransactionTimer:
+
+    def __init__(self, transaction_function):
+        """Time a transaction function run with session.[read,write]_transaction().
+
+        The time until the function is first called is spent acquiring
+        a connection from the pool; the time from its first call until it
+        returns is spent running the query, including driver retries.
+
+        Args:
+            transaction_function (callable): Transaction function to time.
+        """
+        self.transaction_function = transaction_function
+        self.requested = time.perf_counter()
+        self.started = None
+        self.finished = None
+
+    def __call__(self, tx, *args, **kwargs):
+        if self.started is None:
+            self.started = time.perf_counter()
+        try:
+            return self.transaction_function(tx, *args, **kwargs)
+        finally:
+            self.finished = time.perf_counter()
+
+    @property
+    def acquire_ms(self):
+        if self.started is None:
+            return None
+        return (self.started - self.requested) * 1000
+
+    @property
+    def query_ms(self):
+        if self.finished is None:
+            return None
+        return (self.finished - self.started) * 1000
+
+
+class PoolMetrics:
+
+    def __init__(self, acquire_warning_ms=ACQUIRE_WARNING_MS):
+        """Session acquisition and query times of this instance."""
+        self.acquire_warning_ms = acquire_warning_ms
+        self._lock = threading.Lock()
+        self.transactions = 0
+        self.acquire_ms_total = 0.0
+        self.acquire_ms_max = 0.0
+        self.query_ms_total = 0.0
+        self.query_ms_max = 0.0
+        self.slow_acquires = 0
+
+    def record(self, timer, query_name=None):
+        """Add the times of a finished transaction.
+
+        Args:
+            timer (TransactionTimer): Timer of the transaction.
+            query_name (str): Logged with slow acquisitions.
+        """
+        acquire_ms, query_ms = timer.acquire_ms, timer.query_ms
+        if acquire_ms is None or query_ms is None:
+            return
+        with self._lock:
+            self.transactions += 1
+            self.acquire_ms_total += acquire_ms
+            self.acquire_ms_max = max(self.acquire_ms_max, acquire_ms)
+            self.query_ms_total += query_ms
+            self.query_ms_max = max(self.query_ms_max, query_ms)
+            slow = acquire_ms > self.acquire_warning_ms
+            self.slow_acquires += slow
+        logging.debug(f"> db-query: Session acquire wait: {acquire_ms:.1f} ms, query: {query_ms:.1f} ms.")
+        if slow:
+            logging.warning(
+                            f"> db-query: Waited {acquire_ms:.0f} ms for a database connection " +
+                            f"(query {query_name}); the connection pool may be too small.")
+
+    def stats(self):
+        """
+        Returns:
+            (dict): Pool timing for logging and metrics.
+        """
+        with self._lock:
+            transactions = self.transactions or 1
+            return {
+                    'transactions': self.transactions,
+                    'acquireMsMean': round(self.acquire_ms_total / transactions, 1),
+                    'acquireMsMax': round(self.acquire_ms_max, 1),
+                    'queryMsMean': round(self.query_ms_total / transactions, 1),
+                    'queryMsMax': round(self.query_ms_max, 1),
+                    'slowAcquires': self.slow_acquires,
+            }
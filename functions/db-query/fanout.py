@@ -0,0 +1,108 @@
+"""Publish query response messages to several topics at once.
+
+Each message is serialized once and handed to the publisher for every
+topic without waiting for the previous publish, so the Pub/Sub client
+can batch messages per topic and send the batches concurrently. All
+publish futures are then waited for together, with one deadline for
+the whole set.
+"""
+
+import json
+import time
+import logging
+
+from concurrent import futures
+
+# Seconds to wait for all messages of a response to be published
+PUBLISH_DEADLINE = 60
+
+# Messages are sent when a batch is full or after max_latency seconds
+PUBLISH_BATCH_SETTINGS = {
+                          'max_messages': 100,
+                          'max_bytes': 1024 * 1024,
+                          'max_latency': 0.01,
+}
+
+
+class PublishError(Exception):
+
+    def __init__(self, published_message_counts, failures):
+        """Some messages of a response were not published.
+
+        Args:
+            published_message_counts (dict): Published messages by topic.
+            failures (dict): Failed or timed out messages by topic.
+        """
+        super().__init__(
+                         f"> db-query: Could not publish all messages. " +
+                         f"Published: {published_message_counts}, failed: {failures}.")
+        self.published_message_counts = published_message_counts
+        self.failures = failures
+
+
+def create_publisher():
+    """
+    Returns:
+        (pubsub.PublisherClient): Client that batches messages per topic.
+    """
+    from google.cloud import pubsub
+    return pubsub.PublisherClient(batch_settings=pubsub.types.BatchSettings(**PUBLISH_BATCH_SETTINGS))
+
+
+def encode_message(message):
+    """Serialize a message the way trellis.utils.publish_to_pubsub_topic does,
+    without indentation.
+
+    Args:
+        message (dict): Dictionary with header and body fields.
+    Returns:
+        (bytes): JSON message data.
+    """
+    return json.dumps(message, sort_keys=True, default=str).encode('utf-8')
+
+
+def publish_fanout(publisher, project_id, topics, messages, deadline=PUBLISH_DEADLINE):
+    """Publish every message to every topic.
+
+    Args:
+        publisher (pubsub.PublisherClient): Pub/Sub client.
+        project_id (str): Google Cloud project ID.
+        topics (list): Topic names.
+        messages (iterable): Message dictionaries, or message data (bytes)
+            that is already encoded.
+        deadline (float): Seconds to wait for all publish results.
+    Returns:
+        (dict): Number of messages published to each topic.
+        (dict): Number of messages that failed or timed out, by topic.
+    """
+    topic_paths = {topic: publisher.topic_path(project_id, topic) for topic in topics}
+    published_message_counts = dict.fromkeys(topic_paths, 0)
+    failures = dict.fromkeys(topic_paths, 0)
+
+    start = time.perf_counter()
+    pending = {}
+    for message in messages:
+        data = message if isinstance(message, bytes) else encode_message(message)
+        logging.debug(f"> db-query: Publishing message: {message}.")
+        for topic, topic_path in topic_paths.items():
+            pending[publisher.publish(topic_path, data=data)] = topic
+
+    done, not_done = futures.wait(pending, timeout=deadline)
+    for future in done:
+        topic = pending[future]
+        error = future.exception()
+        if error:
+            logging.error(f"> db-query: Could not publish message to {topic}: {error}.")
+            failures[topic] += 1
+        else:
+            logging.debug(f"> db-query: Published message to {topic} with result: {future.result()}.")
+            published_message_counts[topic] += 1
+    for future in not_done:
+        failures[pending[future]] += 1
+    if not_done:
+        logging.error(f"> db-query: {len(not_done)} messages were not published within {deadline} seconds.")
+
+    logging.info(
+                 f"> db-query: Published {sum(published_message_counts.values())} messages " +
+                 f"in {(time.perf_counter() - start) * 1000:.0f} ms.")
+    return published_message_counts, failures
@@ -1,27 +1,40 @@
 import os
 import re
-import pdb
 import sys
 import json
 import math
 import time
 import yaml
 import base64
+import logging
 import neobolt
+import threading
 
 from datetime import datetime
 
 #import neo4j
 from neo4j import GraphDatabase
+from neo4j.graph import Node, Relationship, Path
+from neo4j.exceptions import ClientError
 
 from urllib3.exceptions import ProtocolError
 from neobolt.exceptions import ServiceUnavailable
 
-from google.cloud import pubsub
-from google.cloud import storage
-
+import fanout
+import admission
+import streaming
+import lazy_clients
+import plan_warmup
+import response_chunks
+import query_profiler
+import query_coalescing
+import connection_pool
+import query_catalogue
 import trellisdata as trellis
 
+# Catalogue queries that failed the plan warm-up, by name
+PLAN_ERRORS = {}
+
 # Get runtime variables from cloud storage bucket
 # https://www.sethvargo.com/secrets-in-serverless/
 ENVIRONMENT = os.environ.get('ENVIRONMENT')
@@ -43,17 +56,12 @@ if ENVIRONMENT == 'google-cloud':
     PROJECT_ID = os.environ['PROJECT_ID']
 
     # Not loading this locally yet because it contains sensitive information such as the database credentials.
-    configuration_document = storage.Client() \
-                .get_bucket(os.environ['CREDENTIALS_BUCKET']) \
-                .get_blob(os.environ['CREDENTIALS_BLOB']) \
-                .download_as_string()
-    # https://stackoverflow.com/questions/6866600/how-to-parse-read-a-yaml-file-into-a-python-object
-    #with open("trellis-configuration.yaml", "r") as file_handle:
-    #    configuration_document = file_handle.read()
-    TRELLIS = yaml.safe_load(configuration_document)
-
-    # Pubsub client
-    PUBLISHER = pubsub.PublisherClient()
+    # Downloaded from GCS on first use.
+    TRELLIS = lazy_clients.TRELLIS
+
+    # Pubsub client, created on first use. Batches the messages of
+    # a response instead of sending them one request at a time.
+    PUBLISHER = lazy_clients.Lazy(fanout.create_publisher)
 
     # Load queries predefined by Trellis developers.
     #queries_document = storage.Client() \
@@ -69,29 +77,45 @@ if ENVIRONMENT == 'google-cloud':
     for query in queries:
         if query.name in QUERY_DICT.keys():
             raise ValueError(f"> db-query: Query {query.name} is defined in duplicate.")
+        streaming.check_stream_results(query)
         QUERY_DICT[query.name] = query
     
-    # Load list of existing queries that have been dynamically
+    # Index of existing queries that have been dynamically
     # generated by the create-blob-node function.
-    CREATE_BLOB_QUERY_DOC = storage.Client() \
-                                .get_bucket(os.environ['CREDENTIALS_BUCKET']) \
-                                .get_blob(TRELLIS["CREATE_BLOB_QUERIES"]) \
-                                .download_as_string()
+    # Reloaded when the catalogue object changes.
+    CREATE_BLOB_QUERY_CATALOGUE = lazy_clients.Lazy(
+        lambda: query_catalogue.QueryCatalogue(os.environ['CREDENTIALS_BUCKET'], TRELLIS["CREATE_BLOB_QUERIES"]))
 
-    # Load list of existing queries that have been dynamically
-    # generated by the create-blob-node function.
-    CREATE_JOB_QUERY_DOC = storage.Client() \
-                            .get_bucket(os.environ['CREDENTIALS_BUCKET']) \
-                            .get_blob(TRELLIS["CREATE_JOB_QUERIES"]) \
-                            .download_as_string()
+    # Index of existing queries that have been dynamically
+    # generated by the create-job-node function.
+    CREATE_JOB_QUERY_CATALOGUE = lazy_clients.Lazy(
+        lambda: query_catalogue.QueryCatalogue(os.environ['CREDENTIALS_BUCKET'], TRELLIS["CREATE_JOB_QUERIES"]))
 
     # Use Neo4j driver object to establish connections to the Neo4j
     # database and manage connection pool used by neo4j.Session objects
     # https://neo4j.com/docs/api/python-driver/current/api.html#driver
-    DRIVER = GraphDatabase.driver(
-        f"{TRELLIS['NEO4J_SCHEME']}://{TRELLIS['NEO4J_IP_ADDRESS']}:{TRELLIS['NEO4J_PORT']}",
-        auth=("neo4j", TRELLIS["NEO4J_PASSPHRASE"]),
-        max_connection_pool_size=10)
+    # Pool settings come from the configuration. Created on first use,
+    # or in the background at instance start with WARM_UP_ON_START.
+    DRIVER = lazy_clients.Lazy(lambda: connection_pool.create_driver(TRELLIS))
+
+    # Optionally plan every catalogue query with EXPLAIN after the driver
+    # is created, so first requests don't pay the planning cost and
+    # queries that no longer compile are reported at startup. This
+    # downloads the configuration and connects to the database while the
+    # first request may already be running, so it only happens when
+    # WARM_UP_ON_START is set; otherwise the driver is created on first use.
+    def _start_instance():
+        driver = DRIVER.get()
+        time_budget = TRELLIS.get(plan_warmup.WARM_UP_BUDGET_KEY)
+        if not time_budget:
+            return
+        try:
+            plan_warmup.warm_up_plans(driver, QUERY_DICT.values(), float(time_budget))
+        except plan_warmup.QueryCompileError as error:
+            logging.error(str(error))
+            PLAN_ERRORS[error.query_name] = error
+    if os.environ.get('WARM_UP_ON_START'):
+        threading.Thread(target=_start_instance, daemon=True).start()
 else:
     FUNCTION_NAME = 'db-query-local'
     local_queries = "sample-queries.yaml"
@@ -101,10 +125,66 @@ else:
         queries = yaml.load_all(file_handle, Loader=yaml.FullLoader)
         QUERY_DICT = {}
         for query in queries:
+            streaming.check_stream_results(query)
             QUERY_DICT[query.name] = query
 
 QUERY_ELAPSED_MAX = 300
 PUBSUB_ELAPSED_MAX = 10
+# Session acquisition and query times of this instance
+POOL_METRICS = connection_pool.PoolMetrics()
+
+# Latency histograms and counters by query name. Queries slower than
+# QUERY_ELAPSED_MAX and a sample of the others are profiled, each query
+# at most once per QUERY_PROFILE_INTERVAL seconds.
+PROFILER = query_profiler.QueryProfiler(
+                                        threshold_ms = QUERY_ELAPSED_MAX,
+                                        sample_rate = float(os.environ.get('QUERY_PROFILE_SAMPLE_RATE', 0.001)),
+                                        profile_interval = float(os.environ.get(
+                                                                                'QUERY_PROFILE_INTERVAL',
+                                                                                query_profiler.PROFILE_INTERVAL)))
+
+# Compression of aggregate query responses: gzip, zstd or none
+AGGREGATE_COMPRESSION = os.environ.get('AGGREGATE_COMPRESSION') or None
+# Subscribers of these topics join aggregate responses split into parts;
+# responses to any other topic are published in one message
+REASSEMBLING_TOPICS = ('TOPIC_TRIGGERS',)
+
+# Identical requests of redundant queries within REDUNDANT_QUERY_WINDOW
+# seconds run once; None when not configured
+COALESCER = query_coalescing.get_coalescer()
+
+# Seconds to retry a query for before failing the request
+QUERY_RETRY_DEADLINE = 30
+
+# Limits concurrent queries of this instance based on query latency
+# and retries transient database errors
+ADMISSION = admission.AdmissionController(
+                                          admission.AIMDLimiter(latency_target_ms=QUERY_ELAPSED_MAX),
+                                          deadline = QUERY_RETRY_DEADLINE)
+
+# Catalogue queries run in one transaction per batch with UNWIND
+BATCH_ROW = 'batchRow'
+BATCH_INDEX = 'batchIndex'
+# Parameters, and quoted strings and identifiers that are left unchanged
+QUERY_PARAMETER_PATTERN = re.compile(r"""'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|`[^`]*`|\$(\w+)""", re.DOTALL)
+
+def validate_query_parameters(query, parameters):
+    """Check whether query parameters match the required keys and types.
+
+    Args:
+        query (trellis.DatabaseQuery): Query with required parameters.
+        parameters (dict): Parameter values that will be used in the query.
+    Raises:
+        ValueError: If a parameter is missing or has the wrong type.
+    """
+    key_difference = set(query.required_parameters.keys()).difference(set(parameters.keys()))
+    if key_difference:
+        #logging.error(f"Query parameters do not match requirements. Difference: {key_difference}.")
+        raise ValueError(f"Query parameters do not match requirements. Difference: {key_difference}.")
+
+    for key, type_name in query.required_parameters.items():
+        if not type(parameters[key]).__name__ == type_name:
+            raise ValueError(f"Query parameter {parameters[key]} does not match type {type_name}.")
 
 def query_database(driver, query, parameters):
     """Run a Cypher query against the Neo4j database.
@@ -119,23 +199,58 @@ def query_database(driver, query, parameters):
         neo4j.ResultSummary: https://neo4j.com/docs/api/python-driver/current/api.html#resultsummary
     """
 
-    # Check whether query parameters match the required keys and types
-    key_difference = set(query.required_parameters.keys()).difference(set(parameters.keys()))
-    if key_difference:
-        #logging.error(f"Query parameters do not match requirements. Difference: {key_difference}.")
-        raise ValueError(f"Query parameters do not match requirements. Difference: {key_difference}.")
-
-    for key, type_name in query.required_parameters.items():
-        if not type(parameters[key]).__name__ == type_name:
-            raise ValueError(f"Query parameter {parameters[key]} does not match type {type_name}.")
+    validate_query_parameters(query, parameters)
 
+    # Times the wait for a pooled connection separately from the query
+    transaction_timer = connection_pool.TransactionTimer(_stored_procedure_transaction_function)
     with driver.session() as session:
         if query.write_transaction:
-            graph, result_summary = session.write_transaction(_stored_procedure_transaction_function, query.cypher, **parameters)
+            graph, result_summary = session.write_transaction(transaction_timer, query.cypher, **parameters)
         else:
-            graph, result_summary = session.read_transaction(_stored_procedure_transaction_function, query.cypher, **parameters)
+            graph, result_summary = session.read_transaction(transaction_timer, query.cypher, **parameters)
+    POOL_METRICS.record(transaction_timer, query.name)
     return graph, result_summary
 
+def _streaming_transaction_function(tx, query, parameters, entity_stream, on_entity):
+    """Hand each new entity to on_entity while reading the records."""
+    result = tx.run(query, parameters)
+    for record in result:
+        for entity in entity_stream.new_entities(record):
+            on_entity(entity)
+    return result.consume()
+
+def query_database_streaming(driver, query, parameters, on_entity, entity_stream=None):
+    """Run a Cypher query without collecting its results.
+
+    Entities are only handed to on_entity once, also if the driver
+    retries the transaction. Pass the same entity_stream to calls that
+    retry the query, so entities handed over before are skipped.
+
+    Args:
+        driver (neo4j.Driver): Official Neo4j Python driver.
+        query (trellis.DatabaseQuery): Query to run.
+        parameters (dict): Parameter values that will be used in the query.
+        on_entity (callable): Called with every returned node, or every
+            relationship if the query returns relationships.
+        entity_stream (streaming.EntityStream): Entities seen so far.
+            Default: a new stream.
+    Returns:
+        neo4j.ResultSummary: Summary of the query.
+    """
+    validate_query_parameters(query, parameters)
+
+    if entity_stream is None:
+        entity_stream = streaming.EntityStream(relationships=streaming.returns_relationships(query))
+    transaction_timer = connection_pool.TransactionTimer(_streaming_transaction_function)
+    with driver.session() as session:
+        if query.write_transaction:
+            transaction = session.write_transaction
+        else:
+            transaction = session.read_transaction
+        result_summary = transaction(transaction_timer, query.cypher, parameters, entity_stream, on_entity)
+    POOL_METRICS.record(transaction_timer, query.name)
+    return result_summary
+
 def _stored_procedure_transaction_function(tx, query, **query_parameters):
     """ Standard function for running parameterized cypher queries.
 
@@ -152,25 +267,383 @@ def _stored_procedure_transaction_function(tx, query, **query_parameters):
     result = tx.run(query, query_parameters)
     return result.graph(), result.consume()
 
+class BatchGraph:
+    """Nodes and relationships returned for one row of a batch query.
+
+    Provides the nodes and relationships attributes of neo4j.graph.Graph
+    that trellis.QueryResponseWriter uses.
+    """
+
+    def __init__(self):
+        self._nodes = {}
+        self._relationships = {}
+
+    @property
+    def nodes(self):
+        return list(self._nodes)
+
+    @property
+    def relationships(self):
+        return list(self._relationships)
+
+    def add(self, value):
+        """Add the graph entities in a returned value."""
+        if isinstance(value, Node):
+            self._nodes[value] = None
+        elif isinstance(value, Relationship):
+            # Graph.nodes also includes the nodes of relationships
+            self._nodes[value.start_node] = None
+            self._nodes[value.end_node] = None
+            self._relationships[value] = None
+        elif isinstance(value, Path):
+            for node in value.nodes:
+                self._nodes[node] = None
+            for relationship in value.relationships:
+                self._relationships[relationship] = None
+        elif isinstance(value, (list, tuple)):
+            for item in value:
+                self.add(item)
+
+def get_batch_cypher(query):
+    """Get a Cypher query that runs a catalogue query once per row of $rows.
+
+    Queries can define their own batch_cypher in database-queries.yaml. It
+    receives a $rows list of parameter maps, each with a batchIndex key,
+    and has to return the batchIndex of the row each record belongs to.
+    Otherwise the query is wrapped in a CALL subquery and its $parameters,
+    outside of quoted strings and identifiers, are replaced by properties
+    of the row:
+        UNWIND $rows AS batchRow
+        CALL { WITH batchRow <cypher> }
+        RETURN *, batchRow.batchIndex AS batchIndex
+
+    Args:
+        query (trellis.DatabaseQuery): Catalogue query.
+    Returns:
+        (str): Batch Cypher query.
+    """
+    batch_cypher = getattr(query, 'batch_cypher', None)
+    if batch_cypher:
+        return batch_cypher
+    cypher = QUERY_PARAMETER_PATTERN.sub(
+                                         lambda match: f"{BATCH_ROW}.{match.group(1)}" if match.group(1) else match.group(0),
+                                         query.cypher)
+    return (
+            f"UNWIND $rows AS {BATCH_ROW} " +
+            f"CALL {{ WITH {BATCH_ROW} {cypher} }} " +
+            f"RETURN *, {BATCH_ROW}.{BATCH_INDEX} AS {BATCH_INDEX}")
+
+def _batch_transaction_function(tx, query, rows):
+    """Run a batch query and collect its records.
+
+    Returns:
+        list: Records returned by the query.
+        neo4j.ResultSummary: Summary statistics for the whole batch.
+    """
+    result = tx.run(query, rows=rows)
+    return list(result), result.consume()
+
+def query_database_batch(driver, query, parameter_sets):
+    """Run a catalogue query with many parameter sets in one transaction.
+
+    Parameter sets are validated like in query_database() and the valid
+    ones are run together with the query from get_batch_cypher(). Returned
+    entities are split back into one graph per parameter set. If the batch
+    query is rejected by the database (e.g. the generated Cypher is not
+    valid for this query or a row violates a constraint), each parameter
+    set is run on its own with query_database(). Those commit one at a
+    time, so an error in one of them is its result instead of failing
+    parameter sets that have already committed.
+
+    Args:
+        driver (neo4j.Driver): Official Neo4j Python driver
+        query (trellis.DatabaseQuery): Catalogue query.
+        parameter_sets (list): Parameter dicts, one per query request.
+    Returns:
+        (list): One result per parameter set, in order: a (graph,
+            result_summary) tuple or the exception raised for it. The
+            result summary is shared by all parameter sets of a batch.
+    """
+    results = [None] * len(parameter_sets)
+    rows = []
+    for index, parameters in enumerate(parameter_sets):
+        try:
+            validate_query_parameters(query, parameters)
+        except ValueError as error:
+            results[index] = error
+            continue
+        row = dict(parameters)
+        row[BATCH_INDEX] = index
+        rows.append(row)
+    if not rows:
+        return results
+
+    try:
+        transaction_timer = connection_pool.TransactionTimer(_batch_transaction_function)
+        with driver.session() as session:
+            if query.write_transaction:
+                records, result_summary = session.write_transaction(transaction_timer, get_batch_cypher(query), rows)
+            else:
+                records, result_summary = session.read_transaction(transaction_timer, get_batch_cypher(query), rows)
+        POOL_METRICS.record(transaction_timer, query.name)
+    except ClientError as error:
+        logging.warning(
+                        f"> db-query: Batch of {len(rows)} '{query.name}' queries failed ({error}); " +
+                        "running them one at a time.")
+        for row in rows:
+            index = row[BATCH_INDEX]
+            try:
+                results[index] = query_database(driver, query, parameter_sets[index])
+            except Exception as row_error:
+                results[index] = row_error
+        return results
+
+    graphs = {row[BATCH_INDEX]: BatchGraph() for row in rows}
+    for record in records:
+        graph = graphs[record[BATCH_INDEX]]
+        for key, value in record.items():
+            if key != BATCH_ROW:
+                graph.add(value)
+    for index, graph in graphs.items():
+        results[index] = (graph, result_summary)
+    return results
+
 def new_query_found_in_catalogue(new_query: trellis.DatabaseQuery, catalogued_queries: str) -> bool:
     # Typing hints: https://docs.python.org/3/library/typing.html
+    catalogue = query_catalogue.QueryCatalogue.from_document(catalogued_queries)
+    return catalogue.contains(new_query, refresh=False)
 
-    query_match_found = False
-    query_name_found = False
-    catalogued_queries = yaml.load_all(catalogued_queries, Loader=yaml.FullLoader)
-    
-    for logged_query in catalogued_queries:
-        if new_query.name == logged_query.name:
-                query_name_found = True
-        if new_query == logged_query:
-                query_match_found = True
+def load_query_dict(queries_document):
+    """Index predefined database queries by name.
+
+    Args:
+        queries_document (str): Multi-document query YAML.
+    Returns:
+        (dict): DatabaseQuery objects by name.
+    """
+    query_dict = {}
+    for query in yaml.load_all(queries_document, Loader=yaml.FullLoader):
+        if query.name in query_dict.keys():
+            raise ValueError(f"> db-query: Query {query.name} is defined in duplicate.")
+        streaming.check_stream_results(query)
+        query_dict[query.name] = query
+    return query_dict
+
+def create_custom_query(query_request):
+    """Create a DatabaseQuery from a custom query request.
+
+    Args:
+        query_request (trellis.QueryRequestReader): Custom query request.
+    Returns:
+        (trellis.DatabaseQuery): Query requiring the request parameters.
+    """
+    # Parse query parameters and data types from request
+    required_parameters = {}
+    for key, value in query_request.query_parameters.items():
+        required_parameters[key] = type(value).__name__
+    logging.info(f"> db-query: Custom query required parameters: {required_parameters}.")
+
+    return trellis.DatabaseQuery(
+        name=query_request.query_name,
+        cypher=query_request.cypher,
+        # Maybe I should populate this
+        required_parameters=required_parameters,
+        write_transaction=query_request.write_transaction,
+        returns = query_request.returns,
+        publish_to = query_request.publish_to,
+        aggregate_results = query_request.aggregate_results,
+        active = True)
+
+def register_custom_query(database_query, blob_catalogue, job_catalogue):
+    """Add new create-blob-node and create-job-node queries to their catalogue.
+
+    Args:
+        database_query (trellis.DatabaseQuery): Custom query.
+        blob_catalogue (query_catalogue.QueryCatalogue): Catalogue of mergeBlob queries.
+        job_catalogue (query_catalogue.QueryCatalogue): Catalogue of mergeJob queries.
+    Returns:
+        (bool): Whether the query was added to a catalogue.
+    """
+    if re.match(pattern = r"^mergeBlob.*", string = database_query.name):
+        kind, catalogue = 'blob', blob_catalogue
+    # Register new create-job-node queries
+    elif re.match(pattern = r"^mergeJob.*", string = database_query.name):
+        kind, catalogue = 'job', job_catalogue
+    else:
+        logging.warning("> db-query: Custom query name did not match any recognized pattern.")
+        return False
 
-    if query_name_found and not query_match_found:
+    # Only reloads the catalogue if the query is not already
+    # indexed and the catalogue object has changed
+    if catalogue.contains(database_query):
+        logging.info(f"> db-query: Merge {kind} query already stored.")
+        return False
+
+    logging.info(f"> db-query: Merge {kind} query not found in existing catalogue; adding to {catalogue.blob_name}")
+    catalogue.register(database_query)
+    return True
+
+def get_catalogue_query(query_request, query_dict):
+    """
+    Args:
+        query_request (trellis.QueryRequestReader): Request for a predefined query.
+        query_dict (dict): Predefined queries by name.
+    Returns:
+        (trellis.DatabaseQuery): Requested query.
+    """
+    try:
+        return query_dict[query_request.query_name]
+    except KeyError:
+        logging.info(f"> db-query: Defined queries: {query_dict.keys()}.")
+        raise KeyError(f"> db-query: Database query '{query_request.query_name}' " +
+                       "is not available. Check that is has been " +
+                       #f"added to {TRELLIS['USER_DEFINED_QUERIES']}.")
+                       f"added to config/database-queries.yaml.")
+
+def check_plan_error(database_query):
+    """Fail without waiting for the database to reject a query again.
+
+    Args:
+        database_query (trellis.DatabaseQuery): Catalogue query.
+    Raises:
+        plan_warmup.QueryCompileError: If the query failed the plan warm-up.
+    """
+    plan_error = PLAN_ERRORS.get(database_query.name)
+    if plan_error:
+        # A new exception for every request; raising the stored one again
+        # would keep adding the frames of each request to its traceback
+        raise plan_warmup.QueryCompileError(plan_error.query_name, plan_error.error)
+
+def create_query_response(query_request, database_query, graph, result_summary):
+    """Log query results and create the response message.
+
+    Args:
+        query_request (trellis.QueryRequestReader): Request that was run.
+        database_query (trellis.DatabaseQuery): Query that was run.
+        graph (neo4j.graph.Graph): Returned nodes and relationships.
+        result_summary (neo4j.ResultSummary): Query result summary.
+    Returns:
+        (trellis.QueryResponseWriter): Response to publish.
+    """
+    result_available_after = result_summary.result_available_after
+    result_consumed_after = result_summary.result_consumed_after
+    logging.debug(
+                 f"> db-query: Query result available after: {result_available_after} ms, " +
+                 f"consumed after: {result_consumed_after} ms.")
+    if int(result_available_after) > QUERY_ELAPSED_MAX:
         logging.warning(
-                        f"163 >> Found catalogued query named {new_query.name} " +
-                         "but does not match current query.")
-    return query_match_found
-  
+                        f"> db-query: Result available time ({result_available_after} ms) " +
+                        f"exceeded {QUERY_ELAPSED_MAX:.3f}. " +
+                        f"Query: {database_query.name}.")
+    logging.info(f"> db-query: Query result counter: {result_summary.counters}.")
+
+    query_response = trellis.QueryResponseWriter(
+        sender = FUNCTION_NAME,
+        seed_id = query_request.seed_id,
+        previous_event_id = query_request.event_id,
+        query_name = query_request.query_name,
+        graph = graph,
+        job_request = None,
+        result_summary = result_summary)
+
+    logging.info(f"> db-query: Query response nodes: {[list(node.labels) for node in query_response.nodes]}")
+    logging.info(f"> db-query: Query response relationships:")
+    for relationship in query_response.relationships:
+        logging.info(f"> db-query: (:{list(relationship.start_node.labels)})-[:{relationship.type}]->(:{list(relationship.end_node.labels)})")
+    return query_response
+
+def publish_query_response(query_response, database_query, publisher, project_id, topics):
+    """Publish a query response to the topics of the query.
+
+    Args:
+        query_response (trellis.QueryResponseWriter): Response message.
+        database_query (trellis.DatabaseQuery): Query that was run.
+        publisher (pubsub.PublisherClient): Pub/Sub client.
+        project_id (str): Google Cloud project ID.
+        topics (dict): Topic names by Trellis configuration key.
+    Returns:
+        (dict): Number of messages published to each topic.
+    Raises:
+        fanout.PublishError: If any message was not published.
+    """
+    topic_names = [topics[topic_name] for topic_name in database_query.publish_to]
+    logging.info(f"> db-query: Publishing query response to topics: {topic_names}.")
+
+    # Default behavior will be to split results
+    if hasattr(database_query, "aggregate_results") and database_query.aggregate_results == 'True':
+        if all(topic_name in REASSEMBLING_TOPICS for topic_name in database_query.publish_to):
+            # Split into parts that fit in a Pub/Sub message
+            part_bytes = response_chunks.PART_BYTES
+        else:
+            part_bytes = float('inf')
+        messages = response_chunks.split_aggregate_message(
+                                                           query_response.return_json_with_all_nodes(),
+                                                           part_bytes = part_bytes,
+                                                           encoding = AGGREGATE_COMPRESSION)
+        if len(messages) == 1 and len(messages[0]) > response_chunks.MAX_MESSAGE_BYTES:
+            raise ValueError(
+                             f"> db-query: Aggregate query response is {len(messages[0])} bytes, over the " +
+                             f"Pub/Sub limit, and topics {topic_names} can't join it from parts.")
+        logging.info(f"> db-query: Aggregate query response split into {len(messages)} parts.")
+    else:
+        messages = query_response.generate_separate_entity_jsons()
+
+    # Each message is serialized once and published to all topics at once
+    published_message_counts, failures = fanout.publish_fanout(
+                                                                publisher = publisher,
+                                                                project_id = project_id,
+                                                                topics = topic_names,
+                                                                messages = messages)
+    logging.info(f"> db-query: Summary of published messages: {published_message_counts}")
+    if any(failures.values()):
+        raise fanout.PublishError(published_message_counts, failures)
+    return published_message_counts
+
+def stream_query_response(query_request, database_query, driver, publisher, project_id, topics):
+    """Run a query and publish its results while they are read.
+
+    Args:
+        query_request (trellis.QueryRequestReader): Request to run.
+        database_query (trellis.DatabaseQuery): Query with stream_results set.
+        driver (neo4j.Driver): Neo4j driver.
+        publisher (pubsub.PublisherClient): Pub/Sub client.
+        project_id (str): Google Cloud project ID.
+        topics (dict): Topic names by Trellis configuration key.
+    Returns:
+        neo4j.ResultSummary: Summary of the query.
+    Raises:
+        fanout.PublishError: If any message was not published.
+    """
+    writer = streaming.StreamingResponseWriter(
+                                               sender = FUNCTION_NAME,
+                                               seed_id = query_request.seed_id,
+                                               previous_event_id = query_request.event_id,
+                                               query = database_query,
+                                               parameters = query_request.query_parameters)
+    topic_names = [topics[topic_name] for topic_name in database_query.publish_to]
+    logging.info(f"> db-query: Streaming query response to topics: {topic_names}.")
+    stream_publisher = streaming.StreamPublisher(publisher, project_id, topic_names)
+    # Shared by the retries of the admission controller, so entities
+    # published before a retryable error aren't published again
+    entity_stream = streaming.EntityStream(relationships=streaming.returns_relationships(database_query))
+    try:
+        result_summary = ADMISSION.run(
+            query_database_streaming,
+            driver = driver,
+            query = database_query,
+            parameters = query_request.query_parameters,
+            on_entity = lambda entity: stream_publisher.put(writer.get_entity_message(entity)),
+            entity_stream = entity_stream,
+            latency = lambda result_summary: result_summary.result_available_after,
+            retryable = admission.get_retry_check(database_query))
+    finally:
+        published_message_counts, failures = stream_publisher.close()
+        logging.info(f"> db-query: Summary of published messages: {published_message_counts}")
+    logging.info(f"> db-query: Query result counter: {result_summary.counters}.")
+    if any(failures.values()):
+        raise fanout.PublishError(published_message_counts, failures)
+    return result_summary
+
 def db_query(event, context, local_driver=None):
     """When an object node is added to the database, launch any
        jobs corresponding to that node label.
@@ -205,181 +678,104 @@ def db_query(event, context, local_driver=None):
 
     # Reload predefined database queries every time a function instance
     # is launched in development mode to make sure queries are current.
+    query_dict = QUERY_DICT
     DEVELOPMENT = os.environ.get('DEVELOPMENT')
     if DEVELOPMENT:
         with open("database-queries.yaml", 'r') as file_handle:
-            queries_document = file_handle.read()
-        queries = yaml.load_all(queries_document, Loader=yaml.FullLoader)
-
-        QUERY_DICT = {}
-        for query in queries:
-            if query.name in QUERY_DICT.keys():
-                raise ValueError(f"Query {query.name} is defined in duplicate.")
-            QUERY_DICT[query.name] = query
-        logging.debug(f"> db-query: Loaded database queries: {QUERY_DICT}.")
+            query_dict = load_query_dict(file_handle.read())
+        logging.debug(f"> db-query: Loaded database queries: {query_dict}.")
 
     if query_request.custom == True:
         logging.info("> db-query: Processing custom query.")
-
-        # Parse query parameters and data types from request
-        required_parameters = {}
-        for key, value in query_request.query_parameters.items():
-            required_parameters[key] = type(value).__name__
-        logging.info(f"> db-query: Custom query required parameters: {required_parameters}.")
-
-        # Create DatabaseQuery object
-        database_query = trellis.DatabaseQuery(
-            name=query_request.query_name,
-            cypher=query_request.cypher,
-            # Maybe I should populate this
-            required_parameters=required_parameters,
-            write_transaction=query_request.write_transaction,
-            returns = query_request.returns,
-            publish_to = query_request.publish_to,
-            aggregate_results = query_request.aggregate_results,
-            active = True)
-
-        register_new_query = True
-        
-        if re.match(pattern = r"^mergeBlob.*", string = database_query.name):
-            if new_query_found_in_catalogue(database_query, CREATE_BLOB_QUERY_DOC):
-                register_new_query = False
-                logging.info("> db-query: Merge blob query already stored.")
-            else:
-                logging.info("> db-query: Merge blob query not found in current catalogue; reloading latest version.")
-                # Reload create blob queries to make sure list is current
-                create_blob_query_doc = storage.Client() \
-                                        .get_bucket(os.environ['CREDENTIALS_BUCKET']) \
-                                        .get_blob(TRELLIS["CREATE_BLOB_QUERIES"]) \
-                                        .download_as_string()
-                if new_query_found_in_catalogue(database_query, create_blob_query_doc):
-                    register_new_query = False
-                    logging.info("> db-query: Merge blob query already stored.")
-            
-            if register_new_query:
-                logging.info(f"> db-query: Merge blob query not found in existing catalogue; adding to {TRELLIS['CREATE_BLOB_QUERIES']}")
-                create_blob_query_str = create_blob_query_doc.decode("utf-8")
-                create_blob_query_str += "--- "
-                create_blob_query_str += yaml.dump(database_query)
-
-                storage.Client() \
-                    .get_bucket(os.environ['CREDENTIALS_BUCKET']) \
-                    .get_blob(TRELLIS["CREATE_BLOB_QUERIES"]) \
-                    .upload_from_string(create_blob_query_str)
-        # Register new create-job-node queries
-        elif re.match(pattern = r"^mergeJob.*", string = database_query.name):
-            if new_query_found_in_catalogue(database_query, CREATE_JOB_QUERY_DOC):
-                register_new_query = False
-                logging.info("> db-query: Merge job query already stored.")
-            else:
-                logging.info("> db-query: Merge job query not found in current catalogue; reloading latest version.")
-                # Reload create job queries to make sure list is current
-                create_job_query_doc = storage.Client() \
-                                        .get_bucket(os.environ['CREDENTIALS_BUCKET']) \
-                                        .get_blob(TRELLIS["CREATE_JOB_QUERIES"]) \
-                                        .download_as_string()
-                if new_query_found_in_catalogue(database_query, create_job_query_doc):
-                    register_new_query = False
-                    logging.info("> db-query: Merge job query already stored.")
-
-            if register_new_query:
-                logging.info(f"> db-query: Merge job query not found in existing catalogue; adding to {TRELLIS['CREATE_JOB_QUERIES']}")
-                create_job_query_str = create_job_query_doc.decode("utf-8")
-                create_job_query_str += "--- "
-                create_job_query_str += yaml.dump(database_query)
-                storage.Client() \
-                    .get_bucket(os.environ['CREDENTIALS_BUCKET']) \
-                    .get_blob(TRELLIS["CREATE_JOB_QUERIES"]) \
-                    .upload_from_string(create_job_query_str)
-        else:
-            logging.warning("> db-query: Custom query name did not match any recognized pattern.")
+        database_query = create_custom_query(query_request)
+        register_custom_query(
+                              database_query,
+                              blob_catalogue = CREATE_BLOB_QUERY_CATALOGUE.get(),
+                              job_catalogue = CREATE_JOB_QUERY_CATALOGUE.get())
     else:
-        try:
-            database_query = QUERY_DICT[query_request.query_name]
-        except KeyError:
-            logging.info(f"> db-query: Defined queries: {QUERY_DICT.keys()}.")
-            raise KeyError(f"> db-query: Database query '{query_request.query_name}' " +
-                           "is not available. Check that is has been " +
-                           #f"added to {TRELLIS['USER_DEFINED_QUERIES']}.")
-                           f"added to config/database-queries.yaml.")
+        database_query = get_catalogue_query(query_request, query_dict)
+        check_plan_error(database_query)
+
+        # Requests for the same sample-wide query arrive with every
+        # object of the sample; a request in the window covers the others
+        if COALESCER and query_coalescing.is_redundant(database_query):
+            if not COALESCER.coalesce(database_query.name, query_request.query_parameters):
+                logging.info(
+                             f"> db-query: Skipping redundant query '{database_query.name}' " +
+                             f"with parameters: {query_request.query_parameters}. " +
+                             f"Coalescing stats: {COALESCER.stats()}.")
+                return
+
+    # Publish results of read queries that opt in while they are read,
+    # instead of collecting them first. Write results are only published
+    # once committed.
+    stream = (
+              getattr(database_query, 'stream_results', False) and
+              not database_query.write_transaction and
+              database_query.publish_to and
+              ENVIRONMENT == 'google-cloud' and
+              not getattr(database_query, 'aggregate_results', False) == 'True')
 
     try:
         # TODO: Compare the provided query parameters against the 
         # required query parameters
         logging.info(f"> db-query: Running query '{database_query.name}' " +
                      f"with parameters: {query_request.query_parameters}.")
-        graph, result_summary = query_database(
-            driver = DRIVER,
-            query = database_query,
-            parameters = query_request.query_parameters)
-    except ProtocolError as error:
-        logging.error(f"> db-query: Encountered Protocol Error: {error}.")
-        return
-    except ServiceUnavailable as error:
-        logging.error(f"> db-query: Encountered Service Interrupion: {error}.")
-        return
-    except ConnectionResetError as error:
-        logging.error(f"> db-query: Encountered connection interruption: {error}.")
-        return
-
-    result_available_after = result_summary.result_available_after
-    result_consumed_after = result_summary.result_consumed_after
-    logging.debug(
-                 f"> db-query: Query result available after: {result_available_after} ms, " +
-                 f"consumed after: {result_consumed_after} ms.")
-    if int(result_available_after) > QUERY_ELAPSED_MAX:
-        logging.warning(
-                        f"> db-query: Result available time ({result_available_after} ms) " +
-                        f"exceeded {QUERY_ELAPSED_MAX:.3f}. " +
-                        f"Query: {database_query.name}.")
-    logging.info(f"> db-query: Query result counter: {result_summary.counters}.")
-
-    query_response = trellis.QueryResponseWriter(
-        sender = FUNCTION_NAME,
-        seed_id = query_request.seed_id,
-        previous_event_id = query_request.event_id,
-        query_name = query_request.query_name,
-        graph = graph,
-        job_request = None,
-        result_summary = result_summary)
-
-    logging.info(f"> db-query: Query response nodes: {[list(node.labels) for node in query_response.nodes]}")
-    logging.info(f"> db-query: Query response relationships:")
-    for relationship in query_response.relationships:
-        logging.info(f"> db-query: (:{list(relationship.start_node.labels)})-[:{relationship.type}]->(:{list(relationship.end_node.labels)})")
-
-    # Return if no pubsub topic or not running on GCP
-    if not database_query.publish_to or not ENVIRONMENT == 'google-cloud':
-        print("> db-query: No Pub/Sub topic specified; result not published.")
-        return
-
-    # Track how many messages are published to each topic
-    published_message_counts = {}
-    for topic_name in database_query.publish_to:
-        topic = TRELLIS[topic_name]
-        published_message_counts[topic] = 0
-
-        # Default behavior will be to split results
-        if hasattr(database_query, "aggregate_results") and database_query.aggregate_results == 'True':
-            message = query_response.return_json_with_all_nodes()
-            logging.info(f"> db-query: Publishing query response to topic: {topic}.")
-            logging.debug(f"> db-query: Publising message: {message}.")
-            publish_result = trellis.utils.publish_to_pubsub_topic(
-                    publisher = PUBLISHER,
-                    project_id = PROJECT_ID,
-                    topic = topic, 
-                    message = message)
-            logging.info(f"> db-query: Published message to {topic} with result (event_id): {publish_result}.")
-            published_message_counts[topic] += 1
+        query_start = time.perf_counter()
+        if stream:
+            result_summary = stream_query_response(
+                                                   query_request,
+                                                   database_query,
+                                                   driver = DRIVER,
+                                                   publisher = PUBLISHER,
+                                                   project_id = PROJECT_ID,
+                                                   topics = TRELLIS)
+        else:
+            graph, result_summary = ADMISSION.run(
+                query_database,
+                driver = DRIVER,
+                query = database_query,
+                parameters = query_request.query_parameters,
+                latency = lambda result: result[1].result_available_after,
+                retryable = admission.get_retry_check(database_query))
+    except admission.RETRYABLE_ERRORS + (admission.AdmissionTimeout,) as error:
+        # Raise instead of dropping the request so the failure is reported
+        logging.error(
+                      f"> db-query: Query '{database_query.name}' failed after retrying " +
+                      f"for {QUERY_RETRY_DEADLINE} seconds: {error}.")
+        raise
+    finally:
+        logging.info(f"> db-query: Admission state: {ADMISSION.stats()}.")
+        logging.info(f"> db-query: Connection pool timing: {POOL_METRICS.stats()}.")
+
+    profile = PROFILER.record(
+                              database_query.name,
+                              result_summary,
+                              total_ms = (time.perf_counter() - query_start) * 1000)
+
+    # Streamed results have already been published
+    if not stream:
+        query_response = create_query_response(query_request, database_query, graph, result_summary)
+
+        # Don't publish if no pubsub topic or not running on GCP
+        if not database_query.publish_to or not ENVIRONMENT == 'google-cloud':
+            print("> db-query: No Pub/Sub topic specified; result not published.")
         else:
-            for message in query_response.generate_separate_entity_jsons():
-                logging.info(f"> db-query: Publishing query response to topic: {topic}.")
-                logging.debug(f"> db-query: Publishing message: {message}.")
-                publish_result = trellis.utils.publish_to_pubsub_topic(
-                    publisher = PUBLISHER,
-                    project_id = PROJECT_ID,
-                    topic = topic,
-                    message = message)
-                logging.info(f"> db-query: Published message to {topic} with result: {publish_result}.")
-                published_message_counts[topic] += 1
-    logging.info(f"> db-query: Summary of published messages: {published_message_counts}")
\ No newline at end of file
+            publish_query_response(
+                                   query_response,
+                                   database_query,
+                                   publisher = PUBLISHER,
+                                   project_id = PROJECT_ID,
+                                   topics = TRELLIS)
+
+    # Profile after publishing so it doesn't delay the next function
+    if profile:
+        PROFILER.profile(
+                         DRIVER,
+                         database_query,
+                         query_request.query_parameters,
+                         result_summary,
+                         admission_controller = ADMISSION)
+    logging.info(f"> db-query: Query statistics: {PROFILER.stats()[database_query.name]}.")
+    if COALESCER:
+        logging.info(f"> db-query: Coalescing stats: {COALESCER.stats()}.")
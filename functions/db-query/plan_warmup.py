@@ -0,0 +1,175 @@
+"""Populate the Neo4j query plan cache with the catalogue queries.
+
+Neo4j plans a Cypher statement the first time it is run and caches the
+plan by statement text and parameter types, so the first request for
+each query on a new instance pays the planning cost. warm_up_plans()
+runs EXPLAIN for every loaded query in parallel, with placeholder
+parameters of the required types, which plans the statement without
+running it. Queries that no longer compile fail the warm-up instead of
+the first request that uses them.
+"""
+
+import time
+import logging
+
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError
+
+from neo4j.exceptions import ClientError
+
+# Seconds to spend on the warm-up; queries not planned in time are skipped
+WARM_UP_BUDGET_KEY = 'DB_QUERY_PLAN_WARM_UP_SECONDS'
+WARM_UP_THREADS = 8
+
+# Planning slower than this is logged as a warning
+PLANNING_WARNING_MS = 500
+
+# Values used for parameters when planning, by required parameter type
+PLACEHOLDER_VALUES = {
+                      'str': '',
+                      'int': 0,
+                      'float': 0.0,
+                      'bool': False,
+                      'list': [],
+                      'dict': {},
+}
+
+# Server errors of statements that do not compile
+COMPILE_ERROR_PREFIX = 'Neo.ClientError.Statement.'
+
+
+class QueryCompileError(Exception):
+
+    def __init__(self, query_name, error):
+        """A catalogue query is rejected by the database planner.
+
+        Args:
+            query_name (str): Name of the query.
+            error (neo4j.exceptions.ClientError): Error raised by EXPLAIN.
+        """
+        super().__init__(f"> db-query: Query '{query_name}' does not compile: {error}")
+        self.query_name = query_name
+        self.error = error
+
+
+def get_placeholder_parameters(query):
+    """
+    Args:
+        query (trellis.DatabaseQuery): Query with required parameters.
+    Returns:
+        (dict): Parameter values of the required types.
+    """
+    return {
+            key: PLACEHOLDER_VALUES.get(type_name)
+            for key, type_name in query.required_parameters.items()}
+
+
+def _explain_transaction_function(tx, cypher, parameters):
+    return tx.run(f"EXPLAIN {cypher}", parameters).consume()
+
+
+def explain_query(driver, name, cypher, parameters, write_transaction):
+    """Plan a statement without running it.
+
+    Args:
+        driver (neo4j.Driver): Database driver.
+        name (str): Query name, used in errors.
+        cypher (str): Statement to plan.
+        parameters (dict): Placeholder parameters.
+        write_transaction (bool): Plan on the server the query is run on.
+    Returns:
+        (float): Planning time in milliseconds.
+    Raises:
+        QueryCompileError: If the statement does not compile.
+    """
+    start = time.perf_counter()
+    try:
+        with driver.session() as session:
+            if write_transaction:
+                summary = session.write_transaction(_explain_transaction_function, cypher, parameters)
+            else:
+                summary = session.read_transaction(_explain_transaction_function, cypher, parameters)
+    except ClientError as error:
+        if (error.code or '').startswith(COMPILE_ERROR_PREFIX):
+            raise QueryCompileError(name, error) from error
+        raise
+    planning_ms = summary.result_available_after
+    if planning_ms is None:
+        planning_ms = (time.perf_counter() - start) * 1000
+    return planning_ms
+
+
+def get_statements(queries, batch_cypher=None):
+    """
+    Args:
+        queries (iterable): trellis.DatabaseQuery objects.
+        batch_cypher (callable): Gets the batched statement of a query,
+            e.g. main.get_batch_cypher. Both forms are planned if set.
+    Returns:
+        (list): (name, cypher, parameters, write_transaction) tuples.
+        (set): Names of the batched statements.
+    """
+    statements = []
+    batch_names = set()
+    for query in queries:
+        parameters = get_placeholder_parameters(query)
+        statements.append((query.name, query.cypher, parameters, query.write_transaction))
+        if batch_cypher:
+            name = f"{query.name} (batch)"
+            row = dict(parameters, batchIndex=0)
+            statements.append((name, batch_cypher(query), {'rows': [row]}, query.write_transaction))
+            batch_names.add(name)
+    return statements, batch_names
+
+
+def warm_up_plans(driver, queries, time_budget, threads=WARM_UP_THREADS, batch_cypher=None):
+    """Run EXPLAIN for each query to fill the plan cache.
+
+    Args:
+        driver (neo4j.Driver): Database driver.
+        queries (iterable): trellis.DatabaseQuery objects.
+        time_budget (float): Seconds to wait for the plans.
+        threads (int): Statements planned at the same time.
+        batch_cypher (callable): See get_statements().
+    Returns:
+        (dict): Planning time in milliseconds by statement name.
+            Statements that could not be planned are missing.
+    Raises:
+        QueryCompileError: For the first query that does not compile.
+            Batched statements that do not compile are only logged,
+            because batches fall back to running rows one by one.
+    """
+    statements, batch_names = get_statements(queries, batch_cypher)
+    start = time.perf_counter()
+    planning_times = {}
+    executor = ThreadPoolExecutor(max_workers=threads)
+    futures = {
+               executor.submit(explain_query, driver, *statement): statement[0]
+               for statement in statements}
+    try:
+        for future in as_completed(futures, timeout=time_budget):
+            name = futures[future]
+            try:
+                planning_times[name] = future.result()
+            except QueryCompileError as error:
+                if name not in batch_names:
+                    raise
+                logging.warning(f"{error}; batches of the query will run row by row.")
+            except Exception as error:
+                # Unavailable database etc.; planned on first use instead
+                logging.warning(f"> db-query: Could not plan query '{name}': {error}.")
+    except TimeoutError:
+        logging.warning(
+                        f"> db-query: Plan warm-up exceeded {time_budget} seconds; " +
+                        f"{len(statements) - len(planning_times)} queries not planned.")
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    for name, planning_ms in sorted(planning_times.items(), key=lambda item: item[1], reverse=True):
+        if planning_ms > PLANNING_WARNING_MS:
+            logging.warning(f"> db-query: Query '{name}' took {planning_ms:.0f} ms to plan.")
+        else:
+            logging.info(f"> db-query: Query '{name}' took {planning_ms:.0f} ms to plan.")
+    logging.info(
+                 f"> db-query: Planned {len(planning_times)} of {len(statements)} queries " +
+                 f"in {(time.perf_counter() - start) * 1000:.0f} ms.")
+    return planning_times
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""Create the indexes and constraints declared by the database queries.
+
+Queries in database-queries.yaml declare the schema they depend on:
+
+    indexes:
+      Fastq:
+        - sample
+        - readGroup
+    constraints:
+      Fastq:
+        - uri
+
+The properties listed under a label in `indexes` form one index, which
+is composite if there is more than one; a list of lists declares several
+indexes on the label. Each property under `constraints` gets a
+uniqueness constraint, which is backed by its own index. Statements use
+IF NOT EXISTS, so running the tool again only creates what is missing.
+
+After the schema is created, every query is planned with EXPLAIN and
+the report lists the queries whose plans still start from a label or
+full node scan instead of an index seek. Requires Neo4j 4.4 or later.
+Run from this directory, like the tests.
+
+Examples:
+    python provision_indexes.py --config trellis-config.yaml
+    python provision_indexes.py --neo4j-uri bolt://localhost:7687 --neo4j-password test --verify-only
+"""
+
+import re
+import sys
+import yaml
+import logging
+import argparse
+
+import plan_warmup
+# Registers the !DatabaseQuery YAML tag
+import trellisdata as trellis
+
+# Plan operators that read every node with a label, or every node
+SCAN_OPERATORS = (
+                  'AllNodesScan',
+                  'NodeByLabelScan',
+                  'UndirectedRelationshipTypeScan',
+                  'DirectedRelationshipTypeScan')
+
+SCHEMA_NAME_PREFIX = 'trellis'
+
+
+def get_declared_properties(query, field):
+    """
+    Args:
+        query (trellis.DatabaseQuery): Query with an indexes or constraints field.
+        field (str): 'indexes' or 'constraints'.
+    Returns:
+        (list): (label, properties) tuples, properties being a tuple.
+    """
+    declared = getattr(query, field, None) or {}
+    schema = []
+    for label, properties in declared.items():
+        if isinstance(properties, str):
+            properties = [properties]
+        if field == 'constraints':
+            schema.extend((label, (property,)) for property in properties)
+        elif properties and all(isinstance(item, list) for item in properties):
+            schema.extend((label, tuple(item)) for item in properties)
+        else:
+            schema.append((label, tuple(properties)))
+    return schema
+
+
+def get_schema_name(kind, label, properties):
+    name = '_'.join([SCHEMA_NAME_PREFIX, kind, label, *properties])
+    return re.sub(r"\W", '_', name)
+
+
+def get_index_statement(label, properties):
+    properties_cypher = ', '.join(f"n.`{property}`" for property in properties)
+    return (
+            f"CREATE INDEX {get_schema_name('index', label, properties)} IF NOT EXISTS " +
+            f"FOR (n:`{label}`) ON ({properties_cypher})")
+
+
+def get_constraint_statement(label, properties):
+    return (
+            f"CREATE CONSTRAINT {get_schema_name('unique', label, properties)} IF NOT EXISTS " +
+            f"FOR (n:`{label}`) REQUIRE n.`{properties[0]}` IS UNIQUE")
+
+
+def get_schema_statements(queries):
+    """
+    Args:
+        queries (iterable): trellis.DatabaseQuery objects.
+    Returns:
+        (list): Unique schema statements, constraints first. Indexes on
+            the same property as a constraint are left out, because
+            the constraint index serves the same lookups and Neo4j
+            does not create a constraint over an existing index.
+    """
+    constraints = []
+    indexes = []
+    for query in queries:
+        for schema in get_declared_properties(query, 'constraints'):
+            if schema not in constraints:
+                constraints.append(schema)
+        for schema in get_declared_properties(query, 'indexes'):
+            if schema not in indexes:
+                indexes.append(schema)
+    indexes = [schema for schema in indexes if schema not in constraints]
+    return (
+            [get_constraint_statement(*schema) for schema in constraints] +
+            [get_index_statement(*schema) for schema in indexes])
+
+
+def create_schema(driver, statements):
+    """Run schema statements one at a time.
+
+    Args:
+        driver (neo4j.Driver): Database driver.
+        statements (list): Schema statements.
+    Returns:
+        (dict): Error message by failed statement.
+    """
+    errors = {}
+    with driver.session() as session:
+        for statement in statements:
+            try:
+                session.run(statement).consume()
+            except Exception as error:
+                # E.g. existing duplicate values prevent a constraint
+                errors[statement] = str(error)
+                logging.error(f"> provision: Failed: {statement}: {error}.")
+            else:
+                logging.info(f"> provision: {statement}.")
+    return errors
+
+
+def get_plan_operators(plan):
+    """
+    Args:
+        plan (dict): Plan of a query summary, e.g. summary.plan.
+    Yields:
+        (tuple): Operator type and details of every operator in the plan.
+    """
+    if not plan:
+        return
+    if not isinstance(plan, dict):
+        plan = {
+                'operatorType': plan.operator_type,
+                'args': plan.arguments,
+                'children': plan.children}
+    # Operator types can have a runtime suffix, e.g. NodeByLabelScan@neo4j
+    operator_type = plan.get('operatorType', '').split('@')[0]
+    args = plan.get('args') or {}
+    yield operator_type, args.get('Details') or args.get('LegacyExpression') or ''
+    for child in plan.get('children') or []:
+        yield from get_plan_operators(child)
+
+
+def _explain_transaction_function(tx, cypher, parameters):
+    return tx.run(f"EXPLAIN {cypher}", parameters).consume()
+
+
+def find_scans(driver, query):
+    """Plan a query and find operators that scan instead of seeking.
+
+    Args:
+        driver (neo4j.Driver): Database driver.
+        query (trellis.DatabaseQuery): Query to plan.
+    Returns:
+        (list): (operator type, details) tuples of scan operators.
+    """
+    parameters = plan_warmup.get_placeholder_parameters(query)
+    with driver.session() as session:
+        if query.write_transaction:
+            summary = session.write_transaction(_explain_transaction_function, query.cypher, parameters)
+        else:
+            summary = session.read_transaction(_explain_transaction_function, query.cypher, parameters)
+    return [
+            (operator_type, details)
+            for operator_type, details in get_plan_operators(summary.plan)
+            if operator_type in SCAN_OPERATORS]
+
+
+def verify_queries(driver, queries):
+    """
+    Args:
+        driver (neo4j.Driver): Database driver.
+        queries (iterable): trellis.DatabaseQuery objects.
+    Returns:
+        (dict): Scan operators, or the planning error, by query name.
+            Queries with index-backed plans are not included.
+    """
+    problems = {}
+    for query in queries:
+        try:
+            scans = find_scans(driver, query)
+        except Exception as error:
+            problems[query.name] = f"not planned: {error}"
+            continue
+        if scans:
+            problems[query.name] = ', '.join(
+                f"{operator_type}({details})" if details else operator_type
+                for operator_type, details in scans)
+    return problems
+
+
+def format_report(queries, schema_errors, problems):
+    lines = []
+    if schema_errors:
+        lines.append(f"{len(schema_errors)} schema statements failed:")
+        lines.extend(f"  {statement}: {error}" for statement, error in schema_errors.items())
+    lines.append(f"{len(problems)} of {len(queries)} queries are not index-backed:")
+    name_width = max([len(name) for name in problems] + [0])
+    lines.extend(f"  {name:<{name_width}}  {problem}" for name, problem in problems.items())
+    return '\n'.join(lines)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--queries', default='database-queries.yaml', help='Database queries.')
+    parser.add_argument('--config', help='Local Trellis configuration YAML with the database address.')
+    parser.add_argument('--neo4j-uri', help='Default: from the Trellis configuration.')
+    parser.add_argument('--neo4j-user', default='neo4j')
+    parser.add_argument('--neo4j-password', help='Default: from the Trellis configuration.')
+    parser.add_argument('--dry-run', action='store_true', help='Print the schema statements and exit.')
+    parser.add_argument('--verify-only', action='store_true', help='Only check the query plans.')
+    args = parser.parse_args(argv)
+
+    if not args.dry_run and not args.config and not (args.neo4j_uri and args.neo4j_password):
+        parser.error('--config or --neo4j-uri and --neo4j-password are required.')
+    return args
+
+
+def main_cli(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    with open(args.queries) as file_handle:
+        queries = [query for query in yaml.load_all(file_handle, Loader=yaml.FullLoader) if query]
+    statements = get_schema_statements(queries)
+    if args.dry_run:
+        print('\n'.join(statements))
+        return 0
+
+    from neo4j import GraphDatabase
+
+    trellis_config = {}
+    if args.config:
+        with open(args.config) as file_handle:
+            trellis_config = yaml.safe_load(file_handle)
+    neo4j_uri = args.neo4j_uri or (
+        f"{trellis_config['NEO4J_SCHEME']}://{trellis_config['NEO4J_IP_ADDRESS']}:{trellis_config['NEO4J_PORT']}")
+    neo4j_password = args.neo4j_password or trellis_config['NEO4J_PASSPHRASE']
+
+    driver = GraphDatabase.driver(neo4j_uri, auth=(args.neo4j_user, neo4j_password))
+    try:
+        schema_errors = {}
+        if not args.verify_only:
+            schema_errors = create_schema(driver, statements)
+            # New indexes are populated in the background
+            with driver.session() as session:
+                session.run("CALL db.awaitIndexes(300)").consume()
+        problems = verify_queries(driver, queries)
+    finally:
+        driver.close()
+
+    print(format_report(queries, schema_errors, problems))
+    return 1 if schema_errors or problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
@@ -0,0 +1,380 @@
+"""Index of custom queries registered by db-query.
+
+The create-blob and create-job query catalogues are multi-document YAML
+objects in GCS. Instead of parsing the whole document for every custom
+query request, QueryCatalogue keeps the parsed queries indexed by name
+and content digest, and only reads the object again when its generation
+changes. Queries are appended to the catalogue, so when a new generation
+extends the previous one only the new documents are downloaded and parsed.
+
+New queries are not added to the catalogue object itself. Each one is
+written to its own segment object, named by the query digest, under
+"<catalogue path>.d/". Segments are only created if they don't exist, so
+concurrent function instances can't overwrite each other's queries and
+registering a query doesn't depend on the size of the catalogue.
+QueryCatalogue.compact() merges the segments back into the catalogue object.
+"""
+
+import json
+import base64
+import hashlib
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+
+import lazy_clients
+
+# Attributes compared by DatabaseQuery.__eq__()
+QUERY_FIELDS = (
+                'name',
+                'cypher',
+                'write_transaction',
+                'publish_to',
+                'aggregate_results',
+                'returns',
+                'required_parameters',
+                'active',
+                'job_request')
+
+# Attempts to read a consistent generation of the catalogue
+MAX_REFRESH_ATTEMPTS = 3
+
+# Segment objects are stored under the catalogue path plus this suffix
+SEGMENT_SUFFIX = '.d/'
+# Segments downloaded or deleted at the same time
+SEGMENT_THREADS = 16
+
+
+def get_query_digest(query):
+    """Content digest of a DatabaseQuery.
+
+    Two queries have the same digest when DatabaseQuery.__eq__() considers
+    them equal. Attributes missing from queries loaded from older catalogue
+    documents are treated as None.
+
+    Args:
+        query (trellis.DatabaseQuery): Query to digest.
+    Returns:
+        (str): Hex SHA-256 digest.
+    """
+    fields = {field: getattr(query, field, None) for field in QUERY_FIELDS}
+    serialized = json.dumps(fields, sort_keys=True, default=repr)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+
+def _new_checksum(data=b''):
+    # google-crc32c is installed with google-cloud-storage
+    import google_crc32c
+    return google_crc32c.Checksum(data)
+
+
+def _encode_checksum(checksum):
+    # Same encoding as Blob.crc32c
+    return base64.b64encode(checksum.digest()).decode('utf-8')
+
+
+class QueryCatalogue:
+
+    def __init__(self, bucket_name, blob_name, storage_client=lazy_clients.STORAGE_CLIENT):
+        """
+        Args:
+            bucket_name (str): Bucket of the catalogue object.
+            blob_name (str): Path of the catalogue YAML document.
+            storage_client (google.cloud.storage.Client): Client used
+                to read the catalogue.
+        """
+        self.bucket_name = bucket_name
+        self.blob_name = blob_name
+        self.storage_client = storage_client
+        self.segment_prefix = f"{blob_name}{SEGMENT_SUFFIX}" if blob_name else None
+
+        # {query name: {digest: query}}
+        self._queries = {}
+        self._lock = threading.RLock()
+
+        # State of the object generation the index was built from
+        self.generation = None
+        self.size = 0
+        self._checksum = None
+        # {segment object name: generation} of indexed segments
+        self._segments = {}
+
+        self.full_loads = 0
+        self.incremental_loads = 0
+        self.segment_loads = 0
+
+    @classmethod
+    def from_document(cls, document):
+        """Index a catalogue document that has already been downloaded.
+
+        Args:
+            document (bytes, str): Multi-document query YAML.
+        Returns:
+            (QueryCatalogue): Catalogue that is never refreshed.
+        """
+        catalogue = cls(bucket_name=None, blob_name=None, storage_client=None)
+        catalogue._add_document(document)
+        return catalogue
+
+    def __len__(self):
+        return sum(len(digests) for digests in self._queries.values())
+
+    def __contains__(self, query):
+        return get_query_digest(query) in self._queries.get(query.name, {})
+
+    def has_name(self, name):
+        return name in self._queries
+
+    def get(self, name):
+        """
+        Returns:
+            (list): Catalogued queries with this name.
+        """
+        return list(self._queries.get(name, {}).values())
+
+    @property
+    def segment_count(self):
+        return len(self._segments)
+
+    def _add_query(self, query):
+        self._queries.setdefault(query.name, {})[get_query_digest(query)] = query
+
+    def _add_document(self, document):
+        for query in yaml.load_all(document, Loader=yaml.FullLoader):
+            if query is None:
+                continue
+            self._add_query(query)
+
+    def _load(self, blob):
+        content = blob.download_as_bytes(if_generation_match=blob.generation)
+        self._queries = {}
+        # Segments are indexed again on top of the new catalogue
+        self._segments = {}
+        self._add_document(content)
+        self._checksum = _new_checksum(content)
+        self.full_loads += 1
+
+    def _load_appended(self, blob):
+        """Parse only the bytes appended since the indexed generation.
+
+        Returns:
+            (bool): False if the new generation does not extend the
+                indexed one and the whole catalogue has to be loaded.
+        """
+        appended = blob.download_as_bytes(start=self.size, if_generation_match=blob.generation)
+        # New documents have to start at a document boundary
+        if not appended.lstrip().startswith(b'---'):
+            return False
+        checksum = self._checksum.copy()
+        checksum.update(appended)
+        if blob.crc32c and _encode_checksum(checksum) != blob.crc32c:
+            return False
+        self._add_document(appended)
+        self._checksum = checksum
+        self.incremental_loads += 1
+        return True
+
+    def _refresh_catalogue(self, bucket):
+        """Update the index from the catalogue object.
+
+        Returns:
+            (bool): Whether the index changed.
+        """
+        from google.api_core import exceptions
+
+        for attempt in range(MAX_REFRESH_ATTEMPTS):
+            blob = bucket.get_blob(self.blob_name)
+            if blob is None:
+                changed = self.generation is not None
+                if changed:
+                    self._queries, self._segments = {}, {}
+                self.generation, self.size, self._checksum = None, 0, None
+                return changed
+            if blob.generation == self.generation:
+                return False
+            try:
+                if not (self.generation and blob.size > self.size and self._load_appended(blob)):
+                    self._load(blob)
+            except exceptions.PreconditionFailed:
+                # Overwritten while reading; read the newest generation
+                logging.info(f"> db-query: Query catalogue {self.blob_name} changed while loading; retrying.")
+                continue
+            self.generation, self.size = blob.generation, blob.size
+            return True
+        raise RuntimeError(
+                           f"> db-query: Could not read a consistent generation of {self.blob_name} " +
+                           f"in {MAX_REFRESH_ATTEMPTS} attempts.")
+
+    @staticmethod
+    def _download_segment(blob):
+        from google.api_core import exceptions
+        try:
+            return blob.download_as_bytes(if_generation_match=blob.generation)
+        except (exceptions.NotFound, exceptions.PreconditionFailed):
+            return None
+
+    def _list_segments(self):
+        return {
+                blob.name: blob for blob in self.storage_client.list_blobs(
+                                                                           self.bucket_name,
+                                                                           prefix=self.segment_prefix)}
+
+    def _load_segments(self, listed):
+        """Download listed segments that are not indexed yet, in parallel.
+
+        Args:
+            listed (dict): Segment blobs by name, from _list_segments().
+        Returns:
+            (tuple): (changed, complete) where complete is False if a
+                listed segment was removed before it could be read.
+        """
+        # Segments no longer listed have been merged into the catalogue
+        self._segments = {name: generation for name, generation in self._segments.items() if name in listed}
+        new_segments = [blob for name, blob in listed.items() if self._segments.get(name) != blob.generation]
+        if not new_segments:
+            return False, True
+
+        with ThreadPoolExecutor(max_workers=min(SEGMENT_THREADS, len(new_segments))) as executor:
+            documents = list(executor.map(self._download_segment, new_segments))
+
+        complete = True
+        for blob, document in zip(new_segments, documents):
+            if document is None:
+                complete = False
+                continue
+            self._add_document(document)
+            self._segments[blob.name] = blob.generation
+            self.segment_loads += 1
+        return True, complete
+
+    def refresh(self):
+        """Update the index from the catalogue object and its segments.
+
+        The catalogue object is only downloaded when its generation has
+        changed and only new segments are downloaded.
+
+        Returns:
+            (bool): Whether the index changed.
+        """
+        with self._lock:
+            bucket = self.storage_client.bucket(self.bucket_name)
+            changed = False
+            for attempt in range(MAX_REFRESH_ATTEMPTS):
+                # Compaction writes the catalogue before deleting segments,
+                # so listing segments first can't miss compacted queries
+                listed = self._list_segments()
+                changed = self._refresh_catalogue(bucket) or changed
+                segments_changed, complete = self._load_segments(listed)
+                changed = changed or segments_changed
+                if complete:
+                    return changed
+                # Segments were compacted after they were listed; the
+                # catalogue object may have been read before compaction
+                logging.info(f"> db-query: Query catalogue {self.blob_name} compacted while loading; retrying.")
+            raise RuntimeError(
+                               f"> db-query: Could not read a consistent version of {self.blob_name} " +
+                               f"in {MAX_REFRESH_ATTEMPTS} attempts.")
+
+    def register(self, query):
+        """Add a query to the catalogue.
+
+        Writes one segment object named by the query digest. The object is
+        only created if it does not exist yet, so registering the same query
+        from several instances writes it once and nothing is overwritten.
+
+        Args:
+            query (trellis.DatabaseQuery): Query to register.
+        Returns:
+            (bool): False if the segment had already been written.
+        """
+        from google.api_core import exceptions
+
+        segment_name = f"{self.segment_prefix}{get_query_digest(query)}.yaml"
+        blob = self.storage_client.bucket(self.bucket_name).blob(segment_name)
+        try:
+            blob.upload_from_string("--- " + yaml.dump(query), if_generation_match=0)
+        except exceptions.PreconditionFailed:
+            # Registered by another instance
+            written = False
+        else:
+            written = True
+
+        with self._lock:
+            self._add_query(query)
+            if written:
+                self._segments[segment_name] = blob.generation
+        return written
+
+    def compact(self):
+        """Merge all segments into the catalogue object and delete them.
+
+        The catalogue object is only replaced if it hasn't changed since it
+        was indexed. Segments registered during compaction are kept.
+
+        Returns:
+            (int): Number of merged segments, or None if the catalogue
+                object was changed by another instance.
+        """
+        from google.api_core import exceptions
+
+        with self._lock:
+            self.refresh()
+            segments = dict(self._segments)
+            if not segments:
+                return 0
+
+            document = ''.join(
+                               "--- " + yaml.dump(query)
+                               for digests in self._queries.values()
+                               for query in digests.values())
+            content = document.encode('utf-8')
+            bucket = self.storage_client.bucket(self.bucket_name)
+            blob = bucket.blob(self.blob_name)
+            try:
+                blob.upload_from_string(content, if_generation_match=self.generation or 0)
+            except exceptions.PreconditionFailed:
+                logging.warning(f"> db-query: Query catalogue {self.blob_name} changed during compaction.")
+                return None
+
+            def delete_segment(item):
+                name, generation = item
+                try:
+                    bucket.blob(name).delete(if_generation_match=generation)
+                except (exceptions.NotFound, exceptions.PreconditionFailed):
+                    pass
+
+            with ThreadPoolExecutor(max_workers=min(SEGMENT_THREADS, len(segments))) as executor:
+                list(executor.map(delete_segment, segments.items()))
+
+            self.generation, self.size = blob.generation, len(content)
+            self._checksum = _new_checksum(content)
+            self._segments = {}
+            logging.info(f"> db-query: Merged {len(segments)} segments into {self.blob_name}.")
+            return len(segments)
+
+    def contains(self, query, refresh=True):
+        """Check whether a query is catalogued.
+
+        The in-memory index is checked first; the catalogue object is only
+        checked for a new generation when the query is not found.
+
+        Args:
+            query (trellis.DatabaseQuery): Query to look for.
+            refresh (bool): Check the catalogue object for a new
+                generation before reporting a missing query.
+        Returns:
+            (bool): Whether an equal query is catalogued.
+        """
+        if refresh and query not in self:
+            self.refresh()
+
+        if query in self:
+            return True
+        if self.has_name(query.name):
+            logging.warning(
+                            f"> db-query: Found catalogued query named {query.name} " +
+                             "but does not match current query.")
+        return False
@@ -0,0 +1,314 @@
+"""Collapse repeated requests for redundant queries.
+
+Queries marked `redundant: true` in database-queries.yaml produce the
+same result whichever request runs them: every Fastq of a sample
+requests the same sample-wide relate query. With a coalescing window,
+the first request for a query name and parameters claims the key, waits
+for the window and then runs the query once. Identical requests that
+arrive while the key is claimed are covered by that execution and are
+skipped.
+
+The claim is released before the query runs, not after, so a request
+arriving while the query is running gets an execution of its own and
+sees every node that existed when it was sent. Claims older than twice
+the window are taken over, in case the instance holding them stopped.
+
+Claims are kept in memory, which coalesces the requests handled by one
+instance, or in a SQLite database shared by several instances.
+
+The db-query worker receives requests concurrently and groups identical
+requests with RequestGroups instead: requests received while the first
+one waits for its batch are answered by its execution, and are acked or
+nacked with it.
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+
+from collections import Counter
+
+# Claims kept in memory before expired ones are removed
+MAX_MEMORY_CLAIMS = 10000
+
+
+def is_redundant(query):
+    """
+    Args:
+        query (trellis.DatabaseQuery): Predefined query.
+    Returns:
+        (bool): Whether the query is marked redundant.
+    """
+    return str(getattr(query, 'redundant', False)).lower() == 'true'
+
+
+def get_key(query_name, parameters):
+    """
+    Args:
+        query_name (str): Query name.
+        parameters (dict): Query parameters.
+    Returns:
+        (str): Query name and digest of the parameters.
+    """
+    parameters_json = json.dumps(parameters, sort_keys=True, default=str)
+    return f"{query_name}:{hashlib.sha256(parameters_json.encode('utf-8')).hexdigest()}"
+
+
+class MemoryBackend:
+
+    def __init__(self, max_claims=MAX_MEMORY_CLAIMS):
+        """Claims held by this instance."""
+        self.max_claims = max_claims
+        self._claims = {}
+        self._lock = threading.Lock()
+
+    def claim(self, key, expires, now):
+        """Claim a key that is not claimed or whose claim has expired.
+
+        Args:
+            key (str): Coalescing key.
+            expires (float): Time the new claim expires.
+            now (float): Current time.
+        Returns:
+            (bool): True if the key was claimed.
+        """
+        with self._lock:
+            if self._claims.get(key, now) > now:
+                return False
+            if len(self._claims) >= self.max_claims:
+                self._claims = {key: value for key, value in self._claims.items() if value > now}
+            self._claims[key] = expires
+            return True
+
+    def release(self, key, expires):
+        """Release a claim, unless it has been taken over since."""
+        with self._lock:
+            if self._claims.get(key) == expires:
+                del self._claims[key]
+
+
+class SqliteBackend:
+
+    def __init__(self, path):
+        """Claims in a SQLite database shared by several instances.
+
+        Args:
+            path (str): Path to the database file.
+        """
+        # Only needed with a shared backend; keep it out of cold starts
+        import sqlite3
+
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS coalesced_queries ("
+            "key TEXT PRIMARY KEY, "
+            "expires REAL NOT NULL)")
+
+    def claim(self, key, expires, now):
+        with self._lock:
+            # Inserts, or takes over an expired claim, in one statement
+            cursor = self._connection.execute(
+                "INSERT INTO coalesced_queries (key, expires) VALUES (?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET expires = excluded.expires "
+                "WHERE coalesced_queries.expires <= ?",
+                (key, expires, now))
+            return cursor.rowcount == 1
+
+    def release(self, key, expires):
+        with self._lock:
+            self._connection.execute(
+                "DELETE FROM coalesced_queries WHERE key = ? AND expires = ?", (key, expires))
+
+    def close(self):
+        self._connection.close()
+
+
+class QueryCoalescer:
+
+    def __init__(self, window, backend=None, clock=time.time, sleep=time.sleep):
+        """Run one of the identical requests received within a window.
+
+        A backend is any object with claim(key, expires, now) -> bool and
+        release(key, expires) methods, like SqliteBackend. The clock
+        has to agree between the instances sharing a backend.
+
+        Args:
+            window (float): Seconds to wait for identical requests.
+            backend (object): Claim store. Default: MemoryBackend.
+            clock (function): Current time in seconds.
+            sleep (function): Waits a number of seconds.
+        """
+        self.window = window
+        self.backend = backend or MemoryBackend()
+        self.clock = clock
+        self.sleep = sleep
+
+        self.executions = Counter()
+        self.saved = Counter()
+        self._lock = threading.Lock()
+
+    def coalesce(self, query_name, parameters):
+        """Wait for identical requests or skip this one.
+
+        Args:
+            query_name (str): Query name.
+            parameters (dict): Query parameters.
+        Returns:
+            (bool): True if the query should run now, False if another
+                request will run it.
+        """
+        key = get_key(query_name, parameters)
+        now = self.clock()
+        expires = now + 2 * self.window
+        if not self.backend.claim(key, expires, now):
+            with self._lock:
+                self.saved[query_name] += 1
+            return False
+
+        try:
+            self.sleep(self.window)
+        finally:
+            self.backend.release(key, expires)
+        with self._lock:
+            self.executions[query_name] += 1
+        return True
+
+    def stats(self):
+        """
+        Returns:
+            (dict): Executions and skipped (saved) executions, in total
+                and by query name.
+        """
+        with self._lock:
+            return _get_stats(self.executions, self.saved)
+
+
+def _get_stats(executions, saved):
+    return {
+            'executions': sum(executions.values()),
+            'saved': sum(saved.values()),
+            'queries': {
+                        name: {'executions': executions[name], 'saved': saved[name]}
+                        for name in executions.keys() | saved.keys()},
+    }
+
+
+class RequestGroup:
+
+    def __init__(self, groups, query_name, message):
+        """Identical requests answered by the first one.
+
+        Acks and nacks the messages of all requests together.
+
+        Args:
+            groups (RequestGroups): Groups this group belongs to.
+            query_name (str): Query name.
+            message (google.cloud.pubsub_v1.subscriber.message.Message):
+                Message of the request that runs.
+        """
+        self.groups = groups
+        self.query_name = query_name
+        self.message = message
+        self.duplicates = []
+
+    @property
+    def message_id(self):
+        return self.message.message_id
+
+    def ack(self):
+        self.message.ack()
+        for message in self.duplicates:
+            message.ack()
+        self.groups.record_saved(self.query_name, len(self.duplicates))
+
+    def nack(self):
+        # Pub/Sub redelivers all of them
+        self.message.nack()
+        for message in self.duplicates:
+            message.nack()
+
+
+class RequestGroups:
+
+    def __init__(self):
+        """Group identical requests of redundant queries until they run."""
+        self._groups = {}
+        self._lock = threading.Lock()
+        self.executions = Counter()
+        self.saved = Counter()
+
+    def add(self, query_name, parameters, message):
+        """Add a request to the waiting group of identical requests.
+
+        Args:
+            query_name (str): Query name.
+            parameters (dict): Query parameters.
+            message (google.cloud.pubsub_v1.subscriber.message.Message):
+                Message of the request.
+        Returns:
+            (RequestGroup): New group to run in place of the message, or
+                None if a waiting group answers the request.
+        """
+        key = get_key(query_name, parameters)
+        with self._lock:
+            group = self._groups.get(key)
+            if group:
+                group.duplicates.append(message)
+                return None
+            group = RequestGroup(self, query_name, message)
+            self._groups[key] = group
+            return group
+
+    def close(self, group, parameters):
+        """Answer requests received from now on with another execution.
+
+        Called when the group starts running, so later requests see
+        every node that existed when they were sent.
+
+        Args:
+            group (RequestGroup): Group that runs.
+            parameters (dict): Query parameters.
+        """
+        key = get_key(group.query_name, parameters)
+        with self._lock:
+            if self._groups.get(key) is group:
+                del self._groups[key]
+            self.executions[group.query_name] += 1
+
+    def record_saved(self, query_name, count):
+        """Count requests answered by the execution of another."""
+        with self._lock:
+            self.saved[query_name] += count
+
+    def stats(self):
+        """
+        Returns:
+            (dict): Executions and skipped (saved) executions, in total
+                and by query name.
+        """
+        with self._lock:
+            return _get_stats(self.executions, self.saved)
+
+
+def get_coalescer():
+    """Create a coalescer configured from environment variables.
+
+    REDUNDANT_QUERY_WINDOW: seconds to wait for identical requests of
+        redundant queries. Coalescing is disabled when it is not set or 0.
+    REDUNDANT_QUERY_DATABASE: path to a SQLite database shared by
+        instances. Default: claims are kept in memory.
+
+    Returns:
+        (QueryCoalescer): Coalescer, or None if disabled.
+    """
+    window = float(os.environ.get('REDUNDANT_QUERY_WINDOW') or 0)
+    if not window:
+        return None
+    database = os.environ.get('REDUNDANT_QUERY_DATABASE')
+    backend = SqliteBackend(database) if database else MemoryBackend()
+    return QueryCoalescer(window, backend=backend)
@@ -0,0 +1,298 @@
+"""Per-query latency histograms, update counters and a slow-query log.
+
+QueryProfiler keeps, for each query name, histograms of the time until
+the result was available, the time to consume it and the total time of
+the request's query, plus the sums of the result summary counters.
+
+Queries slower than the threshold, and a random sample of the rest, are
+run again with PROFILE to capture the rows and database hits of every
+plan operator. The operators go into the slow-query log together with
+the parameters of the request, so a catalogue query that degrades as the
+graph grows can be traced to its plan. Write queries are profiled in a
+transaction that is rolled back, so profiling never changes the graph.
+Queries that CREATE entities are only planned with EXPLAIN: running them
+again with the same parameters would fail on uniqueness constraints.
+Each query name is profiled at most once per PROFILE_INTERVAL seconds,
+and profiles run through the admission controller, so profiling adds
+little load when the database is already slow. Their latency is not
+reported to the controller, since PROFILE is slower than the query.
+"""
+
+import json
+import time
+import bisect
+import random
+import logging
+import threading
+
+from collections import deque
+
+import admission
+
+# Upper bounds of the histogram buckets in milliseconds; the last bucket
+# holds everything slower
+HISTOGRAM_BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)
+
+# neo4j.SummaryCounters attributes that are summed per query
+COUNTER_NAMES = (
+                 'nodes_created',
+                 'nodes_deleted',
+                 'relationships_created',
+                 'relationships_deleted',
+                 'properties_set',
+                 'labels_added',
+                 'labels_removed')
+
+LATENCY_NAMES = ('available', 'consumed', 'total')
+
+# Slow-query log entries kept in memory
+SLOW_QUERY_LOG_SIZE = 50
+
+# Least seconds between profiles of the same query
+PROFILE_INTERVAL = 600
+
+
+class LatencyHistogram:
+
+    def __init__(self, bounds=HISTOGRAM_BOUNDS_MS):
+        """Fixed-bucket histogram of latencies in milliseconds."""
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, latency_ms):
+        self.buckets[bisect.bisect_left(self.bounds, latency_ms)] += 1
+        self.count += 1
+        self.total_ms += latency_ms
+        self.max_ms = max(self.max_ms, latency_ms)
+
+    def percentile(self, percent):
+        """
+        Args:
+            percent (float): Percentile, e.g. 99.
+        Returns:
+            (float): Upper bound of the bucket holding the percentile,
+                or the largest latency for the last bucket.
+        """
+        if not self.count:
+            return None
+        rank = percent / 100 * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.buckets):
+            seen += bucket_count
+            if seen >= rank and bucket_count:
+                if index < len(self.bounds):
+                    return min(self.bounds[index], self.max_ms)
+                return self.max_ms
+        return self.max_ms
+
+    def to_dict(self):
+        return {
+                'count': self.count,
+                'meanMs': round(self.total_ms / self.count, 1) if self.count else None,
+                'p50Ms': self.percentile(50),
+                'p95Ms': self.percentile(95),
+                'p99Ms': self.percentile(99),
+                'maxMs': round(self.max_ms, 1),
+        }
+
+
+class QueryStats:
+
+    def __init__(self):
+        """Latencies and summed update counters of one query name."""
+        self.latencies = {name: LatencyHistogram() for name in LATENCY_NAMES}
+        self.counters = dict.fromkeys(COUNTER_NAMES, 0)
+        self.profiles = 0
+
+    def to_dict(self):
+        stats = {name: histogram.to_dict() for name, histogram in self.latencies.items()}
+        stats['counters'] = dict(self.counters)
+        stats['profiles'] = self.profiles
+        return stats
+
+
+def get_profile_operators(profile):
+    """
+    Args:
+        profile (dict): Profiled plan of a query summary, i.e. summary.profile.
+    Returns:
+        (list): Operators in plan order, each with its rows and database hits.
+    """
+    operators = []
+
+    def add_operators(plan, depth):
+        if not isinstance(plan, dict):
+            plan = {
+                    'operatorType': plan.operator_type,
+                    'args': plan.arguments,
+                    'dbHits': getattr(plan, 'db_hits', None),
+                    'rows': getattr(plan, 'rows', None),
+                    'children': plan.children}
+        args = plan.get('args') or {}
+        operators.append({
+                          'operator': plan.get('operatorType', '').split('@')[0],
+                          'details': args.get('Details', ''),
+                          'rows': plan.get('rows', args.get('Rows')),
+                          'dbHits': plan.get('dbHits', args.get('DbHits')),
+                          'depth': depth})
+        for child in plan.get('children') or []:
+            add_operators(child, depth + 1)
+
+    if profile:
+        add_operators(profile, 0)
+    return operators
+
+
+def _profile_transaction_function(tx, cypher, parameters):
+    return tx.run(cypher, parameters).consume()
+
+
+def profile_query(driver, query, parameters):
+    """Run a query with PROFILE without keeping its changes.
+
+    Queries that create entities are planned with EXPLAIN instead.
+
+    Args:
+        driver (neo4j.Driver): Database driver.
+        query (trellis.DatabaseQuery): Query to profile.
+        parameters (dict): Parameters of the slow request.
+    Returns:
+        (neo4j.ResultSummary): Summary with the profiled plan, or the
+            plan of a query that creates entities.
+    """
+    if admission.CREATE_PATTERN.search(query.cypher):
+        cypher = f"EXPLAIN {query.cypher}"
+    else:
+        cypher = f"PROFILE {query.cypher}"
+    with driver.session() as session:
+        if not query.write_transaction:
+            return session.read_transaction(_profile_transaction_function, cypher, parameters)
+        tx = session.begin_transaction()
+        try:
+            return _profile_transaction_function(tx, cypher, parameters)
+        finally:
+            tx.rollback()
+
+
+class QueryProfiler:
+
+    def __init__(
+                 self,
+                 threshold_ms=300,
+                 sample_rate=0.0,
+                 slow_log_size=SLOW_QUERY_LOG_SIZE,
+                 profile_interval=PROFILE_INTERVAL,
+                 random=random.random,
+                 clock=time.monotonic):
+        """Collect query statistics and profile slow or sampled queries.
+
+        Args:
+            threshold_ms (float): Queries whose result takes longer to be
+                available are profiled.
+            sample_rate (float): Fraction of other queries to profile.
+            slow_log_size (int): Slow-query log entries kept in memory.
+            profile_interval (float): Least seconds between profiles of
+                the same query.
+        """
+        self.threshold_ms = threshold_ms
+        self.sample_rate = sample_rate
+        self.profile_interval = profile_interval
+        self.random = random
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self.queries = {}
+        self.slow_queries = deque(maxlen=slow_log_size)
+        # Time of the last profile by query name
+        self._profiled_at = {}
+
+    def record(self, query_name, result_summary, total_ms=None):
+        """Add the latencies and counters of a query result.
+
+        Args:
+            query_name (str): Catalogue or custom query name.
+            result_summary (neo4j.ResultSummary): Summary of the result.
+            total_ms (float): Time the request spent on the query,
+                including waiting for a connection and retries.
+        Returns:
+            (bool): Whether the query should be profiled, i.e. it was
+                slow or sampled and not profiled within profile_interval.
+        """
+        available_ms = result_summary.result_available_after or 0
+        consumed_ms = result_summary.result_consumed_after or 0
+        if total_ms is None:
+            total_ms = available_ms + consumed_ms
+        counters = result_summary.counters
+        with self._lock:
+            stats = self.queries.setdefault(query_name, QueryStats())
+            stats.latencies['available'].record(available_ms)
+            stats.latencies['consumed'].record(consumed_ms)
+            stats.latencies['total'].record(total_ms)
+            for name in COUNTER_NAMES:
+                stats.counters[name] += getattr(counters, name, 0) or 0
+            if not (available_ms > self.threshold_ms or self.random() < self.sample_rate):
+                return False
+            now = self.clock()
+            profiled_at = self._profiled_at.get(query_name)
+            if profiled_at is not None and now - profiled_at < self.profile_interval:
+                return False
+            self._profiled_at[query_name] = now
+            return True
+
+    def profile(self, driver, query, parameters, result_summary, admission_controller=None):
+        """Profile a query and add it to the slow-query log.
+
+        Args:
+            driver (neo4j.Driver): Database driver.
+            query (trellis.DatabaseQuery): Query that was run.
+            parameters (dict): Parameters of the request.
+            result_summary (neo4j.ResultSummary): Summary of the original run.
+            admission_controller (admission.AdmissionController): Runs the
+                profile within the query limit, without retries or
+                reporting its latency.
+        Returns:
+            (dict): Slow-query log entry, or None if profiling failed.
+        """
+        start = time.perf_counter()
+        try:
+            if admission_controller:
+                profile_summary = admission_controller.run(
+                                                           profile_query,
+                                                           driver,
+                                                           query,
+                                                           parameters,
+                                                           latency = lambda summary: None,
+                                                           retryable = lambda error: False)
+            else:
+                profile_summary = profile_query(driver, query, parameters)
+        except Exception as error:
+            logging.warning(f"> db-query: Could not profile query '{query.name}': {error}.")
+            return None
+        operators = get_profile_operators(profile_summary.profile or getattr(profile_summary, 'plan', None))
+        entry = {
+                 'queryName': query.name,
+                 'parameters': parameters,
+                 'resultAvailableAfter': result_summary.result_available_after,
+                 'resultConsumedAfter': result_summary.result_consumed_after,
+                 'profileMs': round((time.perf_counter() - start) * 1000, 1),
+                 'dbHits': sum(operator['dbHits'] or 0 for operator in operators),
+                 # False for queries that were only planned with EXPLAIN
+                 'profiled': profile_summary.profile is not None,
+                 'operators': operators,
+        }
+        with self._lock:
+            self.queries.setdefault(query.name, QueryStats()).profiles += 1
+            self.slow_queries.append(entry)
+        logging.warning(f"> db-query: Slow query log: {json.dumps(entry, default=str)}")
+        return entry
+
+    def stats(self):
+        """
+        Returns:
+            (dict): Latency histograms and counters by query name.
+        """
+        with self._lock:
+            return {name: stats.to_dict() for name, stats in self.queries.items()}
@@ -0,0 +1,248 @@
+"""Stream query results to Pub/Sub while the query is running.
+
+Queries with `stream_results: true` in database-queries.yaml are not
+collected into a neo4j.graph.Graph. Records are read one at a time
+inside the transaction, each new node or relationship is converted to
+its response message, and the message is put on a bounded queue that a
+publisher thread drains. When the queue is full, reading records waits
+for the publisher, so memory does not grow with the size of the result.
+Only the IDs of published entities are kept, to publish each one once.
+
+The result summary is not known until the last record has been read,
+so streamed messages carry the query and its parameters in place of
+the summary. Messages are published before the transaction ends, so
+only read queries can stream their results: subscribers of a write
+query would act on changes that are not committed yet, and may never
+be. Messages already published are sent again when a failed request
+is retried.
+"""
+
+import queue
+import logging
+import threading
+
+from neo4j.graph import Node, Relationship, Path
+
+import trellisdata as trellis
+
+import fanout
+
+# Messages converted but not yet handed to the Pub/Sub client
+STREAM_QUEUE_SIZE = 100
+
+_CLOSE = object()
+
+
+def returns_relationships(query):
+    """
+    Args:
+        query (trellis.DatabaseQuery): Query with a returns pattern.
+    Returns:
+        (bool): Whether the query returns relationship triples, in which
+            case only relationships are published, as for a Graph.
+    """
+    returns = query.returns
+    if isinstance(returns, dict):
+        returns = [returns]
+    return any(isinstance(pattern, dict) and pattern.get('relationship') for pattern in returns or [])
+
+
+def check_stream_results(query):
+    """Check that a query streaming its results doesn't write.
+
+    Args:
+        query (trellis.DatabaseQuery): Predefined query.
+    Raises:
+        ValueError: If the query has stream_results and write_transaction set.
+    """
+    if getattr(query, 'stream_results', False) and query.write_transaction:
+        raise ValueError(
+                         f"> db-query: Query {query.name} writes to the database and can't stream results " +
+                         "that are published before the transaction commits.")
+
+
+def get_entity_id(entity):
+    """
+    Args:
+        entity (neo4j.graph.Node|neo4j.graph.Relationship): Returned entity.
+    Returns:
+        (str|int): Element ID, or the integer ID with 4.x drivers that
+            don't have element IDs. Newer servers may not set the latter.
+    """
+    element_id = getattr(entity, 'element_id', None)
+    if element_id is not None:
+        return element_id
+    return entity.id
+
+
+class EntityStream:
+
+    def __init__(self, relationships):
+        """Find nodes or relationships in records that were not seen before.
+
+        Args:
+            relationships (bool): Yield relationships instead of nodes.
+        """
+        self.relationships = relationships
+        self.seen = set()
+
+    def get_entities(self, value):
+        if isinstance(value, Path):
+            yield from (value.relationships if self.relationships else value.nodes)
+        elif isinstance(value, Relationship):
+            if self.relationships:
+                yield value
+            else:
+                yield value.start_node
+                yield value.end_node
+        elif isinstance(value, Node):
+            if not self.relationships:
+                yield value
+        elif isinstance(value, (list, tuple)):
+            for item in value:
+                yield from self.get_entities(item)
+
+    def new_entities(self, record):
+        """
+        Args:
+            record (neo4j.Record): Returned record.
+        Yields:
+            (neo4j.graph.Node|neo4j.graph.Relationship): Entities not seen before.
+        """
+        for value in record.values():
+            for entity in self.get_entities(value):
+                entity_id = get_entity_id(entity)
+                if entity_id not in self.seen:
+                    self.seen.add(entity_id)
+                    yield entity
+
+
+class StreamingResponseWriter(trellis.QueryResponseWriter):
+
+    def __init__(self, *, sender, seed_id, previous_event_id, query, parameters):
+        """Create query response messages one entity at a time.
+
+        Args:
+            sender (str): Function name.
+            seed_id (int): Seed event ID of the request.
+            previous_event_id (int): Event ID of the request.
+            query (trellis.DatabaseQuery): Query being run.
+            parameters (dict): Query parameters.
+        """
+        super().__init__(
+                         sender = sender,
+                         seed_id = seed_id,
+                         previous_event_id = previous_event_id,
+                         query_name = query.name,
+                         result_summary = None,
+                         graph = None)
+        self.summary_dict = {
+                             'query': query.cypher,
+                             'parameters': parameters,
+                             'streamed': True}
+
+    def get_entity_message(self, entity):
+        """
+        Args:
+            entity (neo4j.graph.Node|neo4j.graph.Relationship): Returned entity.
+        Returns:
+            (dict): Message in the format of generate_separate_entity_jsons().
+        """
+        if isinstance(entity, Relationship):
+            nodes, relationship = [], self._get_relationship_dict(entity)
+        else:
+            nodes, relationship = [self._get_node_dict(entity)], {}
+        message = self.format_json_header()
+        message['body'] = {
+                           'queryName': self.query_name,
+                           'jobRequest': self.job_request,
+                           'nodes': nodes,
+                           'relationship': relationship,
+                           'resultSummary': self.summary_dict}
+        return message
+
+
+class StreamPublisher:
+
+    def __init__(self, publisher, project_id, topics, queue_size=STREAM_QUEUE_SIZE):
+        """Publish messages to all topics from a bounded queue.
+
+        Args:
+            publisher (pubsub.PublisherClient): Pub/Sub client.
+            project_id (str): Google Cloud project ID.
+            topics (list): Topic names.
+            queue_size (int): Messages waiting to be published.
+        """
+        self.publisher = publisher
+        self.topic_paths = {topic: publisher.topic_path(project_id, topic) for topic in topics}
+        self.published_message_counts = dict.fromkeys(self.topic_paths, 0)
+        self.failures = dict.fromkeys(self.topic_paths, 0)
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        # Publish futures are not kept; callbacks count the results
+        self._outstanding = dict.fromkeys(self.topic_paths, 0)
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._publish_messages, daemon=True)
+        self._thread.start()
+
+    def put(self, message):
+        """Queue a message, waiting while the queue is full."""
+        self._queue.put(message)
+
+    def _on_published(self, topic, future):
+        with self._condition:
+            if future.exception():
+                logging.error(f"> db-query: Could not publish message to {topic}: {future.exception()}.")
+                self.failures[topic] += 1
+            else:
+                self.published_message_counts[topic] += 1
+            self._outstanding[topic] -= 1
+            self._condition.notify_all()
+
+    def _publish_messages(self):
+        while True:
+            message = self._queue.get()
+            if message is _CLOSE:
+                return
+            # Any error is counted and the queue is still drained,
+            # so the query reading records doesn't block
+            try:
+                data = fanout.encode_message(message)
+            except Exception as error:
+                logging.error(f"> db-query: Could not encode message: {error}.")
+                with self._condition:
+                    for topic in self.failures:
+                        self.failures[topic] += 1
+                continue
+            for topic, topic_path in self.topic_paths.items():
+                with self._condition:
+                    self._outstanding[topic] += 1
+                try:
+                    future = self.publisher.publish(topic_path, data=data)
+                except Exception as error:
+                    logging.error(f"> db-query: Could not publish message to {topic}: {error}.")
+                    with self._condition:
+                        self._outstanding[topic] -= 1
+                        self.failures[topic] += 1
+                    continue
+                future.add_done_callback(lambda future, topic=topic: self._on_published(topic, future))
+
+    def close(self, deadline=fanout.PUBLISH_DEADLINE):
+        """Publish the queued messages and wait for the results.
+
+        Args:
+            deadline (float): Seconds to wait for the publish results.
+        Returns:
+            (dict): Number of messages published to each topic.
+            (dict): Number of messages that failed or timed out, by topic.
+        """
+        self._queue.put(_CLOSE)
+        self._thread.join()
+        with self._condition:
+            if not self._condition.wait_for(lambda: not any(self._outstanding.values()), timeout=deadline):
+                logging.error(
+                              f"> db-query: {sum(self._outstanding.values())} messages were not published " +
+                              f"within {deadline} seconds.")
+            # Results arriving after the deadline are not counted
+            failures = {topic: count + self._outstanding[topic] for topic, count in self.failures.items()}
+            return dict(self.published_message_counts), failures
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+import threading
+
+from types import SimpleNamespace
+from unittest import TestCase
+
+from neo4j.exceptions import ServiceUnavailable, TransientError, ClientError
+
+import admission
+
+
+class FakeClock:
+
+	def __init__(self):
+		self.now = 0.0
+
+	def __call__(cls):
+		return cls.now
+
+	def sleep(cls, seconds):
+		cls.now += seconds
+
+
+class TestAIMDLimiter(TestCase):
+
+	def test_additive_increase(cls):
+		limiter = admission.AIMDLimiter(initial_limit=2, max_limit=3)
+		for _ in range(3):
+			assert limiter.acquire(timeout=0)
+			assert limiter.acquire(timeout=0)
+			limiter.release(latency_ms=10)
+			limiter.release(latency_ms=10)
+		assert limiter.limit == 3
+
+	def test_no_increase_when_unused(cls):
+		limiter = admission.AIMDLimiter(initial_limit=10)
+		for _ in range(5):
+			limiter.acquire(timeout=0)
+			limiter.release(latency_ms=10)
+		assert limiter.limit == 10
+
+	def test_multiplicative_decrease(cls):
+		limiter = admission.AIMDLimiter(initial_limit=10, min_limit=2, latency_target_ms=100, backoff_ratio=0.5)
+		limiter.acquire(timeout=0)
+		limiter.release(latency_ms=500)
+		assert limiter.limit == 5
+		limiter.acquire(timeout=0)
+		limiter.release(dropped=True)
+		assert limiter.limit == 2
+		limiter.acquire(timeout=0)
+		limiter.release(dropped=True)
+		assert limiter.limit == 2
+		assert limiter.stats()['drops'] == 2
+
+	def test_acquire_waits_for_slot(cls):
+		limiter = admission.AIMDLimiter(initial_limit=1)
+		assert limiter.acquire(timeout=0)
+		assert not limiter.acquire(timeout=0)
+		assert limiter.stats()['rejections'] == 1
+
+		timer = threading.Timer(0.05, limiter.release, kwargs={'latency_ms': 1})
+		timer.start()
+		assert limiter.acquire(timeout=5)
+		assert limiter.in_flight == 1
+
+
+class TestAdmissionController(TestCase):
+
+	def setUp(cls):
+		cls.clock = FakeClock()
+		cls.controller = admission.AdmissionController(
+													   admission.AIMDLimiter(initial_limit=4),
+													   deadline = 10,
+													   sleep = cls.clock.sleep,
+													   clock = cls.clock)
+
+	def failing(cls, errors, result='result'):
+		calls = []
+		def function():
+			calls.append(cls.clock.now)
+			if len(calls) <= len(errors):
+				raise errors[len(calls) - 1]
+			return result
+		return function, calls
+
+	def test_retries_transient_errors(cls):
+		function, calls = cls.failing([
+									   ServiceUnavailable('Connection lost'),
+									   ConnectionResetError('Reset'),
+									   TransientError('Deadlock')])
+		assert cls.controller.run(function) == 'result'
+		assert len(calls) == 4
+		# Backoff stays within the exponential bound
+		assert calls[1] - calls[0] <= 0.1
+		assert calls[3] - calls[2] <= 0.4
+		stats = cls.controller.stats()
+		assert stats['retries'] == 3
+		assert stats['drops'] == 3
+		assert stats['inFlight'] == 0
+
+	def test_permanent_errors_not_retried(cls):
+		function, calls = cls.failing([ClientError('Invalid input')])
+		with cls.assertRaises(ClientError):
+			cls.controller.run(function)
+		assert len(calls) == 1
+		assert cls.controller.stats()['failures'] == 1
+
+	def test_permanent_errors_not_dropped(cls):
+		for error in [ValueError('Missing parameter'), ClientError('Invalid input')] * 5:
+			function, _ = cls.failing([error])
+			with cls.assertRaises(type(error)):
+				cls.controller.run(function)
+		# Bad requests don't throttle the others
+		stats = cls.controller.stats()
+		assert stats['drops'] == 0
+		assert stats['limit'] == 4
+		assert stats['inFlight'] == 0
+
+	def test_deadline(cls):
+		function, calls = cls.failing([ServiceUnavailable('Connection lost')] * 100)
+		with cls.assertRaises(ServiceUnavailable):
+			cls.controller.run(function)
+		assert cls.clock.now <= 10
+		assert 1 < len(calls) < 100
+
+	def test_admission_timeout(cls):
+		limiter = admission.AIMDLimiter(initial_limit=1)
+		limiter.acquire()
+		controller = admission.AdmissionController(limiter, deadline=0.01)
+		with cls.assertRaises(admission.AdmissionTimeout):
+			controller.run(lambda: 'result')
+
+	def test_latency_from_result(cls):
+		cls.controller.run(lambda: ('graph', 450), latency=lambda result: result[1])
+		assert cls.controller.stats()['lastLatencyMs'] == 450
+		assert cls.controller.limiter.limit == 3
+
+	def test_create_not_retried_after_lost_connection(cls):
+		function, calls = cls.failing([TransientError('Deadlock'), ServiceUnavailable('Connection lost')])
+		with cls.assertRaises(ServiceUnavailable):
+			cls.controller.run(function, retryable=admission.is_retryable_before_commit)
+		# Retried after the rollback, not after the connection was lost
+		assert len(calls) == 2
+
+
+class TestGetRetryCheck(TestCase):
+
+	def query(cls, cypher, write_transaction=True):
+		return SimpleNamespace(cypher=cypher, write_transaction=write_transaction)
+
+	def test_retry_checks(cls):
+		assert admission.get_retry_check(cls.query("CREATE (job:DsubJob $properties) RETURN job")) is admission.is_retryable_before_commit
+		assert admission.get_retry_check(cls.query("MATCH (n) WITH n create (m:Copy) RETURN m")) is admission.is_retryable_before_commit
+		assert admission.get_retry_check(cls.query("MERGE (fastq:Fastq {uri: $uri}) RETURN fastq")) is admission.is_retryable
+		assert admission.get_retry_check(cls.query("MERGE (fastq:Fastq {uri: $uri}) ON CREATE SET fastq.created = 1 RETURN fastq")) is admission.is_retryable
+		assert admission.get_retry_check(cls.query("CREATE (n) RETURN n", write_transaction=False)) is admission.is_retryable
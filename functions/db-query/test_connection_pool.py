@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+import time
+import threading
+
+from unittest import TestCase
+
+import connection_pool
+
+
+class FakeRunResult:
+
+	def consume(cls):
+		return None
+
+
+class CountingSession:
+
+	def __init__(self, driver):
+		self.driver = driver
+
+	def __enter__(cls):
+		with cls.driver.lock:
+			cls.driver.open_sessions += 1
+			cls.driver.max_open_sessions = max(cls.driver.max_open_sessions, cls.driver.open_sessions)
+		return cls
+
+	def __exit__(cls, *args):
+		with cls.driver.lock:
+			cls.driver.open_sessions -= 1
+
+	def run(cls, cypher):
+		with cls.driver.lock:
+			call = cls.driver.run_calls
+			cls.driver.run_calls += 1
+		if cls.driver.error and (cls.driver.failing_calls is None or call in cls.driver.failing_calls):
+			raise cls.driver.error
+		return FakeRunResult()
+
+
+class CountingDriver:
+	"""Counts sessions open at the same time, i.e. pooled connections in use."""
+
+	def __init__(self, error=None, failing_calls=None):
+		# Indexes of the queries that raise error; None for all of them
+		self.error = error
+		self.failing_calls = failing_calls
+		self.run_calls = 0
+		self.lock = threading.Lock()
+		self.open_sessions = 0
+		self.max_open_sessions = 0
+
+	def session(cls):
+		return CountingSession(cls)
+
+
+class TestGetDriverConfig(TestCase):
+
+	def test_defaults(cls):
+		assert connection_pool.get_driver_config({}) == {
+			'max_connection_pool_size': 10,
+			'max_transaction_retry_time': 0,
+		}
+
+	def test_configured(cls):
+		driver_config = connection_pool.get_driver_config({
+			'NEO4J_MAX_CONNECTION_POOL_SIZE': 50,
+			'NEO4J_MAX_CONNECTION_LIFETIME': 3600,
+			'NEO4J_CONNECTION_ACQUISITION_TIMEOUT': '',
+			'NEO4J_LIVENESS_CHECK_TIMEOUT': None,
+			'NEO4J_IP_ADDRESS': '10.0.0.1',
+		})
+		assert driver_config == {
+			'max_connection_pool_size': 50,
+			'max_connection_lifetime': 3600,
+			'max_transaction_retry_time': 0,
+		}
+
+
+class TestWarmUp(TestCase):
+
+	def test_connections_held_together(cls):
+		driver = CountingDriver()
+		assert connection_pool.warm_up(driver, 4, timeout=5) == 4
+		assert driver.max_open_sessions == 4
+		assert driver.open_sessions == 0
+
+	def test_unavailable_database(cls):
+		driver = CountingDriver(error=ConnectionRefusedError('refused'))
+		assert connection_pool.warm_up(driver, 3, timeout=5) == 0
+		assert driver.open_sessions == 0
+
+	def test_failed_connection_releases_others(cls):
+		# The last session fails while the others wait for it
+		driver = CountingDriver(error=ConnectionRefusedError('refused'), failing_calls={2})
+		start = time.perf_counter()
+		with cls.assertLogs(level='WARNING'):
+			assert connection_pool.warm_up(driver, 3, timeout=5) == 2
+		# The other sessions don't wait for the timeout
+		assert time.perf_counter() - start < 1
+		assert driver.open_sessions == 0
+
+
+class TestTransactionTimer(TestCase):
+
+	def test_acquire_and_query_times(cls):
+		timer = connection_pool.TransactionTimer(lambda tx, value: value * 2)
+		assert timer.acquire_ms is None and timer.query_ms is None
+
+		assert timer('tx', 21) == 42
+		assert timer.acquire_ms >= 0
+		assert timer.query_ms >= 0
+
+	def test_retried_function(cls):
+		calls = []
+		def transaction_function(tx):
+			calls.append(tx)
+			if len(calls) == 1:
+				raise ConnectionResetError()
+			return tx
+
+		timer = connection_pool.TransactionTimer(transaction_function)
+		with cls.assertRaises(ConnectionResetError):
+			timer('first')
+		started = timer.started
+		assert timer('second') == 'second'
+		# Driver retries count as query time, not acquisition time
+		assert timer.started == started
+
+
+class TestPoolMetrics(TestCase):
+
+	def make_timer(cls, acquire_ms, query_ms):
+		timer = connection_pool.TransactionTimer(None)
+		timer.requested = 0
+		timer.started = acquire_ms / 1000
+		timer.finished = (acquire_ms + query_ms) / 1000
+		return timer
+
+	def test_stats(cls):
+		metrics = connection_pool.PoolMetrics(acquire_warning_ms=100)
+		assert metrics.stats()['transactions'] == 0
+
+		metrics.record(cls.make_timer(10, 30))
+		with cls.assertLogs(level='WARNING'):
+			metrics.record(cls.make_timer(250, 10), query_name='mergeFastq')
+		# Failed before a connection was acquired
+		metrics.record(connection_pool.TransactionTimer(None))
+
+		stats = metrics.stats()
+		assert stats['transactions'] == 2
+		assert stats['slowAcquires'] == 1
+		cls.assertAlmostEqual(stats['acquireMsMean'], 130)
+		cls.assertAlmostEqual(stats['acquireMsMax'], 250)
+		cls.assertAlmostEqual(stats['queryMsMean'], 20)
+		cls.assertAlmostEqual(stats['queryMsMax'], 30)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+import json
+
+from concurrent.futures import Future
+from unittest import TestCase
+
+import fanout
+
+
+class FanoutPublisher:
+	"""Returns futures that are completed, failed or never completed by topic."""
+
+	def __init__(self, failing=(), hanging=()):
+		self.failing = failing
+		self.hanging = hanging
+		self.published = []
+
+	def topic_path(cls, project_id, topic):
+		return f"projects/{project_id}/topics/{topic}"
+
+	def publish(cls, topic_path, data):
+		cls.published.append((topic_path, data))
+		future = Future()
+		topic = topic_path.split('/')[-1]
+		if topic in cls.failing:
+			future.set_exception(RuntimeError('Publish failed'))
+		elif topic not in cls.hanging:
+			future.set_result(str(len(cls.published)))
+		return future
+
+
+class TestPublishFanout(TestCase):
+
+	messages = [{'header': {'seedId': 1}, 'body': {'nodes': [index]}} for index in range(3)]
+
+	def test_published_to_all_topics(cls):
+		publisher = FanoutPublisher()
+		counts, failures = fanout.publish_fanout(
+												 publisher,
+												 'test-project',
+												 ['trellis-check-triggers', 'trellis-job-launcher'],
+												 iter(cls.messages))
+
+		assert counts == {'trellis-check-triggers': 3, 'trellis-job-launcher': 3}
+		assert failures == {'trellis-check-triggers': 0, 'trellis-job-launcher': 0}
+		assert [json.loads(data) for _, data in publisher.published[::2]] == cls.messages
+		# Serialized once per message
+		for index in range(0, 6, 2):
+			assert publisher.published[index][1] is publisher.published[index + 1][1]
+
+	def test_failures_by_topic(cls):
+		publisher = FanoutPublisher(failing=['trellis-job-launcher'], hanging=['trellis-db-query'])
+		with cls.assertLogs(level='ERROR'):
+			counts, failures = fanout.publish_fanout(
+													 publisher,
+													 'test-project',
+													 ['trellis-check-triggers', 'trellis-job-launcher', 'trellis-db-query'],
+													 cls.messages,
+													 deadline = 0.1)
+
+		assert counts == {'trellis-check-triggers': 3, 'trellis-job-launcher': 0, 'trellis-db-query': 0}
+		assert failures == {'trellis-check-triggers': 0, 'trellis-job-launcher': 3, 'trellis-db-query': 3}
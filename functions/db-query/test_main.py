@@ -13,6 +13,9 @@ from unittest import TestCase
 import trellisdata as trellis
 #from trellisdata import DatabaseQuery
 import main
+import plan_warmup
+
+from test_fanout import FanoutPublisher
 
 mock_context = mock.Mock()
 mock_context.event_id = '617187464135194'
@@ -253,4 +256,254 @@ class TestLoadConfig(TestCase):
 			queries = list(queries)
 
 		for query in queries:
-			assert isinstance(query, trellis.DatabaseQuery) == True
\ No newline at end of file
+			assert isinstance(query, trellis.DatabaseQuery) == True
+
+class FakeResult:
+
+	def __init__(self, records, summary='summary'):
+		self.records = records
+		self.summary = summary
+
+	def __iter__(cls):
+		return iter(cls.records)
+
+	def consume(cls):
+		return cls.summary
+
+
+class FakeSession:
+
+	def __init__(self, driver):
+		self.driver = driver
+
+	def __enter__(cls):
+		return cls
+
+	def __exit__(cls, *args):
+		return False
+
+	def write_transaction(cls, function, *args, **kwargs):
+		return function(cls.driver, *args, **kwargs)
+
+	read_transaction = write_transaction
+
+
+class FakeDriver:
+	"""Records queries and answers them with run_query(cypher, parameters)."""
+
+	def __init__(self, run_query, summary='summary'):
+		self.run_query = run_query
+		self.summary = summary
+		self.queries = []
+
+	def session(cls):
+		return FakeSession(cls)
+
+	def run(cls, cypher, parameters=None, **kwargs):
+		parameters = dict(parameters or {}, **kwargs)
+		cls.queries.append((cypher, parameters))
+		return FakeResult(cls.run_query(cypher, parameters), cls.summary)
+
+
+class GraphResult(FakeResult):
+
+	def graph(cls):
+		graph = main.BatchGraph()
+		for record in cls.records:
+			for value in record.values():
+				graph.add(value)
+		return graph
+
+
+class GraphDriver(FakeDriver):
+	"""Results have graph(), as used by query_database()."""
+
+	def run(cls, cypher, parameters=None, **kwargs):
+		result = super().run(cypher, parameters, **kwargs)
+		return GraphResult(result.records, result.summary)
+
+
+class TestQueryDatabaseBatch(TestCase):
+
+	query = trellis.DatabaseQuery(
+								  name = 'mergeFastq',
+								  cypher = "MERGE (fastq:Fastq {uri: $uri}) RETURN fastq",
+								  required_parameters = {'uri': 'str'},
+								  write_transaction = True,
+								  publish_to = ['TOPIC_TRIGGERS'],
+								  returns = {'fastq': 'node'})
+
+	graph = neo4j.graph.Graph()
+
+	def make_node(cls, index, uri):
+		return neo4j.graph.Node(cls.graph, f"4:test:{index}", index, ['Fastq'], {'uri': uri})
+
+	def test_get_batch_cypher(cls):
+		cypher = main.get_batch_cypher(cls.query)
+		assert cypher == (
+						  "UNWIND $rows AS batchRow " +
+						  "CALL { WITH batchRow MERGE (fastq:Fastq {uri: batchRow.uri}) RETURN fastq } " +
+						  "RETURN *, batchRow.batchIndex AS batchIndex")
+
+		with open('../../config/database-queries.yaml') as file_handle:
+			queries = {query.name: query for query in yaml.load_all(file_handle, Loader=yaml.FullLoader)}
+		query = queries['relateFastqToReadGroup']
+		assert main.get_batch_cypher(query) == query.batch_cypher
+
+	def test_get_batch_cypher_quoted(cls):
+		query = trellis.DatabaseQuery(
+									  name = 'mergeFastq',
+									  cypher = (
+												"MERGE (fastq:Fastq {uri: $uri}) " +
+												"SET fastq.note = 'costs $5', fastq.`$size` = $size, " +
+												"fastq.path = \"it\\\"s $uri\" RETURN fastq"),
+									  required_parameters = {'uri': 'str', 'size': 'int'},
+									  write_transaction = True,
+									  publish_to = ['TOPIC_TRIGGERS'],
+									  returns = {'fastq': 'node'})
+		cypher = main.get_batch_cypher(query)
+		assert "{uri: batchRow.uri}" in cypher
+		assert "'costs $5'" in cypher
+		assert "fastq.`$size` = batchRow.size" in cypher
+		assert '"it\\"s $uri"' in cypher
+
+	def test_batch_split_per_request(cls):
+		def run_query(cypher, parameters):
+			records = []
+			for row in parameters['rows']:
+				node = cls.make_node(row['batchIndex'], row['uri'])
+				records.append({'batchRow': row, 'fastq': node, 'batchIndex': row['batchIndex']})
+			return records
+		driver = FakeDriver(run_query)
+
+		parameter_sets = [{'uri': f"gs://bucket/sample_{index}.fastq.gz"} for index in range(3)]
+		parameter_sets.insert(1, {'uri': 1})
+		results = main.query_database_batch(driver, cls.query, parameter_sets)
+
+		# One transaction for all valid parameter sets
+		assert len(driver.queries) == 1
+		assert [row['batchIndex'] for row in driver.queries[0][1]['rows']] == [0, 2, 3]
+		assert isinstance(results[1], ValueError)
+		for index in (0, 2, 3):
+			graph, result_summary = results[index]
+			assert result_summary == 'summary'
+			assert [node['uri'] for node in graph.nodes] == [parameter_sets[index]['uri']]
+			assert graph.relationships == []
+
+			response = trellis.QueryResponseWriter(
+												   sender = 'test',
+												   seed_id = 1,
+												   previous_event_id = 2,
+												   query_name = cls.query.name,
+												   graph = graph,
+												   result_summary = result_summary)
+			assert len(response.nodes) == 1
+
+	def test_batch_falls_back_to_single_queries(cls):
+		def run_query(cypher, parameters):
+			if 'rows' in parameters:
+				raise neo4j.exceptions.CypherSyntaxError('Invalid input')
+			if parameters['uri'] == 'gs://bucket/bad':
+				raise neo4j.exceptions.ConstraintError('Node already exists')
+			return [{'fastq': cls.make_node(0, parameters['uri'])}]
+		driver = GraphDriver(run_query)
+
+		results = main.query_database_batch(driver, cls.query, [{'uri': 'gs://bucket/good'}, {'uri': 'gs://bucket/bad'}])
+		assert len(driver.queries) == 3
+		assert [node['uri'] for node in results[0][0].nodes] == ['gs://bucket/good']
+		assert isinstance(results[1], neo4j.exceptions.ConstraintError)
+
+	def test_single_query_transient_error(cls):
+		def run_query(cypher, parameters):
+			if 'rows' in parameters:
+				raise neo4j.exceptions.ConstraintError('Node already exists')
+			if parameters['uri'] == 'gs://bucket/1':
+				raise neo4j.exceptions.ServiceUnavailable('Connection lost')
+			return [{'fastq': cls.make_node(0, parameters['uri'])}]
+		driver = GraphDriver(run_query)
+
+		parameter_sets = [{'uri': f"gs://bucket/{index}"} for index in range(3)]
+		results = main.query_database_batch(driver, cls.query, parameter_sets)
+		# Parameter sets run after the error still run; committed ones keep their results
+		assert len(driver.queries) == 4
+		assert [node['uri'] for node in results[0][0].nodes] == ['gs://bucket/0']
+		assert isinstance(results[1], neo4j.exceptions.ServiceUnavailable)
+		assert [node['uri'] for node in results[2][0].nodes] == ['gs://bucket/2']
+
+	def test_batch_graph_relationships(cls):
+		graph = main.BatchGraph()
+		start, end = cls.make_node(1, 'a'), cls.make_node(2, 'b')
+		relationship = cls.graph.relationship_type('HAS_FASTQ')(cls.graph, '5:test:1', 1, {})
+		relationship._start_node, relationship._end_node = start, end
+		graph.add([start, relationship])
+		assert graph.nodes == [start, end]
+		assert graph.relationships == [relationship]
+
+
+class TestPublishQueryResponse(TestCase):
+
+	topics = {'TOPIC_TRIGGERS': 'trellis-check-triggers', 'TOPIC_JOB_LAUNCHER': 'trellis-job-launcher'}
+
+	def setUp(cls):
+		nodes = [{'id': index, 'labels': ['Fastq'], 'properties': {'uri': 'x' * 100}} for index in range(100)]
+		cls.query_response = mock.Mock()
+		cls.query_response.return_json_with_all_nodes.return_value = {
+			'header': {'seedId': 1, 'previousEventId': 2},
+			'body': {'queryName': 'getFastqs', 'nodes': nodes}}
+
+	def get_query(cls, publish_to):
+		return trellis.DatabaseQuery(
+									 name = 'getFastqs',
+									 cypher = "MATCH (fastq:Fastq) RETURN fastq",
+									 required_parameters = {},
+									 write_transaction = False,
+									 publish_to = publish_to,
+									 returns = {'node': 'Fastq'},
+									 aggregate_results = 'True')
+
+	def publish(cls, publish_to):
+		publisher = FanoutPublisher()
+		with mock.patch('response_chunks.PART_BYTES', 2000), cls.assertLogs(level='INFO'):
+			main.publish_query_response(cls.query_response, cls.get_query(publish_to), publisher, 'test-project', cls.topics)
+		return publisher.published
+
+	def test_split_for_reassembling_topics(cls):
+		published = cls.publish(['TOPIC_TRIGGERS'])
+		assert len(published) > 1
+
+	def test_not_split_for_other_topics(cls):
+		published = cls.publish(['TOPIC_TRIGGERS', 'TOPIC_JOB_LAUNCHER'])
+		assert len(published) == 2
+		assert {json.loads(data)['header']['chunk']['count'] for _, data in published} == {1}
+
+	def test_too_large_to_publish(cls):
+		with mock.patch('response_chunks.MAX_MESSAGE_BYTES', 2000), cls.assertRaises(ValueError):
+			cls.publish(['TOPIC_JOB_LAUNCHER'])
+
+
+class TestCheckPlanError(TestCase):
+
+	query = trellis.DatabaseQuery(
+								  name = 'mergeFastq',
+								  cypher = "MERGE (fastq:Fastq {uri: $uri}) RETURN fastq",
+								  required_parameters = {'uri': 'str'},
+								  write_transaction = True,
+								  publish_to = ['TOPIC_TRIGGERS'],
+								  returns = {'fastq': 'node'})
+
+	def test_new_error_per_request(cls):
+		main.check_plan_error(cls.query)
+
+		plan_error = plan_warmup.QueryCompileError('mergeFastq', neo4j.exceptions.CypherSyntaxError('Invalid input'))
+		errors = []
+		with mock.patch.dict(main.PLAN_ERRORS, {'mergeFastq': plan_error}):
+			for _ in range(3):
+				try:
+					main.check_plan_error(cls.query)
+				except plan_warmup.QueryCompileError as error:
+					errors.append(error)
+		assert len(errors) == 3
+		assert str(errors[0]) == str(plan_error)
+		# The stored error doesn't collect the frames of each request
+		assert plan_error.__traceback__ is None
+		assert len({id(error) for error in errors}) == 3
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+import time
+
+from types import SimpleNamespace
+from unittest import TestCase
+
+from neo4j.exceptions import ClientError, ServiceUnavailable
+
+import trellisdata as trellis
+
+import main
+import plan_warmup
+
+from test_main import FakeDriver
+
+
+class StatementSyntaxError(ClientError):
+	code = 'Neo.ClientError.Statement.SyntaxError'
+
+
+class TestWarmUpPlans(TestCase):
+
+	queries = [
+		trellis.DatabaseQuery(
+							  name = 'mergeFastq',
+							  cypher = "MERGE (fastq:Fastq {uri: $uri}) SET fastq.size = $size RETURN fastq",
+							  required_parameters = {'uri': 'str', 'size': 'int'},
+							  write_transaction = True,
+							  publish_to = [],
+							  returns = {'fastq': 'node'}),
+		trellis.DatabaseQuery(
+							  name = 'getFastq',
+							  cypher = "MATCH (fastq:Fastq {uri: $uri}) RETURN fastq",
+							  required_parameters = {'uri': 'str'},
+							  write_transaction = False,
+							  publish_to = [],
+							  returns = {'fastq': 'node'}),
+	]
+
+	def make_driver(cls, run_query, planning_ms=3):
+		return FakeDriver(run_query, summary=SimpleNamespace(result_available_after=planning_ms))
+
+	def test_explain_with_placeholders(cls):
+		driver = cls.make_driver(lambda cypher, parameters: [])
+		planning_times = plan_warmup.warm_up_plans(driver, cls.queries, time_budget=5)
+
+		assert planning_times == {'mergeFastq': 3, 'getFastq': 3}
+		assert sorted(driver.queries) == [
+			("EXPLAIN MATCH (fastq:Fastq {uri: $uri}) RETURN fastq", {'uri': ''}),
+			("EXPLAIN MERGE (fastq:Fastq {uri: $uri}) SET fastq.size = $size RETURN fastq", {'uri': '', 'size': 0}),
+		]
+
+	def test_batch_statements(cls):
+		driver = cls.make_driver(lambda cypher, parameters: [])
+		planning_times = plan_warmup.warm_up_plans(
+												   driver,
+												   cls.queries[:1],
+												   time_budget = 5,
+												   batch_cypher = main.get_batch_cypher)
+
+		assert set(planning_times) == {'mergeFastq', 'mergeFastq (batch)'}
+		batch_parameters = [parameters for cypher, parameters in driver.queries if 'UNWIND' in cypher]
+		assert batch_parameters == [{'rows': [{'uri': '', 'size': 0, 'batchIndex': 0}]}]
+
+	def test_compile_error(cls):
+		def run_query(cypher, parameters):
+			if 'MATCH' in cypher:
+				raise StatementSyntaxError('Invalid input')
+			return []
+		driver = cls.make_driver(run_query)
+
+		with cls.assertRaises(plan_warmup.QueryCompileError) as context:
+			plan_warmup.warm_up_plans(driver, cls.queries, time_budget=5)
+		assert context.exception.query_name == 'getFastq'
+
+	def test_batch_compile_error_logged(cls):
+		def run_query(cypher, parameters):
+			if 'UNWIND' in cypher:
+				raise StatementSyntaxError('Invalid input')
+			return []
+		driver = cls.make_driver(run_query)
+
+		with cls.assertLogs(level='WARNING'):
+			planning_times = plan_warmup.warm_up_plans(
+													   driver,
+													   cls.queries,
+													   time_budget = 5,
+													   batch_cypher = main.get_batch_cypher)
+		assert set(planning_times) == {'mergeFastq', 'getFastq'}
+
+	def test_unavailable_database(cls):
+		def run_query(cypher, parameters):
+			raise ServiceUnavailable('Database unavailable')
+		driver = cls.make_driver(run_query)
+
+		with cls.assertLogs(level='WARNING'):
+			planning_times = plan_warmup.warm_up_plans(driver, cls.queries, time_budget=5)
+		assert planning_times == {}
+
+	def test_time_budget(cls):
+		def run_query(cypher, parameters):
+			if 'MATCH' in cypher:
+				time.sleep(0.5)
+			return []
+		driver = cls.make_driver(run_query)
+
+		start = time.perf_counter()
+		with cls.assertLogs(level='WARNING'):
+			planning_times = plan_warmup.warm_up_plans(driver, cls.queries, time_budget=0.1)
+		assert time.perf_counter() - start < 0.5
+		assert planning_times == {'mergeFastq': 3}
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+import os
+import yaml
+
+from types import SimpleNamespace
+from unittest import TestCase
+
+import trellisdata as trellis
+
+import provision_indexes
+
+from test_main import FakeDriver
+
+QUERIES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'config', 'database-queries.yaml')
+
+
+def make_query(name, cypher, **schema):
+	query = trellis.DatabaseQuery(
+								  name = name,
+								  cypher = cypher,
+								  required_parameters = {'uri': 'str'},
+								  write_transaction = False,
+								  publish_to = [],
+								  returns = {})
+	for field, declared in schema.items():
+		setattr(query, field, declared)
+	return query
+
+
+def make_plan(operator_type, details='', children=()):
+	return {'operatorType': operator_type, 'args': {'Details': details}, 'children': list(children)}
+
+
+class TestSchemaStatements(TestCase):
+
+	def test_declared_properties(cls):
+		query = make_query(
+						   'relateFastqToReadGroup',
+						   "MATCH (fastq:Fastq {sample: $sample}) RETURN fastq",
+						   indexes = {'Fastq': ['sample', 'readGroup'], 'Sample': [['sample'], ['name']]},
+						   constraints = {'Fastq': ['uri', 'gcsId']})
+		assert provision_indexes.get_declared_properties(query, 'indexes') == [
+			('Fastq', ('sample', 'readGroup')),
+			('Sample', ('sample',)),
+			('Sample', ('name',)),
+		]
+		assert provision_indexes.get_declared_properties(query, 'constraints') == [
+			('Fastq', ('uri',)),
+			('Fastq', ('gcsId',)),
+		]
+
+	def test_statements(cls):
+		queries = [
+			make_query('a', "RETURN 1", indexes={'Fastq': ['uri']}, constraints={'Fastq': ['uri']}),
+			make_query('b', "RETURN 1", indexes={'Fastq': ['sample', 'readGroup']}),
+			make_query('c', "RETURN 1", indexes={'Fastq': ['sample', 'readGroup']}),
+			make_query('d', "RETURN 1"),
+		]
+		assert provision_indexes.get_schema_statements(queries) == [
+			"CREATE CONSTRAINT trellis_unique_Fastq_uri IF NOT EXISTS FOR (n:`Fastq`) REQUIRE n.`uri` IS UNIQUE",
+			"CREATE INDEX trellis_index_Fastq_sample_readGroup IF NOT EXISTS " +
+			"FOR (n:`Fastq`) ON (n.`sample`, n.`readGroup`)",
+		]
+
+	def test_database_queries(cls):
+		with open(QUERIES_FILE) as file_handle:
+			queries = list(yaml.load_all(file_handle, Loader=yaml.FullLoader))
+		statements = provision_indexes.get_schema_statements(queries)
+		assert "CREATE CONSTRAINT trellis_unique_Fastq_uri IF NOT EXISTS FOR (n:`Fastq`) REQUIRE n.`uri` IS UNIQUE" in statements
+		assert len(statements) == len(set(statements))
+
+
+class TestVerifyQueries(TestCase):
+
+	def test_scans_reported(cls):
+		plan = make_plan('ProduceResults@neo4j', children=[
+			make_plan('Apply@neo4j', children=[
+				make_plan('NodeIndexSeek@neo4j', 'RANGE INDEX sample:Sample(sample) WHERE sample = $sample'),
+				make_plan('NodeByLabelScan@neo4j', 'fastq:Fastq'),
+			])
+		])
+		driver = FakeDriver(lambda cypher, parameters: [], summary=SimpleNamespace(plan=plan))
+		query = make_query('getFastq', "MATCH (fastq:Fastq {uri: $uri}) RETURN fastq")
+
+		problems = provision_indexes.verify_queries(driver, [query])
+		assert problems == {'getFastq': 'NodeByLabelScan(fastq:Fastq)'}
+		assert driver.queries == [("EXPLAIN MATCH (fastq:Fastq {uri: $uri}) RETURN fastq", {'uri': ''})]
+
+	def test_index_backed(cls):
+		plan = make_plan('ProduceResults', children=[make_plan('NodeUniqueIndexSeek', 'UNIQUE fastq:Fastq(uri)')])
+		driver = FakeDriver(lambda cypher, parameters: [], summary=SimpleNamespace(plan=plan))
+		query = make_query('getFastq', "MATCH (fastq:Fastq {uri: $uri}) RETURN fastq")
+
+		assert provision_indexes.verify_queries(driver, [query]) == {}
+
+	def test_report(cls):
+		queries = [make_query('getFastq', "RETURN 1"), make_query('mergeFastq', "RETURN 1")]
+		report = provision_indexes.format_report(queries, {}, {'getFastq': 'NodeByLabelScan(fastq:Fastq)'})
+		assert report.splitlines() == [
+			"1 of 2 queries are not index-backed:",
+			"  getFastq  NodeByLabelScan(fastq:Fastq)",
+		]
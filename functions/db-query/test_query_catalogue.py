@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+
+import yaml
+import base64
+
+from unittest import TestCase
+
+import google_crc32c
+import trellisdata as trellis
+
+from google.api_core import exceptions
+
+import query_catalogue
+
+
+class FakeBlob:
+
+	def __init__(self, bucket, name, generation=None):
+		# Metadata of the generation current when the blob was fetched
+		self.bucket = bucket
+		self.name = name
+		self.generation = generation
+		if generation is not None:
+			content = bucket.objects[name]
+			self.size = len(content)
+			self.crc32c = base64.b64encode(google_crc32c.Checksum(content).digest()).decode('utf-8')
+
+	def _check_generation(self, if_generation_match):
+		current = self.bucket.generations.get(self.name, 0)
+		if if_generation_match is not None and if_generation_match != current:
+			raise exceptions.PreconditionFailed('generation changed')
+
+	def download_as_bytes(self, start=None, if_generation_match=None):
+		if self.name not in self.bucket.objects:
+			raise exceptions.NotFound('object deleted')
+		self._check_generation(if_generation_match)
+		self.bucket.downloads.append((self.name, start))
+		return self.bucket.objects[self.name][start:]
+
+	def upload_from_string(self, data, if_generation_match=None):
+		self._check_generation(if_generation_match)
+		self.bucket.uploads.append(self.name)
+		self.bucket.upload(self.name, data)
+		self.generation = self.bucket.generations[self.name]
+
+	def delete(self, if_generation_match=None):
+		if self.name not in self.bucket.objects:
+			raise exceptions.NotFound('object deleted')
+		self._check_generation(if_generation_match)
+		del self.bucket.objects[self.name]
+		del self.bucket.generations[self.name]
+
+
+class FakeBucket:
+
+	def __init__(self):
+		self.objects = {}
+		self.generations = {}
+		self.last_generation = 0
+		self.downloads = []
+		self.uploads = []
+		self.metadata_requests = 0
+
+	def upload(self, name, content):
+		if isinstance(content, str):
+			content = content.encode('utf-8')
+		self.objects[name] = content
+		# Generations are unique across objects, as in GCS
+		self.last_generation += 1
+		self.generations[name] = self.last_generation
+
+	def blob(self, name):
+		return FakeBlob(self, name)
+
+	def get_blob(self, name):
+		self.metadata_requests += 1
+		if name not in self.objects:
+			return None
+		return FakeBlob(self, name, self.generations[name])
+
+
+class FakeStorageClient:
+
+	def __init__(self, bucket):
+		self._bucket = bucket
+
+	def bucket(self, name):
+		return self._bucket
+
+	def list_blobs(self, bucket_name, prefix=None):
+		names = sorted(name for name in self._bucket.objects if name.startswith(prefix))
+		return [FakeBlob(self._bucket, name, self._bucket.generations[name]) for name in names]
+
+
+def make_query(name, cypher="MERGE (node:Blob {uri: $uri}) RETURN node"):
+	return trellis.DatabaseQuery(
+								 name = name,
+								 cypher = cypher,
+								 required_parameters = {'uri': 'str'},
+								 write_transaction = True,
+								 returns = {'node': 'node'},
+								 publish_to = ['TOPIC_TRIGGERS'],
+								 aggregate_results = False,
+								 active = True)
+
+
+def dump_queries(queries):
+	return ''.join("--- " + yaml.dump(query) for query in queries)
+
+
+class CatalogueTestCase(TestCase):
+
+	blob_name = 'create-blob-queries.yaml'
+
+	def setUp(cls):
+		cls.bucket = FakeBucket()
+		cls.catalogue = cls.new_catalogue()
+
+	def new_catalogue(cls):
+		# Catalogue of another function instance sharing the bucket
+		return query_catalogue.QueryCatalogue(
+											  'credentials',
+											  cls.blob_name,
+											  storage_client = FakeStorageClient(cls.bucket))
+
+
+class TestQueryCatalogue(CatalogueTestCase):
+
+	def test_query_digest(cls):
+		query = make_query('mergeBlobFastq')
+		assert query_catalogue.get_query_digest(query) == query_catalogue.get_query_digest(make_query('mergeBlobFastq'))
+		assert query_catalogue.get_query_digest(query) != query_catalogue.get_query_digest(make_query('mergeBlobFastq', cypher="RETURN 1"))
+
+		loaded = yaml.load(yaml.dump(query), Loader=yaml.FullLoader)
+		assert loaded == query
+		assert query_catalogue.get_query_digest(loaded) == query_catalogue.get_query_digest(query)
+
+	def test_parsed_once_per_generation(cls):
+		cls.bucket.upload(cls.blob_name, dump_queries([make_query('mergeBlobFastq'), make_query('mergeBlobBam')]))
+
+		assert cls.catalogue.contains(make_query('mergeBlobFastq'))
+		assert cls.catalogue.contains(make_query('mergeBlobBam'))
+		# Found in the index without reading the catalogue again
+		assert cls.bucket.metadata_requests == 1
+		assert cls.catalogue.full_loads == 1
+
+		# Missing queries check the generation but don't reparse it
+		assert not cls.catalogue.contains(make_query('mergeBlobVcf'))
+		assert cls.bucket.metadata_requests == 2
+		assert cls.catalogue.full_loads == 1
+		assert len(cls.bucket.downloads) == 1
+
+	def test_appended_queries_loaded_incrementally(cls):
+		document = dump_queries([make_query('mergeBlobFastq')])
+		cls.bucket.upload(cls.blob_name, document)
+		cls.catalogue.refresh()
+		size = cls.catalogue.size
+
+		cls.bucket.upload(cls.blob_name, document + dump_queries([make_query('mergeBlobVcf')]))
+		assert cls.catalogue.contains(make_query('mergeBlobVcf'))
+		assert cls.catalogue.contains(make_query('mergeBlobFastq'))
+		assert cls.catalogue.full_loads == 1
+		assert cls.catalogue.incremental_loads == 1
+		assert cls.bucket.downloads == [(cls.blob_name, None), (cls.blob_name, size)]
+		assert len(cls.catalogue) == 2
+
+	def test_rewritten_catalogue_reloaded(cls):
+		cls.bucket.upload(cls.blob_name, dump_queries([make_query('mergeBlobFastq')]))
+		cls.catalogue.refresh()
+
+		# Same size prefix replaced and a query appended: checksum differs
+		changed = make_query('mergeBlobFastq', cypher="MERGE (node:Blob {uri: $uri}) RETURN nodf")
+		cls.bucket.upload(cls.blob_name, dump_queries([changed, make_query('mergeBlobVcf')]))
+		assert cls.catalogue.contains(changed)
+		assert not cls.catalogue.contains(make_query('mergeBlobFastq'), refresh=False)
+		assert cls.catalogue.full_loads == 2
+		assert cls.catalogue.incremental_loads == 0
+
+	def test_missing_catalogue(cls):
+		assert not cls.catalogue.contains(make_query('mergeBlobFastq'))
+		assert cls.catalogue.generation is None
+		assert len(cls.catalogue) == 0
+
+	def test_changed_while_loading(cls):
+		cls.bucket.upload(cls.blob_name, dump_queries([make_query('mergeBlobFastq')]))
+		get_blob = cls.bucket.get_blob
+
+		def get_blob_then_overwrite(name):
+			# Another instance writes a new generation before the download
+			blob = get_blob(name)
+			if cls.bucket.metadata_requests == 1:
+				cls.bucket.upload(name, dump_queries([make_query('mergeBlobBam')]))
+			return blob
+		cls.bucket.get_blob = get_blob_then_overwrite
+
+		assert cls.catalogue.contains(make_query('mergeBlobBam'))
+		assert cls.bucket.metadata_requests == 2
+		assert cls.catalogue.generation == 2
+
+	def test_from_document(cls):
+		document = dump_queries([make_query('mergeBlobFastq')])
+		catalogue = query_catalogue.QueryCatalogue.from_document(document)
+		assert catalogue.contains(make_query('mergeBlobFastq'), refresh=False)
+		assert catalogue.has_name('mergeBlobFastq')
+		assert not catalogue.contains(make_query('mergeBlobFastq', cypher="RETURN 1"), refresh=False)
+
+
+class TestQueryCatalogueSegments(CatalogueTestCase):
+
+	def segments(cls):
+		return sorted(name for name in cls.bucket.objects if name.startswith(cls.catalogue.segment_prefix))
+
+	def test_register_writes_one_segment(cls):
+		queries = [make_query(f"mergeBlob{index}") for index in range(50)]
+		cls.bucket.upload(cls.blob_name, dump_queries(queries))
+		cls.catalogue.refresh()
+		downloads = len(cls.bucket.downloads)
+
+		query = make_query('mergeBlobVcf')
+		assert cls.catalogue.register(query)
+		# The catalogue object is neither downloaded nor rewritten
+		assert len(cls.bucket.downloads) == downloads
+		assert cls.bucket.uploads == [f"{cls.catalogue.segment_prefix}{query_catalogue.get_query_digest(query)}.yaml"]
+		assert cls.catalogue.contains(query, refresh=False)
+
+		other = cls.new_catalogue()
+		assert other.contains(query)
+		assert other.segment_loads == 1
+		assert len(other) == 51
+
+	def test_concurrent_registration(cls):
+		other = cls.new_catalogue()
+		assert cls.catalogue.register(make_query('mergeBlobVcf'))
+		assert other.register(make_query('mergeBlobBam'))
+		# Same query registered by two instances is written once
+		assert not other.register(make_query('mergeBlobVcf'))
+		assert len(cls.segments()) == 2
+
+		reader = cls.new_catalogue()
+		assert reader.contains(make_query('mergeBlobVcf'))
+		assert reader.contains(make_query('mergeBlobBam'))
+
+	def test_segments_loaded_once(cls):
+		for index in range(20):
+			cls.new_catalogue().register(make_query(f"mergeBlob{index}"))
+		cls.catalogue.refresh()
+		assert cls.catalogue.segment_loads == 20
+
+		cls.new_catalogue().register(make_query('mergeBlobVcf'))
+		assert cls.catalogue.contains(make_query('mergeBlobVcf'))
+		assert cls.catalogue.segment_loads == 21
+		assert cls.catalogue.segment_count == 21
+
+	def test_compact(cls):
+		cls.bucket.upload(cls.blob_name, dump_queries([make_query('mergeBlobFastq')]))
+		for name in ['mergeBlobVcf', 'mergeBlobBam']:
+			cls.new_catalogue().register(make_query(name))
+		reader = cls.new_catalogue()
+		reader.refresh()
+
+		assert cls.catalogue.compact() == 2
+		assert cls.segments() == []
+		assert cls.catalogue.compact() == 0
+
+		compacted = cls.new_catalogue()
+		compacted.refresh()
+		assert compacted.segment_loads == 0
+		assert len(compacted) == 3
+		# Instances that loaded the segments reload the compacted catalogue
+		assert reader.refresh()
+		assert len(reader) == 3
+		assert reader.segment_count == 0
+
+	def test_compact_conflict(cls):
+		cls.bucket.upload(cls.blob_name, dump_queries([make_query('mergeBlobFastq')]))
+		cls.catalogue.register(make_query('mergeBlobVcf'))
+		refresh = cls.catalogue.refresh
+
+		def refresh_then_overwrite():
+			changed = refresh()
+			cls.bucket.upload(cls.blob_name, dump_queries([make_query('mergeBlobBam')]))
+			return changed
+		cls.catalogue.refresh = refresh_then_overwrite
+
+		assert cls.catalogue.compact() is None
+		assert len(cls.segments()) == 1
+
+	def test_segment_compacted_while_loading(cls):
+		cls.new_catalogue().register(make_query('mergeBlobVcf'))
+		get_blob = cls.bucket.get_blob
+		compactor = cls.new_catalogue()
+		compactor.refresh()
+
+		def get_blob_then_compact(name):
+			blob = get_blob(name)
+			if cls.bucket.metadata_requests == 2:
+				compactor.compact()
+			return blob
+		cls.bucket.get_blob = get_blob_then_compact
+
+		assert cls.catalogue.contains(make_query('mergeBlobVcf'))
+		assert cls.catalogue.segment_count == 0
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+
+from unittest import TestCase
+
+import trellisdata as trellis
+
+import query_coalescing
+
+from test_admission import FakeClock
+
+
+class WindowClock(FakeClock):
+	"""Runs requests while the first one waits for its window."""
+
+	def __init__(self):
+		super().__init__()
+		self.during_window = []
+
+	def sleep(cls, seconds):
+		requests, cls.during_window = cls.during_window, []
+		for request in requests:
+			request()
+		super().sleep(seconds)
+
+
+class CoalescingTestCase(TestCase):
+
+	def make_backend(cls):
+		return query_coalescing.MemoryBackend()
+
+	def setUp(cls):
+		cls.clock = WindowClock()
+		cls.coalescer = query_coalescing.QueryCoalescer(
+														5,
+														backend = cls.make_backend(),
+														clock = cls.clock,
+														sleep = cls.clock.sleep)
+		cls.results = []
+
+	def request(cls, sample, query_name='relateFastqMatePair'):
+		cls.results.append(cls.coalescer.coalesce(query_name, {'sample': sample}))
+
+	def test_requests_in_window_saved(cls):
+		cls.clock.during_window = [lambda: cls.request('SAMPLE1')] * 3
+		cls.request('SAMPLE1')
+		# Skipped requests return first
+		assert cls.results == [False, False, False, True]
+		assert cls.coalescer.stats() == {
+			'executions': 1,
+			'saved': 3,
+			'queries': {'relateFastqMatePair': {'executions': 1, 'saved': 3}},
+		}
+
+	def test_different_requests_run(cls):
+		cls.clock.during_window = [
+			lambda: cls.request('SAMPLE2'),
+			lambda: cls.request('SAMPLE1', query_name='relateReadGroupToSample')]
+		cls.request('SAMPLE1')
+		assert cls.results == [True, True, True]
+		assert cls.coalescer.stats()['saved'] == 0
+
+	def test_request_after_window_runs(cls):
+		cls.request('SAMPLE1')
+		# Arrives while the first request runs its query
+		cls.request('SAMPLE1')
+		assert cls.results == [True, True]
+
+	def test_expired_claim_taken_over(cls):
+		key = query_coalescing.get_key('relateFastqMatePair', {'sample': 'SAMPLE1'})
+		# Left by an instance that stopped while waiting
+		cls.coalescer.backend.claim(key, expires=10, now=0)
+		cls.request('SAMPLE1')
+		cls.clock.now = 10
+		cls.request('SAMPLE1')
+		assert cls.results == [False, True]
+
+
+class TestSqliteCoalescing(CoalescingTestCase):
+
+	def make_backend(cls):
+		directory = tempfile.TemporaryDirectory()
+		cls.addCleanup(directory.cleanup)
+		cls.path = os.path.join(directory.name, 'coalescing.db')
+		backend = query_coalescing.SqliteBackend(cls.path)
+		cls.addCleanup(backend.close)
+		return backend
+
+	def test_shared_between_instances(cls):
+		other = query_coalescing.QueryCoalescer(5, backend=query_coalescing.SqliteBackend(cls.path), clock=cls.clock)
+		cls.addCleanup(other.backend.close)
+		cls.clock.during_window = [lambda: cls.results.append(other.coalesce('relateFastqMatePair', {'sample': 'SAMPLE1'}))]
+		cls.request('SAMPLE1')
+		assert cls.results == [False, True]
+		assert other.stats()['saved'] == 1
+
+
+class TestIsRedundant(TestCase):
+
+	def test_flag(cls):
+		query = trellis.DatabaseQuery(
+									  name = 'relateFastqMatePair',
+									  cypher = 'RETURN 1',
+									  required_parameters = {},
+									  write_transaction = True,
+									  publish_to = [],
+									  returns = {})
+		assert not query_coalescing.is_redundant(query)
+		query.redundant = True
+		assert query_coalescing.is_redundant(query)
+		query.redundant = 'False'
+		assert not query_coalescing.is_redundant(query)
+
+
+class FakeMessage:
+
+	def __init__(self, message_id):
+		self.message_id = message_id
+		self.acked = False
+		self.nacked = False
+
+	def ack(cls):
+		cls.acked = True
+
+	def nack(cls):
+		cls.nacked = True
+
+
+class TestRequestGroups(TestCase):
+
+	def test_identical_requests_grouped(cls):
+		request_groups = query_coalescing.RequestGroups()
+		messages = [FakeMessage(str(index)) for index in range(4)]
+
+		group = request_groups.add('relateFastqMatePair', {'sample': 'A'}, messages[0])
+		assert group.message_id == '0'
+		assert request_groups.add('relateFastqMatePair', {'sample': 'A'}, messages[1]) is None
+		other_group = request_groups.add('relateFastqMatePair', {'sample': 'B'}, messages[2])
+		assert other_group
+
+		# Requests received once the group runs are run again
+		request_groups.close(group, {'sample': 'A'})
+		later_group = request_groups.add('relateFastqMatePair', {'sample': 'A'}, messages[3])
+		assert later_group is not group
+
+		group.ack()
+		assert messages[0].acked and messages[1].acked
+		assert not messages[3].acked
+		assert request_groups.stats() == {
+			'executions': 1,
+			'saved': 1,
+			'queries': {'relateFastqMatePair': {'executions': 1, 'saved': 1}},
+		}
+
+	def test_failed_group_nacked(cls):
+		request_groups = query_coalescing.RequestGroups()
+		messages = [FakeMessage(str(index)) for index in range(2)]
+		group = request_groups.add('relateFastqMatePair', {'sample': 'A'}, messages[0])
+		request_groups.add('relateFastqMatePair', {'sample': 'A'}, messages[1])
+		request_groups.close(group, {'sample': 'A'})
+
+		group.nack()
+		assert all(message.nacked for message in messages)
+		assert request_groups.stats()['saved'] == 0
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+from types import SimpleNamespace
+from unittest import TestCase
+
+import trellisdata as trellis
+
+import admission
+import query_profiler
+
+from test_main import FakeDriver
+from test_admission import FakeClock
+
+
+def make_summary(available_ms, consumed_ms=1, profile=None, **counters):
+	return SimpleNamespace(
+						   result_available_after = available_ms,
+						   result_consumed_after = consumed_ms,
+						   counters = SimpleNamespace(**counters),
+						   profile = profile)
+
+
+class FakeTransaction:
+
+	def __init__(self, driver):
+		self.driver = driver
+		self.rolled_back = False
+
+	def run(cls, cypher, parameters=None):
+		return cls.driver.run(cypher, parameters)
+
+	def rollback(cls):
+		cls.rolled_back = True
+		cls.driver.rollbacks += 1
+
+
+class RollbackDriver(FakeDriver):
+
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.rollbacks = 0
+
+	def session(cls):
+		session = super().session()
+		session.begin_transaction = lambda: FakeTransaction(cls)
+		return session
+
+
+class TestLatencyHistogram(TestCase):
+
+	def test_percentiles(cls):
+		histogram = query_profiler.LatencyHistogram()
+		assert histogram.percentile(50) is None
+
+		for latency_ms in [3] * 90 + [40] * 9 + [45000]:
+			histogram.record(latency_ms)
+		assert histogram.count == 100
+		assert histogram.percentile(50) == 5
+		assert histogram.percentile(95) == 50
+		assert histogram.percentile(99) == 50
+		assert histogram.percentile(100) == 45000
+		assert histogram.to_dict()['maxMs'] == 45000
+
+
+class TestQueryProfiler(TestCase):
+
+	query = trellis.DatabaseQuery(
+								  name = 'mergeFastq',
+								  cypher = "MERGE (fastq:Fastq {uri: $uri}) RETURN fastq",
+								  required_parameters = {'uri': 'str'},
+								  write_transaction = True,
+								  publish_to = [],
+								  returns = {'fastq': 'node'})
+
+	profile = {
+		'operatorType': 'ProduceResults@neo4j',
+		'args': {'Details': 'fastq'},
+		'rows': 1,
+		'dbHits': 0,
+		'children': [{
+			'operatorType': 'NodeByLabelScan@neo4j',
+			'args': {'Details': 'fastq:Fastq'},
+			'rows': 20000,
+			'dbHits': 20001,
+			'children': [],
+		}],
+	}
+
+	def test_record(cls):
+		profiler = query_profiler.QueryProfiler(threshold_ms=300, sample_rate=0)
+		assert not profiler.record('mergeFastq', make_summary(10, nodes_created=1, properties_set=4), total_ms=20)
+		assert profiler.record('mergeFastq', make_summary(400, properties_set=2))
+
+		stats = profiler.stats()['mergeFastq']
+		assert stats['available']['count'] == 2
+		assert stats['available']['maxMs'] == 400
+		assert stats['total']['maxMs'] == 401
+		assert stats['counters']['nodes_created'] == 1
+		assert stats['counters']['properties_set'] == 6
+
+	def test_sampled(cls):
+		profiler = query_profiler.QueryProfiler(threshold_ms=300, sample_rate=0.1, random=lambda: 0.05)
+		assert profiler.record('mergeFastq', make_summary(10))
+
+	def test_profile_interval(cls):
+		clock = FakeClock()
+		profiler = query_profiler.QueryProfiler(threshold_ms=300, profile_interval=600, clock=clock)
+		assert profiler.record('mergeFastq', make_summary(400))
+		clock.now = 599
+		assert not profiler.record('mergeFastq', make_summary(400))
+		# Limited per query
+		assert profiler.record('relateFastqMatePair', make_summary(400))
+		clock.now = 600
+		assert profiler.record('mergeFastq', make_summary(400))
+		assert profiler.stats()['mergeFastq']['available']['count'] == 3
+
+	def test_profile_through_admission(cls):
+		driver = RollbackDriver(lambda cypher, parameters: [], summary=make_summary(250, profile=cls.profile))
+		controller = admission.AdmissionController(admission.AIMDLimiter(initial_limit=4, latency_target_ms=300))
+		profiler = query_profiler.QueryProfiler()
+
+		with cls.assertLogs(level='WARNING'):
+			entry = profiler.profile(driver, cls.query, {'uri': 'a'}, make_summary(400), admission_controller=controller)
+		assert entry['dbHits'] == 20001
+		# PROFILE takes longer than the query; its latency is not reported
+		assert controller.stats()['lastLatencyMs'] is None
+		assert controller.stats()['limit'] == 4
+		assert controller.stats()['inFlight'] == 0
+
+	def test_profile_not_retried(cls):
+		def run_query(cypher, parameters):
+			raise ConnectionResetError()
+		driver = RollbackDriver(run_query)
+		controller = admission.AdmissionController(sleep=lambda seconds: None)
+		profiler = query_profiler.QueryProfiler()
+
+		with cls.assertLogs(level='WARNING'):
+			assert profiler.profile(driver, cls.query, {'uri': 'a'}, make_summary(400), admission_controller=controller) is None
+		assert len(driver.queries) == 1
+		assert controller.stats()['retries'] == 0
+
+	def test_profile_write_query_rolled_back(cls):
+		driver = RollbackDriver(lambda cypher, parameters: [], summary=make_summary(400, profile=cls.profile))
+		profiler = query_profiler.QueryProfiler()
+
+		with cls.assertLogs(level='WARNING'):
+			entry = profiler.profile(driver, cls.query, {'uri': 'gs://bucket/a.fastq.gz'}, make_summary(400))
+		assert driver.queries == [
+			("PROFILE MERGE (fastq:Fastq {uri: $uri}) RETURN fastq", {'uri': 'gs://bucket/a.fastq.gz'})]
+		assert driver.rollbacks == 1
+		assert entry['parameters'] == {'uri': 'gs://bucket/a.fastq.gz'}
+		assert entry['dbHits'] == 20001
+		assert entry['operators'][1] == {
+			'operator': 'NodeByLabelScan',
+			'details': 'fastq:Fastq',
+			'rows': 20000,
+			'dbHits': 20001,
+			'depth': 1,
+		}
+		assert list(profiler.slow_queries) == [entry]
+		assert profiler.stats()['mergeFastq']['profiles'] == 1
+
+	def test_create_query_explained(cls):
+		query = trellis.DatabaseQuery(
+									  name = 'createDsubJobNode',
+									  cypher = "CREATE (job:Job:Dsub {dsubJobId: $dsub_job_id}) RETURN job",
+									  required_parameters = {'dsub_job_id': 'str'},
+									  write_transaction = True,
+									  publish_to = [],
+									  returns = {'job': 'node'})
+		plan = {'operatorType': 'ProduceResults@neo4j', 'args': {'Details': 'job'}, 'children': [
+			{'operatorType': 'Create@neo4j', 'args': {'Details': '(job:Job:Dsub)'}, 'children': []}]}
+		summary = make_summary(400)
+		summary.plan = plan
+		driver = RollbackDriver(lambda cypher, parameters: [], summary=summary)
+		profiler = query_profiler.QueryProfiler()
+
+		with cls.assertLogs(level='WARNING'):
+			entry = profiler.profile(driver, query, {'dsub_job_id': 'job-1'}, make_summary(400))
+		assert driver.queries == [
+			("EXPLAIN CREATE (job:Job:Dsub {dsubJobId: $dsub_job_id}) RETURN job", {'dsub_job_id': 'job-1'})]
+		assert driver.rollbacks == 1
+		assert not entry['profiled']
+		assert [operator['operator'] for operator in entry['operators']] == ['ProduceResults', 'Create']
+
+	def test_profile_failure(cls):
+		def run_query(cypher, parameters):
+			raise ConnectionResetError()
+		driver = RollbackDriver(run_query)
+		profiler = query_profiler.QueryProfiler()
+
+		with cls.assertLogs(level='WARNING'):
+			assert profiler.profile(driver, cls.query, {'uri': 'a'}, make_summary(400)) is None
+		assert driver.rollbacks == 1
+		assert len(profiler.slow_queries) == 0
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+import json
+import mock
+import yaml
+import neo4j
+import threading
+
+from types import SimpleNamespace
+from unittest import TestCase
+
+import trellisdata as trellis
+
+from neo4j.exceptions import ServiceUnavailable
+
+import main
+import admission
+import streaming
+
+from test_main import FakeDriver
+from test_fanout import FanoutPublisher
+
+
+class BlockingPublisher(FanoutPublisher):
+	"""Publishes only after release is set."""
+
+	def __init__(self):
+		super().__init__()
+		self.release = threading.Event()
+
+	def publish(cls, topic_path, data):
+		cls.release.wait()
+		return super().publish(topic_path, data)
+
+
+class StreamTestCase(TestCase):
+
+	query = trellis.DatabaseQuery(
+								  name = 'relateFastqMatePair',
+								  cypher = "MATCH (fastq1:Fastq)-[rel:HAS_MATE_PAIR]->(fastq2:Fastq) RETURN fastq1, rel, fastq2",
+								  required_parameters = {'sample': 'str'},
+								  write_transaction = False,
+								  publish_to = ['TOPIC_TRIGGERS'],
+								  returns = [{'start': 'Fastq', 'relationship': 'HAS_MATE_PAIR', 'end': 'Fastq'}])
+
+	def setUp(cls):
+		cls.graph = neo4j.graph.Graph()
+		cls.nodes = [
+			neo4j.graph.Node(cls.graph, f"4:test:{index}", index, ['Fastq'], {'matePair': index % 2 + 1})
+			for index in range(4)]
+		cls.relationships = []
+		for index in range(0, 4, 2):
+			relationship = cls.graph.relationship_type('HAS_MATE_PAIR')(cls.graph, f"5:test:{index}", index, {})
+			relationship._start_node = cls.nodes[index]
+			relationship._end_node = cls.nodes[index + 1]
+			cls.relationships.append(relationship)
+		cls.records = [
+			neo4j.Record({'fastq1': cls.nodes[0], 'rel': cls.relationships[0], 'fastq2': cls.nodes[1]}),
+			neo4j.Record({'fastq1': cls.nodes[2], 'rel': cls.relationships[1], 'fastq2': cls.nodes[3]}),
+			neo4j.Record({'fastq1': cls.nodes[0], 'rel': cls.relationships[0], 'fastq2': cls.nodes[1]}),
+		]
+
+
+class TestEntityStream(StreamTestCase):
+
+	def test_returns_relationships(cls):
+		assert streaming.returns_relationships(cls.query)
+		node_query = trellis.DatabaseQuery(
+										   name = 'mergeFastq',
+										   cypher = "MERGE (fastq:Fastq {uri: $uri}) RETURN fastq",
+										   required_parameters = {'uri': 'str'},
+										   write_transaction = True,
+										   publish_to = [],
+										   returns = {'fastq': 'node'})
+		assert not streaming.returns_relationships(node_query)
+
+	def test_write_query_not_streamed(cls):
+		with mock.patch.object(cls.query, 'stream_results', True, create=True):
+			streaming.check_stream_results(cls.query)
+		write_query = trellis.DatabaseQuery(
+											name = 'relateFastqMatePair',
+											cypher = "MATCH (fastq1:Fastq), (fastq2:Fastq) MERGE (fastq1)-[rel:HAS_MATE_PAIR]->(fastq2) RETURN fastq1, rel, fastq2",
+											required_parameters = {'sample': 'str'},
+											write_transaction = True,
+											publish_to = ['TOPIC_TRIGGERS'],
+											returns = [{'start': 'Fastq', 'relationship': 'HAS_MATE_PAIR', 'end': 'Fastq'}])
+		write_query.stream_results = True
+		with cls.assertRaises(ValueError):
+			streaming.check_stream_results(write_query)
+		with cls.assertRaises(ValueError):
+			main.load_query_dict(yaml.dump(write_query))
+
+	def test_catalogue_queries(cls):
+		with open('../../config/database-queries.yaml') as file_handle:
+			main.load_query_dict(file_handle.read())
+
+	def test_relationships(cls):
+		entity_stream = streaming.EntityStream(relationships=True)
+		entities = [entity for record in cls.records for entity in entity_stream.new_entities(record)]
+		assert entities == cls.relationships
+
+	def test_entities_without_integer_id(cls):
+		# Newer servers only set element IDs
+		graph = neo4j.graph.Graph()
+		nodes = [neo4j.graph.Node(graph, f"4:test:{index}", None, ['Fastq'], {}) for index in range(2)]
+		entity_stream = streaming.EntityStream(relationships=False)
+		entities = list(entity_stream.new_entities(neo4j.Record({'fastq1': nodes[0], 'fastq2': nodes[1]})))
+		assert entities == nodes
+
+	def test_nodes(cls):
+		entity_stream = streaming.EntityStream(relationships=False)
+		entities = [entity for record in cls.records for entity in entity_stream.new_entities(record)]
+		assert entities == cls.nodes
+
+	def test_query_database_streaming(cls):
+		summary = SimpleNamespace(result_available_after=1)
+		driver = FakeDriver(lambda cypher, parameters: iter(cls.records), summary=summary)
+		entities = []
+
+		result_summary = main.query_database_streaming(driver, cls.query, {'sample': 'SAMPLE1'}, entities.append)
+		assert result_summary is summary
+		assert entities == cls.relationships
+
+	def test_stream_query_response_retried(cls):
+		summary = SimpleNamespace(result_available_after=1, counters={})
+		attempts = []
+
+		def run_query(cypher, parameters):
+			attempts.append(cypher)
+			yield cls.records[0]
+			if len(attempts) == 1:
+				raise ServiceUnavailable('Connection dropped')
+			yield from cls.records[1:]
+
+		driver = FakeDriver(run_query, summary=summary)
+		publisher = FanoutPublisher()
+		query_request = SimpleNamespace(seed_id=1, event_id=2, query_parameters={'sample': 'SAMPLE1'})
+		controller = admission.AdmissionController(sleep=lambda seconds: None)
+
+		with mock.patch.object(main, 'ADMISSION', controller), cls.assertLogs(level='WARNING'):
+			main.stream_query_response(query_request, cls.query, driver, publisher, 'test-project', {'TOPIC_TRIGGERS': 'trellis-check-triggers'})
+
+		assert len(attempts) == 2
+		# The relationship published before the error is not published again
+		relationships = [json.loads(data)['body']['relationship']['id'] for _, data in publisher.published]
+		assert relationships == [relationship.id for relationship in cls.relationships]
+
+
+class TestStreamingResponseWriter(StreamTestCase):
+
+	def test_entity_message(cls):
+		writer = streaming.StreamingResponseWriter(
+												   sender = 'db-query',
+												   seed_id = 1,
+												   previous_event_id = 2,
+												   query = cls.query,
+												   parameters = {'sample': 'SAMPLE1'})
+		message = writer.get_entity_message(cls.relationships[0])
+
+		summary = SimpleNamespace(metadata={}, server=None, counters=SimpleNamespace(), result_available_after=1)
+		expected = next(trellis.QueryResponseWriter(
+													sender = 'db-query',
+													seed_id = 1,
+													previous_event_id = 2,
+													query_name = cls.query.name,
+													result_summary = summary,
+													graph = SimpleNamespace(
+																			nodes = cls.nodes[:2],
+																			relationships = cls.relationships[:1])
+													).generate_separate_entity_jsons())
+		assert message['header'].keys() == expected['header'].keys()
+		assert message['body']['relationship'] == expected['body']['relationship']
+		assert message['body']['nodes'] == []
+		assert message['body']['resultSummary'] == {
+			'query': cls.query.cypher,
+			'parameters': {'sample': 'SAMPLE1'},
+			'streamed': True,
+		}
+
+
+class TestStreamPublisher(TestCase):
+
+	def test_published_to_all_topics(cls):
+		publisher = FanoutPublisher(failing=['trellis-job-launcher'])
+		stream_publisher = streaming.StreamPublisher(publisher, 'test-project', ['trellis-check-triggers', 'trellis-job-launcher'])
+		with cls.assertLogs(level='ERROR'):
+			for index in range(5):
+				stream_publisher.put({'body': {'index': index}})
+			counts, failures = stream_publisher.close()
+
+		assert counts == {'trellis-check-triggers': 5, 'trellis-job-launcher': 0}
+		assert failures == {'trellis-check-triggers': 0, 'trellis-job-launcher': 5}
+		assert [json.loads(data)['body']['index'] for _, data in publisher.published[::2]] == list(range(5))
+
+	def test_bounded_queue(cls):
+		publisher = BlockingPublisher()
+		stream_publisher = streaming.StreamPublisher(publisher, 'test-project', ['trellis-check-triggers'], queue_size=1)
+
+		def put_messages():
+			for index in range(3):
+				stream_publisher.put({'body': {'index': index}})
+		producer = threading.Thread(target=put_messages)
+		producer.start()
+		# One message is being published and one is queued
+		producer.join(timeout=0.2)
+		assert producer.is_alive()
+
+		publisher.release.set()
+		producer.join(timeout=5)
+		assert not producer.is_alive()
+		assert stream_publisher.close() == ({'trellis-check-triggers': 3}, {'trellis-check-triggers': 0})
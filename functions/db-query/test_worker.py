@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+
+import json
+import mock
+import neo4j
+
+from types import SimpleNamespace
+from concurrent.futures import Future
+from datetime import datetime, timezone
+from unittest import TestCase
+
+import trellisdata as trellis
+
+import main
+import worker
+import admission
+import plan_warmup
+
+from test_main import FakeDriver, GraphDriver
+
+
+class FakeMessage:
+
+	def __init__(self, message_id, query_name, query_parameters, cypher=None):
+		self.message_id = message_id
+		self.publish_time = datetime(2022, 7, 13, tzinfo=timezone.utc)
+		body = {
+			'queryName': query_name,
+			'queryParameters': query_parameters,
+			'custom': bool(cypher),
+		}
+		if cypher:
+			body.update({
+				'cypher': cypher,
+				'writeTransaction': True,
+				'aggregateResults': False,
+				'publishTo': ['TOPIC_TRIGGERS'],
+				'returns': {'fastq': 'node'},
+			})
+		self.data = json.dumps({
+			'header': {
+				'messageKind': 'queryRequest',
+				'sender': 'test',
+				'seedId': 1,
+				'previousEventId': 2,
+			},
+			'body': body,
+		}).encode('utf-8')
+		self.acked = False
+		self.nacked = False
+
+	def ack(cls):
+		cls.acked = True
+
+	def nack(cls):
+		cls.nacked = True
+
+
+class FakePublisher:
+
+	def __init__(self):
+		self.messages = []
+
+	def topic_path(cls, project_id, topic):
+		return f"projects/{project_id}/topics/{topic}"
+
+	def publish(cls, topic_path, data):
+		cls.messages.append((topic_path, json.loads(data)))
+		future = Future()
+		future.set_result(str(len(cls.messages)))
+		return future
+
+
+class FakeSummary:
+	"""Attributes of neo4j.ResultSummary used by db-query and QueryResponseWriter."""
+
+	def __init__(self):
+		self.metadata = {}
+		self.server = None
+		self.counters = SimpleNamespace(nodes_created=1)
+		self.result_available_after = 5
+		self.result_consumed_after = 1
+
+
+class FakeClock:
+
+	def __init__(self):
+		self.now = 0.0
+
+	def __call__(cls):
+		return cls.now
+
+
+class TestMicroBatcher(TestCase):
+
+	def setUp(cls):
+		cls.batches = []
+		cls.clock = FakeClock()
+		cls.batcher = worker.MicroBatcher(
+										  lambda key, items: cls.batches.append((key, items)),
+										  max_batch_size = 3,
+										  max_latency = 0.5,
+										  clock = cls.clock)
+
+	def test_full_batch(cls):
+		for item in range(4):
+			cls.batcher.add('mergeFastq', item)
+		cls.batcher.add('mergeBam', 'a')
+		assert cls.batches == [('mergeFastq', [0, 1, 2])]
+		assert len(cls.batcher) == 2
+
+	def test_batch_latency(cls):
+		cls.batcher.add('mergeFastq', 0)
+		cls.clock.now = 0.2
+		cls.batcher.add('mergeBam', 'a')
+		cls.assertAlmostEqual(cls.batcher.flush(), 0.5 - 0.2)
+		assert cls.batches == []
+
+		cls.clock.now = 0.5
+		cls.assertAlmostEqual(cls.batcher.flush(), 0.2)
+		assert cls.batches == [('mergeFastq', [0])]
+
+		assert cls.batcher.flush(force=True) == 0.5
+		assert cls.batches[-1] == ('mergeBam', ['a'])
+		assert len(cls.batcher) == 0
+
+
+class TestQueryWorker(TestCase):
+
+	query = trellis.DatabaseQuery(
+								  name = 'mergeFastq',
+								  cypher = "MERGE (fastq:Fastq {uri: $uri}) RETURN fastq",
+								  required_parameters = {'uri': 'str'},
+								  write_transaction = True,
+								  publish_to = ['TOPIC_TRIGGERS'],
+								  returns = {'fastq': 'node'})
+
+	def make_worker(cls, run_query):
+		cls.driver = FakeDriver(run_query, summary=FakeSummary())
+		cls.publisher = FakePublisher()
+		return worker.QueryWorker(
+								  cls.driver,
+								  {'mergeFastq': cls.query},
+								  publisher = cls.publisher,
+								  project_id = 'test-project',
+								  topics = {'TOPIC_TRIGGERS': 'trellis-check-triggers'},
+								  max_batch_size = 3,
+								  max_latency = 60,
+								  admission_controller = admission.AdmissionController(deadline=0))
+
+	def run_batch_query(cls, cypher, parameters):
+		graph = neo4j.graph.Graph()
+		return [
+				{'fastq': neo4j.graph.Node(graph, f"4:test:{row['batchIndex']}", row['batchIndex'], ['Fastq'], {'uri': row['uri']}),
+				 'batchIndex': row['batchIndex']}
+				for row in parameters['rows']]
+
+	def test_batch_acked_after_commit(cls):
+		query_worker = cls.make_worker(cls.run_batch_query)
+
+		messages = [FakeMessage(str(index), 'mergeFastq', {'uri': f"gs://bucket/{index}.fastq.gz"}) for index in range(3)]
+		messages.append(FakeMessage('3', 'mergeFastq', {'uri': 3}))
+		messages.append(FakeMessage('4', 'undefinedQuery', {}))
+		for message in messages:
+			query_worker.receive(message)
+		query_worker.stop()
+
+		# One transaction for the full batch; the remaining request is invalid
+		assert len(cls.driver.queries) == 1
+		assert all(message.acked for message in messages)
+		published = [message for _, message in cls.publisher.messages]
+		assert [message['body']['nodes'][0]['properties']['uri'] for message in published] == [
+			f"gs://bucket/{index}.fastq.gz" for index in range(3)]
+		assert [message['header']['previousEventId'] for message in published] == ['0', '1', '2']
+
+	def test_failed_batch_nacked(cls):
+		def run_query(cypher, parameters):
+			raise neo4j.exceptions.ServiceUnavailable('Database unavailable')
+		query_worker = cls.make_worker(run_query)
+
+		messages = [FakeMessage(str(index), 'mergeFastq', {'uri': f"gs://bucket/{index}.fastq.gz"}) for index in range(2)]
+		for message in messages:
+			query_worker.receive(message)
+		query_worker.stop()
+
+		assert all(message.nacked and not message.acked for message in messages)
+		assert cls.publisher.messages == []
+
+	def test_custom_queries_not_kept(cls):
+		query_worker = cls.make_worker(cls.run_batch_query)
+
+		# Custom queries with the same name and different Cypher
+		messages = [
+			FakeMessage(str(index), 'mergeCustomFastq', {'uri': f"gs://bucket/{index}.fastq.gz"},
+						cypher = f"MERGE (fastq:Fastq {{uri: $uri, index: {index}}}) RETURN fastq")
+			for index in range(2)]
+		for message in messages:
+			query_worker.receive(message)
+		query_worker.stop()
+
+		assert all(message.acked for message in messages)
+		# Each batch ran its own query
+		assert sorted(cypher for cypher, _ in cls.driver.queries) == [
+			f"UNWIND $rows AS batchRow CALL {{ WITH batchRow MERGE (fastq:Fastq {{uri: batchRow.uri, index: {index}}}) RETURN fastq }} " +
+			"RETURN *, batchRow.batchIndex AS batchIndex"
+			for index in range(2)]
+
+	def test_redundant_requests_run_once(cls):
+		redundant_query = trellis.DatabaseQuery(
+												name = 'mergeFastq',
+												cypher = "MERGE (fastq:Fastq {uri: $uri}) RETURN fastq",
+												required_parameters = {'uri': 'str'},
+												write_transaction = True,
+												publish_to = ['TOPIC_TRIGGERS'],
+												returns = {'fastq': 'node'})
+		redundant_query.redundant = True
+		query_worker = cls.make_worker(cls.run_batch_query)
+		query_worker.query_dict['mergeFastq'] = redundant_query
+
+		messages = [FakeMessage(str(index), 'mergeFastq', {'uri': f"gs://bucket/{index // 2}.fastq.gz"}) for index in range(4)]
+		with cls.assertLogs(level='INFO'):
+			for message in messages:
+				query_worker.receive(message)
+			query_worker.stop()
+
+		# One batch of the two distinct requests
+		assert len(cls.driver.queries) == 1
+		assert len(cls.driver.queries[0][1]['rows']) == 2
+		assert len(cls.publisher.messages) == 2
+		assert all(message.acked for message in messages)
+		assert query_worker.request_groups.stats()['saved'] == 2
+
+
+class TestCommittedRequests(TestCase):
+
+	query = trellis.DatabaseQuery(
+								  name = 'createDsubJobNode',
+								  cypher = "CREATE (dsubJob:DsubJob {dsubJobId: $dsubJobId}) RETURN dsubJob",
+								  required_parameters = {'dsubJobId': 'str'},
+								  write_transaction = True,
+								  publish_to = ['TOPIC_TRIGGERS'],
+								  returns = {'dsubJob': 'node'})
+
+	def setUp(cls):
+		# dsubJobId of nodes committed by earlier attempts, and whether
+		# a node with the same ID but other properties exists
+		cls.existing = {'job-0': True, 'job-1': False}
+		cls.graph = neo4j.graph.Graph()
+
+	def run_query(cls, cypher, parameters):
+		if 'rows' in parameters:
+			raise neo4j.exceptions.ConstraintError('Node already exists')
+		job_id = parameters['dsubJobId']
+		if job_id in cls.existing and (cypher.startswith('CREATE') or not cls.existing[job_id]):
+			raise neo4j.exceptions.ConstraintError('Node already exists')
+		if job_id == 'job-3':
+			raise neo4j.exceptions.ServiceUnavailable('Connection lost')
+		return [{'dsubJob': neo4j.graph.Node(cls.graph, f"4:test:{job_id}", 0, ['DsubJob'], {'dsubJobId': job_id})}]
+
+	def make_worker(cls):
+		cls.driver = GraphDriver(cls.run_query, summary=FakeSummary())
+		cls.publisher = FakePublisher()
+		return worker.QueryWorker(
+								  cls.driver,
+								  {'createDsubJobNode': cls.query},
+								  publisher = cls.publisher,
+								  project_id = 'test-project',
+								  topics = {'TOPIC_TRIGGERS': 'trellis-check-triggers'},
+								  max_batch_size = 4,
+								  max_latency = 60,
+								  admission_controller = admission.AdmissionController(deadline=0))
+
+	def test_existing_query(cls):
+		existing_query = worker.get_existing_query(cls.query)
+		assert existing_query.cypher == "MERGE (dsubJob:DsubJob {dsubJobId: $dsubJobId}) RETURN dsubJob"
+		assert cls.query.cypher.startswith('CREATE')
+		assert worker.get_existing_query(TestQueryWorker.query) is None
+
+	def test_committed_request_published(cls):
+		query_worker = cls.make_worker()
+		messages = [FakeMessage(str(index), 'createDsubJobNode', {'dsubJobId': f"job-{index}"}) for index in range(4)]
+		with cls.assertLogs(level='INFO'):
+			for message in messages:
+				query_worker.receive(message)
+			query_worker.stop()
+
+		# Created before, created now, and conflicting requests are done
+		assert [message.acked for message in messages] == [True, True, True, False]
+		assert messages[3].nacked
+		published = [message['body']['nodes'][0]['properties']['dsubJobId'] for _, message in cls.publisher.messages]
+		assert sorted(published) == ['job-0', 'job-2']
+
+	def test_plan_error(cls):
+		query_worker = cls.make_worker()
+		plan_error = plan_warmup.QueryCompileError('createDsubJobNode', neo4j.exceptions.CypherSyntaxError('Invalid input'))
+		messages = [FakeMessage(str(index), 'createDsubJobNode', {'dsubJobId': f"job-{index}"}) for index in range(2)]
+		with mock.patch.dict(main.PLAN_ERRORS, {'createDsubJobNode': plan_error}), cls.assertLogs(level='ERROR'):
+			for message in messages:
+				query_worker.receive(message)
+			query_worker.stop()
+
+		assert all(message.acked for message in messages)
+		assert cls.driver.queries == []
@@ -0,0 +1,481 @@
+#!/usr/bin/env python3
+"""Long-running db-query worker that runs query requests in batches.
+
+Pulls query requests from a subscription to the TOPIC_DB_QUERY topic,
+groups them by query over a short window and runs each group as one
+transaction with main.query_database_batch(). Requests are resolved and
+responses published with the same functions db_query uses, and messages
+are only acked after the transaction has committed and the response has
+been published; anything else is nacked so Pub/Sub redelivers it.
+Identical requests of queries marked `redundant: true` that arrive while
+the first one waits for its batch are answered by its execution (see
+query_coalescing.RequestGroups).
+
+Run from this directory, like the tests, after copying
+functions/shared/lazy_clients.py here.
+
+Examples:
+    # Local Pub/Sub emulator and Neo4j
+    export PUBSUB_EMULATOR_HOST=localhost:8085
+    python worker.py --project test-project --subscription db-query-worker \
+        --config ../../config/trellis-configuration.yaml \
+        --queries ../../config/database-queries.yaml \
+        --neo4j-uri bolt://localhost:7687 --neo4j-password test
+
+    # Configuration from GCS, like the function
+    CREDENTIALS_BUCKET=... CREDENTIALS_BLOB=... python worker.py \
+        --project my-project --subscription trellis-db-query-worker \
+        --credentials-bucket my-credentials-bucket
+"""
+
+import os
+import sys
+import copy
+import time
+import yaml
+import base64
+import logging
+import argparse
+import threading
+
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+
+from neo4j.exceptions import ConstraintError, CypherSyntaxError, CypherTypeError
+
+import main
+import fanout
+import admission
+import plan_warmup
+import lazy_clients
+import connection_pool
+import query_catalogue
+import query_coalescing
+import trellisdata as trellis
+
+# Results for these errors won't change when the request is retried:
+# invalid requests and queries the database can't compile
+PERMANENT_ERRORS = (
+                    ValueError,
+                    KeyError,
+                    CypherSyntaxError,
+                    CypherTypeError,
+                    plan_warmup.QueryCompileError)
+
+
+def get_existing_query(database_query):
+    """Get a query that finds what a CREATE query created before.
+
+    A CREATE query fails on a uniqueness constraint when an earlier
+    attempt of the request committed, e.g. before a lost connection or a
+    batch that was run again. With MERGE in place of CREATE, it matches
+    the entities created with the same properties, and still fails if the
+    constraint is violated by different ones.
+
+    Args:
+        database_query (trellis.DatabaseQuery): Write query.
+    Returns:
+        (trellis.DatabaseQuery): Query with MERGE clauses, or None if
+            the query doesn't create entities.
+    """
+    if not database_query.write_transaction or not admission.CREATE_PATTERN.search(database_query.cypher):
+        return None
+    existing_query = copy.copy(database_query)
+    existing_query.cypher = admission.CREATE_PATTERN.sub('MERGE', database_query.cypher)
+    return existing_query
+
+
+class MicroBatcher:
+
+    def __init__(self, process_batch, max_batch_size=100, max_latency=0.5, clock=time.monotonic):
+        """Group items by key and pass them on in batches.
+
+        A batch is passed on when it has max_batch_size items or, on the
+        next flush(), when its first item has waited max_latency seconds.
+
+        Args:
+            process_batch (callable): Called with (key, items) for every batch.
+            max_batch_size (int): Largest batch.
+            max_latency (float): Seconds an item waits for its batch to fill.
+            clock (callable): Returns the current time in seconds.
+        """
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.clock = clock
+        # {key: (time of first item, items)}
+        self._batches = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(items) for _, items in self._batches.values())
+
+    def add(self, key, item):
+        with self._lock:
+            batch = self._batches.get(key)
+            if batch is None:
+                batch = self._batches[key] = (self.clock(), [])
+            batch[1].append(item)
+            if len(batch[1]) < self.max_batch_size:
+                return
+            del self._batches[key]
+        self.process_batch(key, batch[1])
+
+    def flush(self, force=False):
+        """Pass on batches that have waited max_latency seconds.
+
+        Args:
+            force (bool): Pass on all batches.
+        Returns:
+            (float): Seconds until the next batch is due.
+        """
+        now = self.clock()
+        with self._lock:
+            due = [
+                   key for key, (first_time, _) in self._batches.items()
+                   if force or now - first_time >= self.max_latency]
+            batches = [(key, self._batches.pop(key)[1]) for key in due]
+            next_due = min(
+                           (first_time + self.max_latency - now for first_time, _ in self._batches.values()),
+                           default=self.max_latency)
+        for key, items in batches:
+            self.process_batch(key, items)
+        return next_due
+
+
+def get_request_latency(results):
+    """Average result availability time per request of a batch, in ms.
+
+    Used as the latency of batch transactions, so the limiter compares
+    batches of any size against the same per-query latency target.
+    """
+    for result in results:
+        if not isinstance(result, Exception):
+            return result[1].result_available_after / len(results)
+    return None
+
+
+def read_query_request(message):
+    """Read a pulled Pub/Sub message like the db_query function event.
+
+    Args:
+        message (google.cloud.pubsub_v1.subscriber.message.Message): Query request.
+    Returns:
+        (trellis.QueryRequestReader): Parsed request.
+    """
+    event = {'data': base64.b64encode(message.data)}
+    context = SimpleNamespace(
+                              event_id = message.message_id,
+                              timestamp = message.publish_time.isoformat())
+    return trellis.QueryRequestReader(event=event, context=context)
+
+
+class QueryWorker:
+
+    def __init__(
+                 self,
+                 driver,
+                 query_dict,
+                 publisher=None,
+                 project_id=None,
+                 topics=None,
+                 catalogues=None,
+                 max_batch_size=100,
+                 max_latency=0.5,
+                 workers=4,
+                 admission_controller=None):
+        """
+        Args:
+            driver (neo4j.Driver): Official Neo4j Python driver
+            query_dict (dict): Predefined queries by name.
+            publisher (pubsub.PublisherClient): Client used to publish
+                responses; responses aren't published without one.
+            project_id (str): Google Cloud project of the response topics.
+            topics (dict): Topic names by Trellis configuration key.
+            catalogues (dict): blob_catalogue and job_catalogue arguments
+                of main.register_custom_query(); custom queries aren't
+                registered without them.
+            max_batch_size (int): Most requests run in one transaction.
+            max_latency (float): Seconds a request waits for its batch.
+            workers (int): Batches run at the same time.
+            admission_controller (admission.AdmissionController): Limits
+                and retries batch transactions; defaults to main.ADMISSION.
+        """
+        self.driver = driver
+        self.query_dict = query_dict
+        self.publisher = publisher
+        self.project_id = project_id
+        self.topics = topics
+        self.catalogues = catalogues
+        self.admission = admission_controller or main.ADMISSION
+
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.batcher = MicroBatcher(self._submit_batch, max_batch_size, max_latency)
+        # Identical requests of redundant queries run once
+        self.request_groups = query_coalescing.RequestGroups()
+        self._stopped = threading.Event()
+
+    def get_database_query(self, query_request):
+        if query_request.custom:
+            database_query = main.create_custom_query(query_request)
+            if self.catalogues:
+                main.register_custom_query(database_query, **self.catalogues)
+            return database_query
+        return main.get_catalogue_query(query_request, self.query_dict)
+
+    def receive(self, message):
+        """Subscriber callback: add a query request to its batch."""
+        try:
+            query_request = read_query_request(message)
+            database_query = self.get_database_query(query_request)
+        except PERMANENT_ERRORS as error:
+            # The function would fail on this message every time as well
+            logging.error(f"> db-query-worker: Dropping invalid query request {message.message_id}: {error}.")
+            message.ack()
+            return
+
+        # Custom queries with the same name can differ. The query travels
+        # with the request, so no query is kept after its batch has run
+        key = (database_query.name, query_catalogue.get_query_digest(database_query))
+        if query_coalescing.is_redundant(database_query):
+            message = self.request_groups.add(database_query.name, query_request.query_parameters, message)
+            if message is None:
+                # Answered with an identical request waiting for its batch
+                return
+        self.batcher.add(key, (message, query_request, database_query))
+
+    def _submit_batch(self, key, items):
+        self.executor.submit(self.run_batch, key, items)
+
+    def run_batch(self, key, items):
+        """Run a batch of requests and ack the messages that are done.
+
+        Args:
+            key (tuple): Query name and digest.
+            items (list): (message, query request, database query) tuples.
+                The message is a query_coalescing.RequestGroup for
+                requests of redundant queries.
+        """
+        # Requests with the same key have the same query
+        database_query = items[0][2]
+        logging.info(f"> db-query-worker: Running {len(items)} '{database_query.name}' requests.")
+        for message, query_request, _ in items:
+            if isinstance(message, query_coalescing.RequestGroup):
+                self.request_groups.close(message, query_request.query_parameters)
+        try:
+            # Fail without waiting for the database to reject it again
+            main.check_plan_error(database_query)
+        except plan_warmup.QueryCompileError as error:
+            logging.error(f"> db-query-worker: Dropping {len(items)} '{database_query.name}' requests: {error}.")
+            for message, _, _ in items:
+                message.ack()
+            return
+        try:
+            results = self.admission.run(
+                                         main.query_database_batch,
+                                         self.driver,
+                                         database_query,
+                                         [query_request.query_parameters for _, query_request, _ in items],
+                                         latency = get_request_latency,
+                                         retryable = admission.get_retry_check(database_query))
+        except Exception as error:
+            # Messages have to be nacked or they stay leased
+            logging.error(f"> db-query-worker: Batch of '{database_query.name}' requests failed: {error}.")
+            for message, _, _ in items:
+                message.nack()
+            return
+
+        for (message, query_request, _), result in zip(items, results):
+            if isinstance(result, ConstraintError):
+                result = self.find_existing(database_query, query_request, result)
+            # Constraint errors left are violated by other entities
+            if isinstance(result, PERMANENT_ERRORS + (ConstraintError,)):
+                logging.error(f"> db-query-worker: Query request {message.message_id} failed: {result}.")
+                message.ack()
+                continue
+            elif isinstance(result, Exception):
+                logging.warning(f"> db-query-worker: Query request {message.message_id} will be retried: {result}.")
+                message.nack()
+                continue
+
+            graph, result_summary = result
+            try:
+                query_response = main.create_query_response(query_request, database_query, graph, result_summary)
+                if self.publisher and database_query.publish_to:
+                    main.publish_query_response(
+                                                query_response,
+                                                database_query,
+                                                publisher = self.publisher,
+                                                project_id = self.project_id,
+                                                topics = self.topics)
+            except Exception as error:
+                # Redelivery runs the query again, as a function retry would
+                logging.error(f"> db-query-worker: Could not publish response to {message.message_id}: {error}.")
+                message.nack()
+                continue
+            message.ack()
+        logging.info(f"> db-query-worker: Admission state: {self.admission.stats()}.")
+        logging.info(f"> db-query-worker: Coalescing stats: {self.request_groups.stats()}.")
+        logging.info(f"> db-query-worker: Connection pool timing: {main.POOL_METRICS.stats()}.")
+
+    def find_existing(self, database_query, query_request, error):
+        """Get the result of a request that an earlier attempt committed.
+
+        Args:
+            database_query (trellis.DatabaseQuery): Query that failed.
+            query_request (trellis.QueryRequestReader): Failed request.
+            error (neo4j.exceptions.ConstraintError): Error of the request.
+        Returns:
+            (tuple): (graph, result_summary) of the existing entities, or
+                the error if they were not created by this request.
+        """
+        existing_query = get_existing_query(database_query)
+        if not existing_query:
+            return error
+        try:
+            result = self.admission.run(
+                                        main.query_database,
+                                        self.driver,
+                                        existing_query,
+                                        query_request.query_parameters,
+                                        latency = lambda result: result[1].result_available_after,
+                                        retryable = admission.get_retry_check(existing_query))
+        except Exception as existing_error:
+            return existing_error
+        logging.info(
+                     f"> db-query-worker: '{database_query.name}' request {query_request.event_id} " +
+                     "was already committed; publishing the existing entities.")
+        return result
+
+    def _flush_batches(self):
+        while not self._stopped.is_set():
+            self._stopped.wait(self.batcher.flush())
+
+    def run(self, subscription_path, max_messages=1000):
+        """Pull and process query requests until interrupted.
+
+        Args:
+            subscription_path (str): Subscription to the db-query topic.
+            max_messages (int): Most unacked messages held by the worker.
+        """
+        from google.cloud import pubsub_v1
+
+        subscriber = pubsub_v1.SubscriberClient()
+        flow_control = pubsub_v1.types.FlowControl(max_messages=max_messages)
+        streaming_pull = subscriber.subscribe(subscription_path, callback=self.receive, flow_control=flow_control)
+        flusher = threading.Thread(target=self._flush_batches, daemon=True)
+        flusher.start()
+        logging.info(f"> db-query-worker: Listening on {subscription_path}.")
+        try:
+            streaming_pull.result()
+        except KeyboardInterrupt:
+            streaming_pull.cancel()
+            streaming_pull.result()
+        finally:
+            self.stop()
+            subscriber.close()
+
+    def stop(self):
+        """Run the remaining batches and wait for them to finish."""
+        self._stopped.set()
+        self.batcher.flush(force=True)
+        self.executor.shutdown(wait=True)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--project', default=os.environ.get('PROJECT_ID'), help='Google Cloud project.')
+    parser.add_argument('--subscription', required=True, help='Subscription to the db-query topic.')
+    parser.add_argument('--queries', default='database-queries.yaml', help='Predefined database queries.')
+    parser.add_argument(
+                        '--config',
+                        help='Local Trellis configuration YAML. Default: CREDENTIALS_BUCKET/CREDENTIALS_BLOB.')
+    parser.add_argument('--neo4j-uri', help='Default: from the Trellis configuration.')
+    parser.add_argument('--neo4j-password', help='Default: from the Trellis configuration.')
+    parser.add_argument(
+                        '--credentials-bucket',
+                        help='Bucket with the custom query catalogues; custom queries are not registered without it.')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--batch-latency', type=float, default=0.5, help='Seconds to wait for a batch to fill.')
+    parser.add_argument('--max-messages', type=int, default=1000, help='Flow control limit on unacked messages.')
+    parser.add_argument('--workers', type=int, default=4, help='Batches run at the same time.')
+    parser.add_argument(
+                        '--plan-warm-up',
+                        type=float,
+                        help='Seconds to spend planning the queries with EXPLAIN before receiving messages. ' +
+                             f"Default: {plan_warmup.WARM_UP_BUDGET_KEY} from the Trellis configuration.")
+    args = parser.parse_args(argv)
+
+    if not args.project:
+        parser.error('--project or PROJECT_ID is required.')
+    return args
+
+
+def main_cli(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    from neo4j import GraphDatabase
+    from google.cloud import pubsub_v1
+
+    if args.config:
+        with open(args.config) as file_handle:
+            trellis_config = yaml.safe_load(file_handle)
+    else:
+        trellis_config = lazy_clients.TRELLIS
+
+    neo4j_uri = args.neo4j_uri or (
+        f"{trellis_config['NEO4J_SCHEME']}://{trellis_config['NEO4J_IP_ADDRESS']}:{trellis_config['NEO4J_PORT']}")
+    neo4j_password = args.neo4j_password or trellis_config['NEO4J_PASSPHRASE']
+    driver_config = connection_pool.get_driver_config(trellis_config)
+    # Each batch thread needs its own connection
+    driver_config['max_connection_pool_size'] = max(driver_config['max_connection_pool_size'], args.workers)
+    driver = GraphDatabase.driver(neo4j_uri, auth=("neo4j", neo4j_password), **driver_config)
+    connection_pool.warm_up(driver, args.workers)
+
+    with open(args.queries) as file_handle:
+        query_dict = main.load_query_dict(file_handle.read())
+
+    # Requests for a query that doesn't compile fail without running it,
+    # like in the function
+    time_budget = args.plan_warm_up
+    if time_budget is None:
+        time_budget = float(trellis_config.get(plan_warmup.WARM_UP_BUDGET_KEY) or 0)
+    if time_budget:
+        try:
+            plan_warmup.warm_up_plans(
+                                      driver,
+                                      query_dict.values(),
+                                      time_budget,
+                                      batch_cypher = main.get_batch_cypher)
+        except plan_warmup.QueryCompileError as error:
+            logging.error(str(error))
+            main.PLAN_ERRORS[error.query_name] = error
+
+    catalogues = None
+    if args.credentials_bucket:
+        catalogues = {
+            'blob_catalogue': query_catalogue.QueryCatalogue(args.credentials_bucket, trellis_config['CREATE_BLOB_QUERIES']),
+            'job_catalogue': query_catalogue.QueryCatalogue(args.credentials_bucket, trellis_config['CREATE_JOB_QUERIES']),
+        }
+
+    worker = QueryWorker(
+                         driver,
+                         query_dict,
+                         publisher = fanout.create_publisher(),
+                         project_id = args.project,
+                         topics = trellis_config,
+                         catalogues = catalogues,
+                         max_batch_size = args.batch_size,
+                         max_latency = args.batch_latency,
+                         workers = args.workers)
+    subscription_path = pubsub_v1.SubscriberClient.subscription_path(args.project, args.subscription)
+    try:
+        worker.run(subscription_path, max_messages=args.max_messages)
+    finally:
+        driver.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
@@ -1,5 +1,4 @@
 import os
-import pdb
 import sys
 import json
 import time
@@ -9,13 +8,11 @@ import base64
 import random
 import hashlib
 
+import lazy_clients
+import response_chunks
 import trellisdata as trellis
 
-from google.cloud import storage
-from google.cloud import pubsub
-
 from datetime import datetime
-from dsub.commands import dsub
 
 from envyaml import EnvYAML
 
@@ -38,9 +35,13 @@ if ENVIRONMENT == 'google-cloud':
     ENABLE_JOB_LAUNCH = os.environ['ENABLE_JOB_LAUNCH']
     TOPIC_DB_QUERY = os.environ['TOPIC_DB_QUERY']
 
-    PUBLISHER = pubsub.PublisherClient()
+    # Created on first use
+    PUBLISHER = lazy_clients.PUBLISHER
 
 def launch_dsub_task(dsub_args):
+    # dsub pulls in the Google API client libraries; only import it
+    # when a job is actually launched
+    from dsub.commands import dsub
     try:
         result = dsub.dsub_main('dsub', dsub_args)
     except ValueError as exception:
@@ -114,9 +115,13 @@ def launch_job(event, context):
             context (google.cloud.functions.Context): Metadata for the event.
     """
     
-    query_response = trellis.QueryResponseReader(
+    # Also reads compressed responses. Responses split into parts are
+    # not joined here; db-query only splits responses for check-triggers
+    query_response = response_chunks.QueryResponsePart(
                         context = context,
                         event = event)
+    if query_response.chunk_count > 1:
+        raise ValueError(f"> job-launcher: Expected a complete query response, but got part {query_response.chunk_index} of {query_response.chunk_count}.")
 
     logging.info(f"> job-launcher: Received message (context): {query_response.context}.")
     logging.info(f"> job-launcher: Message header: {query_response.header}.")
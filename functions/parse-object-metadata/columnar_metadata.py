@@ -0,0 +1,136 @@
+import iso8601
+import numpy as np
+
+import trellisdata as trellis
+
+# Variable-width strings; fixed-width unicode arrays would use 4 bytes per
+# character of the longest object name for every row.
+STRING_DTYPE = np.dtypes.StringDType()
+
+NAME_FIELDS = ['bucket', 'path', 'dirname', 'basename', 'name', 'extension', 'filetype', 'uri']
+TIME_FIELDS = ['timeCreatedEpoch', 'timeUpdatedEpoch', 'timeCreatedIso', 'timeUpdatedIso']
+
+
+def _strings(values):
+    return np.asarray(values, dtype=STRING_DTYPE)
+
+
+def get_name_columns(event_names, event_buckets):
+    """Columnar version of get_name_fields() for a batch of objects.
+
+    Args:
+        event_names (list): Object paths.
+        event_buckets (str, list): Bucket name shared by all objects,
+            or one bucket name per object.
+    Returns:
+        (dict): Name field columns as NumPy string arrays.
+    """
+    paths = _strings(event_names)
+    buckets = np.broadcast_to(_strings(event_buckets), paths.shape)
+
+    slash = _strings('/')
+    dot = _strings('.')
+    dirnames, _, basenames = np.strings.rpartition(paths, slash)
+    names, _, extensions = np.strings.partition(basenames, dot)
+    # Without a '.', rpartition puts the whole basename in the tail,
+    # matching name_elements[-1] in get_name_fields()
+    _, _, filetypes = np.strings.rpartition(basenames, dot)
+    uris = np.strings.add(np.strings.add(np.strings.add(_strings('gs://'), buckets), slash), paths)
+
+    return {
+            'bucket': buckets,
+            'path': paths,
+            'dirname': dirnames,
+            'basename': basenames,
+            'name': names,
+            'extension': extensions,
+            'filetype': filetypes,
+            'uri': uris,
+    }
+
+
+def _parse_timestamps(timestamps):
+    """Parse RFC 3339 timestamps into epoch seconds and ISO strings.
+
+    GCS timestamps ("2020-02-19T01:31:55.288Z") are parsed with NumPy
+    datetime64. Anything else falls back to iso8601, as in get_time_fields().
+
+    Returns:
+        (tuple): (epoch seconds float array, ISO string array)
+    """
+    timestamps = _strings(timestamps)
+    epochs = np.empty(timestamps.shape, dtype=np.float64)
+    isos = np.empty(timestamps.shape, dtype=STRING_DTYPE)
+
+    utc = np.strings.endswith(timestamps, _strings('Z'))
+    try:
+        datetimes = np.strings.rstrip(timestamps[utc], _strings('Z')).astype('datetime64[us]')
+    except ValueError:
+        utc[:] = False
+    else:
+        microseconds = datetimes.astype(np.int64)
+        # Same float as timedelta.total_seconds(): an exact integer divided once
+        epochs[utc] = microseconds / 1e6
+        # datetime.isoformat() drops the fraction for whole seconds
+        whole_seconds = microseconds % 1_000_000 == 0
+        isos[utc] = np.strings.add(
+                                   np.where(
+                                            whole_seconds,
+                                            np.datetime_as_string(datetimes, unit='s'),
+                                            np.datetime_as_string(datetimes, unit='us')).astype(STRING_DTYPE),
+                                   _strings('+00:00'))
+
+    for index in np.flatnonzero(~utc):
+        datetime_value = iso8601.parse_date(str(timestamps[index]))
+        epochs[index] = trellis.utils.get_seconds_from_epoch(datetime_value)
+        isos[index] = datetime_value.isoformat()
+    return epochs, isos
+
+
+def get_time_columns(time_created, time_updated):
+    """Columnar version of get_time_fields() for a batch of objects.
+
+    Args:
+        time_created (list): 'timeCreated' values of the object events.
+        time_updated (list): 'updated' values of the object events.
+    Returns:
+        (dict): Time field columns as NumPy arrays.
+    """
+    created_epochs, created_isos = _parse_timestamps(time_created)
+    updated_epochs, updated_isos = _parse_timestamps(time_updated)
+    return {
+            'timeCreatedEpoch': created_epochs,
+            'timeUpdatedEpoch': updated_epochs,
+            'timeCreatedIso': created_isos,
+            'timeUpdatedIso': updated_isos,
+    }
+
+
+def get_metadata_columns(events):
+    """Get name and time field columns for a batch of object events.
+
+    Args:
+        events (list): GCS object events/resources.
+    Returns:
+        (dict): Name and time field columns.
+    """
+    columns = get_name_columns(
+                               [event['name'] for event in events],
+                               [event['bucket'] for event in events])
+    columns.update(get_time_columns(
+                                    [event['timeCreated'] for event in events],
+                                    [event['updated'] for event in events]))
+    return columns
+
+
+def iterate_records(columns):
+    """Convert columns back to one dict per object.
+
+    Yields:
+        (dict): The same fields get_name_fields() and get_time_fields()
+            return for a single object, with Python str/float values.
+    """
+    fields = list(columns.keys())
+    values = [columns[field].tolist() for field in fields]
+    for row in zip(*values):
+        yield dict(zip(fields, row))
@@ -1,19 +1,12 @@
 import os
-import re
-import pdb
 import json
 import uuid
-import yaml
 import iso8601
-import importlib
 
+import event_dedup
+import lazy_clients
 import trellisdata as trellis
 
-from collections import deque
-
-from google.cloud import storage
-from google.cloud import pubsub
-
 ENVIRONMENT = os.environ.get('ENVIRONMENT', 'Environment variable not set')
 if ENVIRONMENT == 'google-cloud':
 
@@ -27,9 +20,17 @@ if ENVIRONMENT == 'google-cloud':
     FUNCTION_NAME = os.environ['K_SERVICE']
     PROJECT_ID = os.environ['PROJECT_ID']
 
-    PUBLISHER = pubsub.PublisherClient()
+    # Clients are created on first use
+    PUBLISHER = lazy_clients.PUBLISHER
     # Storage client is used for adding UUIDs to blobs
-    STORAGE_CLIENT = storage.Client()
+    STORAGE_CLIENT = lazy_clients.STORAGE_CLIENT
+else:
+    FUNCTION_NAME = 'parse-object-metadata-local'
+
+# Only deduplicate locally when DEDUP_DATABASE is set
+EVENT_DEDUPLICATOR = event_dedup.get_deduplicator(
+                                                  namespace = FUNCTION_NAME,
+                                                  enabled = ENVIRONMENT == 'google-cloud')
 
 def get_name_fields(event_name, event_bucket):
     """
@@ -106,6 +107,7 @@ def add_metadata_to_object(metadata_fields):
 
     return blob.metadata
 
+@event_dedup.skip_duplicates(EVENT_DEDUPLICATOR)
 def parse_object_metadata(event, context, test=False):
     """When object created in bucket, add metadata to database.
     Args:
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+from unittest import TestCase
+
+import main
+import columnar_metadata
+
+
+class TestColumnarMetadata(TestCase):
+
+	events = [
+		{
+			'bucket': 'gcp-bucket-mvp-test-from-personalis',
+			'name': 'va_mvp_phase2/PLATE0/SAMPLE0/FASTQ/SAMPLE0_0_R1.fastq.gz',
+			'timeCreated': '2020-02-19T01:31:55.288Z',
+			'updated': '2022-02-28T21:13:19.739Z',
+		},
+		{
+			'bucket': 'gcp-bucket-mvp-test-from-personalis',
+			'name': 'checksum.txt',
+			'timeCreated': '2020-02-19T01:31:55Z',
+			'updated': '2022-02-28T21:13:19.000Z',
+		},
+		{
+			'bucket': 'other-bucket',
+			'name': 'va_mvp_phase2/PLATE0/SAMPLE0/README',
+			'timeCreated': '1969-12-31T23:59:59.999Z',
+			'updated': '2022-02-28T23:13:19.739+02:00',
+		},
+		{
+			'bucket': 'other-bucket',
+			'name': 'dsub/vcfstats/objects/.hidden/',
+			'timeCreated': '2020-02-19T01:31:55.288123Z',
+			'updated': '2022-02-28T21:13:19.1Z',
+		},
+	]
+
+	def test_name_and_time_parity(cls):
+		columns = columnar_metadata.get_metadata_columns(cls.events)
+
+		for event, record in zip(cls.events, columnar_metadata.iterate_records(columns)):
+			expected = main.get_name_fields(
+											event_name = event['name'],
+											event_bucket = event['bucket'])
+			expected.update(main.get_time_fields(event))
+			assert record == expected
+			assert [type(value) for value in record.values()] == [type(value) for value in expected.values()]
+
+	def test_unparsable_timestamps_fall_back(cls):
+		epochs, isos = columnar_metadata._parse_timestamps(['20200219T013155Z', '2020-02-19T01:31:55.288Z'])
+
+		assert epochs.tolist() == [1582075915.0, 1582075915.288]
+		assert isos.tolist() == ['2020-02-19T01:31:55+00:00', '2020-02-19T01:31:55.288000+00:00']
@@ -0,0 +1,202 @@
+"""Skip repeated object events.
+
+Pub/Sub delivers messages at least once and GCS emits repeated finalize
+and metadata events for the same object generation. Functions check
+events against an EventDeduplicator before doing any work.
+
+This module lives in functions/shared/ and is copied into each function
+directory at build time (see the function cloudbuild.yaml files).
+"""
+
+import os
+import logging
+import functools
+import threading
+
+from collections import OrderedDict
+
+DEFAULT_CACHE_SIZE = 10000
+
+# Event fields that, with the event ID, identify a repeated event. Add
+# metageneration for metadataUpdate triggers, where every update of a
+# generation has the same ID.
+GENERATION_FIELDS = ('generation',)
+METAGENERATION_FIELDS = ('generation', 'metageneration')
+
+
+class SqliteBackend:
+
+    def __init__(self, path):
+        """Persistent record of processed event keys in a SQLite database.
+
+        Args:
+            path (str): Path to the database file. Can be shared by
+                several functions; keys are namespaced by the deduplicator.
+        """
+        # Only needed with a persistent backend; keep it out of cold starts
+        import sqlite3
+
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS processed_events ("
+            "key TEXT PRIMARY KEY, "
+            "created INTEGER DEFAULT (strftime('%s', 'now')))")
+
+    def claim(self, key):
+        """Record a key if it has not been seen.
+
+        Returns:
+            (bool): True if the key was new, False if already recorded.
+        """
+        with self._lock:
+            cursor = self._connection.execute(
+                "INSERT OR IGNORE INTO processed_events (key) VALUES (?)", (key,))
+            return cursor.rowcount == 1
+
+    def forget(self, key):
+        with self._lock:
+            self._connection.execute("DELETE FROM processed_events WHERE key = ?", (key,))
+
+    def close(self):
+        self._connection.close()
+
+
+class EventDeduplicator:
+
+    def __init__(self, namespace, backend=None, max_entries=DEFAULT_CACHE_SIZE, key_fields=GENERATION_FIELDS):
+        """Track which object events have already been processed.
+
+        Keys are looked up in a bounded in-memory LRU first and then in
+        the optional persistent backend, which is shared across function
+        instances. A backend is any object with claim(key) -> bool and
+        forget(key) methods, like SqliteBackend.
+
+        Args:
+            namespace (str): Prefix for keys, usually the function name.
+            backend (object): Optional persistent backend.
+            max_entries (int): Number of keys kept in memory.
+            key_fields (tuple): Event fields added to the event ID in keys.
+        """
+        self.namespace = namespace
+        self.backend = backend
+        self.max_entries = max_entries
+        self.key_fields = key_fields
+
+        self.hits = 0
+        self.misses = 0
+
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_key(self, event):
+        """Build the deduplication key for an object event.
+
+        Args:
+            event (dict): GCS object event payload.
+        Returns:
+            (str): Namespaced event ID and key fields, e.g. the generation.
+        """
+        fields = '#'.join(str(event.get(field, '')) for field in self.key_fields)
+        return f"{self.namespace}:{event['id']}#{fields}"
+
+    def _remember(self, key):
+        self._recent[key] = None
+        self._recent.move_to_end(key)
+        while len(self._recent) > self.max_entries:
+            self._recent.popitem(last=False)
+
+    def is_duplicate(self, event):
+        """Check an event and record it as processed if it is new.
+
+        Args:
+            event (dict): GCS object event payload.
+        Returns:
+            (bool): True if the event was already processed.
+        """
+        key = self.get_key(event)
+        with self._lock:
+            if key in self._recent:
+                self._recent.move_to_end(key)
+                self.hits += 1
+                return True
+            if self.backend and not self.backend.claim(key):
+                self._remember(key)
+                self.hits += 1
+                return True
+            self._remember(key)
+            self.misses += 1
+            return False
+
+    def forget(self, event):
+        """Remove an event so it is processed again when redelivered.
+
+        Used when processing fails after the event was recorded.
+        """
+        key = self.get_key(event)
+        with self._lock:
+            self._recent.pop(key, None)
+            if self.backend:
+                self.backend.forget(key)
+
+    def stats(self):
+        """
+        Returns:
+            (dict): Hit and miss counts, hit rate and number of cached keys.
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hitRate': self.hits / total if total else 0.0,
+                    'cached': len(self._recent),
+            }
+
+
+def get_deduplicator(namespace, enabled, key_fields=GENERATION_FIELDS):
+    """Create a deduplicator configured from environment variables.
+
+    DEDUP_DATABASE: path to a SQLite database used as persistent backend.
+        Setting it also enables deduplication when not otherwise enabled.
+    DEDUP_CACHE_SIZE: number of keys kept in memory.
+
+    Args:
+        namespace (str): Prefix for keys, usually the function name.
+        enabled (bool): Whether to deduplicate without DEDUP_DATABASE.
+        key_fields (tuple): Event fields added to the event ID in keys.
+    Returns:
+        (EventDeduplicator): Deduplicator, or None if disabled.
+    """
+    database = os.environ.get('DEDUP_DATABASE')
+    if not enabled and not database:
+        return None
+    backend = SqliteBackend(database) if database else None
+    max_entries = int(os.environ.get('DEDUP_CACHE_SIZE', DEFAULT_CACHE_SIZE))
+    return EventDeduplicator(namespace, backend=backend, max_entries=max_entries, key_fields=key_fields)
+
+
+def skip_duplicates(deduplicator):
+    """Decorate an (event, context) function to skip repeated events.
+
+    Failed events are forgotten again, so a redelivery is retried.
+    With deduplicator None the function is returned unchanged.
+    """
+    def decorator(function):
+        if deduplicator is None:
+            return function
+
+        @functools.wraps(function)
+        def wrapper(event, context, *args, **kwargs):
+            if deduplicator.is_duplicate(event):
+                logging.info(f"> {deduplicator.namespace}: Skipping duplicate event {event['id']}. Deduplication stats: {deduplicator.stats()}.")
+                return None
+            try:
+                return function(event, context, *args, **kwargs)
+            except BaseException:
+                deduplicator.forget(event)
+                raise
+        return wrapper
+    return decorator
@@ -0,0 +1,134 @@
+"""Create Google Cloud clients and load configuration on first use.
+
+Importing google.cloud.pubsub and google.cloud.storage and constructing
+their clients is a large part of function cold starts, as is downloading
+the Trellis configuration from GCS. Functions reference the objects
+defined here instead, so that work only happens on the first request
+that needs it and is reused by later requests on the same instance.
+
+This module lives in functions/shared/ and is copied into each function
+directory at build time (see the function cloudbuild.yaml files).
+"""
+
+import os
+import threading
+
+from collections.abc import Mapping
+
+
+class Lazy:
+
+    def __init__(self, factory):
+        """Create an object with factory() the first time it is used.
+
+        Attribute access is forwarded to the created object, so a Lazy
+        client can be used wherever the client itself was used.
+
+        Args:
+            factory (callable): Function without arguments that returns
+                the object.
+        """
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._value = None
+        self._loaded = False
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def get(self):
+        """
+        Returns:
+            (object): The created object.
+        """
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self._value = self._factory()
+                    self._loaded = True
+        return self._value
+
+    def reset(self):
+        """Drop the created object so the next use creates it again."""
+        with self._lock:
+            self._value = None
+            self._loaded = False
+
+    def __getattr__(self, name):
+        # Only called for attributes not found on the Lazy itself
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.get(), name)
+
+    def __repr__(self):
+        state = repr(self._value) if self._loaded else 'not loaded'
+        return f"Lazy({state})"
+
+
+class LazyConfig(Mapping):
+
+    def __init__(self, loader):
+        """Read-only mapping loaded by loader() on first key access.
+
+        Args:
+            loader (callable): Function without arguments that returns
+                a dict.
+        """
+        self._document = Lazy(loader)
+
+    @property
+    def loaded(self):
+        return self._document.loaded
+
+    def __getitem__(self, key):
+        return self._document.get()[key]
+
+    def __iter__(self):
+        return iter(self._document.get())
+
+    def __len__(self):
+        return len(self._document.get())
+
+    def __repr__(self):
+        state = 'loaded' if self.loaded else 'not loaded'
+        return f"LazyConfig({state})"
+
+
+def _create_publisher():
+    from google.cloud import pubsub
+    return pubsub.PublisherClient()
+
+
+def _create_storage_client():
+    from google.cloud import storage
+    return storage.Client()
+
+
+# One client of each kind per function instance
+PUBLISHER = Lazy(_create_publisher)
+STORAGE_CLIENT = Lazy(_create_storage_client)
+
+
+def download_blob(bucket_name, blob_name):
+    """Download an object without fetching bucket and object metadata first.
+
+    Args:
+        bucket_name (str): Name of the GCS bucket.
+        blob_name (str): Path of the object.
+    Returns:
+        (bytes): Object content.
+    """
+    return STORAGE_CLIENT.bucket(bucket_name).blob(blob_name).download_as_bytes()
+
+
+def _load_trellis_config():
+    import yaml
+    configuration_document = download_blob(
+                                           os.environ['CREDENTIALS_BUCKET'],
+                                           os.environ['CREDENTIALS_BLOB'])
+    return yaml.safe_load(configuration_document)
+
+
+# Trellis configuration (database credentials, bucket and topic names)
+TRELLIS = LazyConfig(_load_trellis_config)
@@ -0,0 +1,333 @@
+"""Split aggregate query responses into parts and read them back.
+
+db-query publishes the nodes of an aggregate query response in one
+message. Pub/Sub rejects messages over 10 MB, so split_aggregate_message()
+splits the nodes into parts of at most PART_BYTES of JSON. Every part
+has the full message header plus a `chunk` entry with the ID shared by
+all parts, the part index and the number of parts; the body of each part
+has the query name, job request and result summary and its share of the
+nodes. Consumers that evaluate the nodes of the whole response collect
+the parts in GCS with a PartBuffer and process them once all have
+arrived; see handle_query_response(). Responses to consumers that can't
+collect parts are sent in one message, up to MAX_MESSAGE_BYTES.
+
+Bodies can be compressed with gzip or zstd (zstandard package). The
+header then has a `contentEncoding` entry and the body is the base64
+encoded compressed JSON. QueryResponsePart reads compressed, chunked and
+plain query responses alike, with the attributes of
+trellisdata.QueryResponseReader.
+
+This module lives in functions/shared/ and is copied into each function
+directory at build time (see the function cloudbuild.yaml files).
+"""
+
+import gzip
+import json
+import uuid
+import base64
+import logging
+
+# Uncompressed JSON size of the nodes in a part. Leaves room for the
+# header and base64 encoding under the 10 MB Pub/Sub limit.
+PART_BYTES = 4 * 1024 * 1024
+
+# Pub/Sub message size limit
+MAX_MESSAGE_BYTES = 10 * 1000 * 1000
+
+# Objects of buffered parts: <prefix>/<chunk ID>/<part index>.json
+PART_BUFFER_PREFIX = 'query-response-parts'
+# Created by the instance that joins the parts of a response
+JOINED_MARKER = 'joined'
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+
+
+def _zstd_compress(data):
+    # Optional dependency; only needed when zstd is configured
+    import zstandard
+    return zstandard.ZstdCompressor().compress(data)
+
+
+def _zstd_decompress(data):
+    import zstandard
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+CODECS = {
+          GZIP: (lambda data: gzip.compress(data, compresslevel=6), gzip.decompress),
+          ZSTD: (_zstd_compress, _zstd_decompress),
+}
+
+
+def _dumps(value):
+    # Same conversions as trellis.utils.publish_to_pubsub_topic
+    return json.dumps(value, sort_keys=True, default=str)
+
+
+def _get_codec(encoding):
+    if encoding not in CODECS:
+        raise ValueError(f"Content encoding '{encoding}' is not one of {list(CODECS)}.")
+    return CODECS[encoding]
+
+
+def _encode_part(header, body_json, encoding):
+    if encoding:
+        compress, _ = _get_codec(encoding)
+        header = dict(header, contentEncoding=encoding)
+        body_json = json.dumps(base64.b64encode(compress(body_json.encode('utf-8'))).decode('ascii'))
+    return f'{{"header": {_dumps(header)}, "body": {body_json}}}'.encode('utf-8')
+
+
+def split_aggregate_message(message, part_bytes=PART_BYTES, encoding=None, chunk_id=None):
+    """Encode an aggregate query response as one or more messages.
+
+    Each node is serialized once; parts are assembled from the node JSON.
+
+    Args:
+        message (dict): Message from QueryResponseWriter.return_json_with_all_nodes().
+        part_bytes (int): Largest JSON size of the nodes of a part. A
+            larger node gets a part of its own.
+        encoding (str): 'gzip', 'zstd' or None to not compress.
+        chunk_id (str): ID shared by the parts. Default: a new UUID.
+    Returns:
+        (list): Message data (bytes) of each part.
+    """
+    if encoding:
+        # Fail before serializing anything
+        _get_codec(encoding)
+    body = dict(message['body'])
+    node_jsons = [_dumps(node) for node in body.pop('nodes')]
+    # Body without nodes, e.g. '{"jobRequest": null, ...}'
+    body_json = _dumps(body)
+
+    # Size of the JSON list: each node plus ", " or the brackets
+    groups = [[]]
+    group_bytes = 0
+    for node_json in node_jsons:
+        node_bytes = len(node_json) + 2
+        if groups[-1] and group_bytes + node_bytes > part_bytes:
+            groups.append([])
+            group_bytes = 0
+        groups[-1].append(node_json)
+        group_bytes += node_bytes
+
+    chunk_id = chunk_id or str(uuid.uuid4())
+    parts = []
+    for index, group in enumerate(groups):
+        header = dict(message['header'], chunk={'id': chunk_id, 'index': index, 'count': len(groups)})
+        separator = ', ' if body_json != '{}' else ''
+        part_body_json = f'{{"nodes": [{", ".join(group)}]{separator}{body_json[1:]}'
+        parts.append(_encode_part(header, part_body_json, encoding))
+    return parts
+
+
+def decode_message(data):
+    """
+    Args:
+        data (bytes): Pub/Sub message data.
+    Returns:
+        (dict): Message with header and decompressed body.
+    """
+    message = json.loads(data)
+    encoding = message['header'].get('contentEncoding')
+    if encoding:
+        _, decompress = _get_codec(encoding)
+        message['body'] = json.loads(decompress(base64.b64decode(message['body'])))
+    return message
+
+
+def join_parts(messages):
+    """Join the decoded parts of an aggregate response.
+
+    Args:
+        messages (list): All parts, from decode_message(), in any order.
+    Returns:
+        (dict): Message with the nodes of all parts.
+    Raises:
+        ValueError: If parts are missing or belong to different responses.
+    """
+    messages = sorted(messages, key=lambda message: message['header']['chunk']['index'])
+    chunks = [message['header']['chunk'] for message in messages]
+    if len({chunk['id'] for chunk in chunks}) != 1:
+        raise ValueError("Parts belong to different query responses.")
+    if [chunk['index'] for chunk in chunks] != list(range(chunks[0]['count'])):
+        raise ValueError(f"Expected {chunks[0]['count']} parts, got indexes {[chunk['index'] for chunk in chunks]}.")
+
+    header = {key: value for key, value in messages[0]['header'].items() if key not in ('chunk', 'contentEncoding')}
+    body = dict(messages[0]['body'], nodes=[node for message in messages for node in message['body']['nodes']])
+    return {'header': header, 'body': body}
+
+
+class QueryResponsePart:
+
+    def __init__(self, context, event):
+        """Read a query response message, or a part of an aggregate one.
+
+        Args:
+            context (google.cloud.functions.Context): Metadata for the event.
+            event (dict): Event payload.
+        """
+        self._read(context, decode_message(base64.b64decode(event['data'])))
+
+    @classmethod
+    def from_message(cls, context, message):
+        """
+        Args:
+            context (google.cloud.functions.Context): Metadata for the event.
+            message (dict): Decoded message, e.g. from join_parts().
+        Returns:
+            (QueryResponsePart): Reader of the message.
+        """
+        query_response = cls.__new__(cls)
+        query_response._read(context, message)
+        return query_response
+
+    def _read(self, context, data):
+        # As in trellisdata.MessageReader
+        seed_id = int(data['header'].get('seedId'))
+        previous_event_id = int(data['header'].get('previousEventId'))
+        if not previous_event_id:
+            previous_event_id = seed_id
+
+        self.context = context
+        self.message_kind = data['header']['messageKind']
+        self.header = data['header']
+        self.body = data['body']
+        self.sender = data['header']['sender']
+        self.event_id = context.event_id
+        self.seed_id = seed_id
+        self.previous_event_id = previous_event_id
+
+        if self.message_kind != 'queryResponse':
+            raise ValueError(f"Expected a queryResponse message, got {self.message_kind}.")
+
+        self.query_name = self.body['queryName']
+        self.result_summary = self.body['resultSummary']
+        self.nodes = self.body['nodes']
+        self.relationship = self.body['relationship']
+        self.job_request = self.body['jobRequest']
+
+        chunk = self.header.get('chunk') or {}
+        self.chunk_id = chunk.get('id')
+        self.chunk_index = chunk.get('index', 0)
+        self.chunk_count = chunk.get('count', 1)
+        if self.chunk_count > 1:
+            logging.info(
+                         f"> Query response part {self.chunk_index + 1} of {self.chunk_count} " +
+                         f"({self.chunk_id}) with {len(self.nodes)} nodes.")
+
+    def get_message(self):
+        """
+        Returns:
+            (dict): Decoded message with header and body.
+        """
+        return {'header': self.header, 'body': self.body}
+
+
+class PartBuffer:
+
+    def __init__(self, storage_client, bucket_name, prefix=PART_BUFFER_PREFIX):
+        """Collect the parts of aggregate query responses in GCS.
+
+        Parts of a response are delivered to any function instance, in
+        any order. Each part is stored as an object under the chunk ID;
+        the instance that finds all of them creates the joined marker
+        and joins them. Objects are only created if they don't exist, so
+        redelivered parts and instances racing for the last part don't
+        join a response twice. Parts left by failed responses can be
+        removed by a lifecycle rule on the prefix.
+
+        Args:
+            storage_client (storage.Client): GCS client.
+            bucket_name (str): Bucket to store parts in.
+            prefix (str): Object name prefix of the parts.
+        """
+        self.storage_client = storage_client
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+
+    def _blob(self, chunk_id, name):
+        return self.storage_client.bucket(self.bucket_name).blob(f"{self.prefix}/{chunk_id}/{name}")
+
+    def add(self, query_response):
+        """Store a part and join the response if it was the last one.
+
+        Args:
+            query_response (QueryResponsePart): Part of a response.
+        Returns:
+            (dict): Joined message, or None if parts are missing or
+                another instance joined them.
+        """
+        from google.api_core.exceptions import PreconditionFailed
+
+        chunk_id = query_response.chunk_id
+        try:
+            self._blob(chunk_id, f"{query_response.chunk_index}.json").upload_from_string(
+                json.dumps(query_response.get_message()),
+                if_generation_match = 0)
+        except PreconditionFailed:
+            logging.info(f"> Part {query_response.chunk_index} of query response {chunk_id} was already stored.")
+
+        part_blobs = [
+                      blob for blob in self.storage_client.list_blobs(self.bucket_name, prefix=f"{self.prefix}/{chunk_id}/")
+                      if blob.name.endswith('.json')]
+        if len(part_blobs) < query_response.chunk_count:
+            return None
+        try:
+            # Event that joined the parts
+            self._blob(chunk_id, JOINED_MARKER).upload_from_string(
+                str(query_response.event_id),
+                if_generation_match = 0)
+        except PreconditionFailed:
+            return None
+        return join_parts(json.loads(blob.download_as_bytes()) for blob in part_blobs)
+
+    def release(self, chunk_id):
+        """Let the response be joined again, e.g. after processing failed."""
+        self._blob(chunk_id, JOINED_MARKER).delete()
+
+    def delete(self, chunk_id):
+        """Delete the stored parts of a processed response."""
+        for blob in self.storage_client.list_blobs(self.bucket_name, prefix=f"{self.prefix}/{chunk_id}/"):
+            blob.delete()
+
+
+def handle_query_response(context, event, function, part_buffer=None):
+    """Call function with a complete query response.
+
+    Messages that are not split are handled right away. Parts of an
+    aggregate response are collected with part_buffer, and function is
+    called with the joined response when the last part arrives.
+
+    Args:
+        context (google.cloud.functions.Context): Metadata for the event.
+        event (dict): Event payload.
+        function (callable): Called with a QueryResponsePart.
+        part_buffer (PartBuffer): Collects parts of aggregate responses.
+    Returns:
+        The value returned by function, or None while parts are missing.
+    Raises:
+        ValueError: If the message is a part and there is no part_buffer.
+    """
+    query_response = QueryResponsePart(context, event)
+    if query_response.chunk_count == 1:
+        return function(query_response)
+    if part_buffer is None:
+        raise ValueError(
+                         f"Query response {query_response.chunk_id} was split into {query_response.chunk_count} " +
+                         "parts, but this function can't join them.")
+
+    message = part_buffer.add(query_response)
+    if message is None:
+        logging.info(f"> Waiting for the other parts of query response {query_response.chunk_id}.")
+        return None
+    logging.info(f"> Joined {query_response.chunk_count} parts of query response {query_response.chunk_id}.")
+    try:
+        result = function(QueryResponsePart.from_message(context, message))
+    except Exception:
+        # The next delivery of a part joins them again
+        part_buffer.release(query_response.chunk_id)
+        raise
+    part_buffer.delete(query_response.chunk_id)
+    return result
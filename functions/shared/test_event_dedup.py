@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+import os
+import mock
+import tempfile
+
+from unittest import TestCase
+
+import event_dedup
+
+
+class TestEventDeduplicator(TestCase):
+
+	event = {
+		'bucket': 'gcp-bucket-mvp-test-from-personalis',
+		'generation': '1582075915288601',
+		'id': 'gcp-bucket-mvp-test-from-personalis/va_mvp_phase2/PLATE0/SAMPLE0/FASTQ/SAMPLE0_0_R1.fastq.gz/1582075915288601',
+		'name': 'va_mvp_phase2/PLATE0/SAMPLE0/FASTQ/SAMPLE0_0_R1.fastq.gz',
+	}
+
+	def setUp(cls):
+		cls.directory = tempfile.TemporaryDirectory()
+		cls.database = os.path.join(cls.directory.name, 'dedup.sqlite')
+
+	def tearDown(cls):
+		cls.directory.cleanup()
+
+	def test_in_memory(cls):
+		deduplicator = event_dedup.EventDeduplicator('parse-object-metadata')
+		overwrite = dict(cls.event, generation='1582075915288602')
+
+		assert deduplicator.is_duplicate(cls.event) == False
+		assert deduplicator.is_duplicate(cls.event) == True
+		assert deduplicator.is_duplicate(overwrite) == False
+		assert deduplicator.stats() == {'hits': 1, 'misses': 2, 'hitRate': 1/3, 'cached': 2}
+
+	def test_metageneration_key(cls):
+		deduplicator = event_dedup.EventDeduplicator('check-object-triggers', key_fields=event_dedup.METAGENERATION_FIELDS)
+		update = dict(cls.event, metageneration='1')
+		touched = dict(cls.event, metageneration='2')
+
+		assert deduplicator.is_duplicate(update) == False
+		assert deduplicator.is_duplicate(update) == True
+		assert deduplicator.is_duplicate(touched) == False
+
+	def test_lru_eviction(cls):
+		deduplicator = event_dedup.EventDeduplicator('parse-object-metadata', max_entries=2)
+		events = [dict(cls.event, generation=str(generation)) for generation in range(3)]
+
+		for event in events:
+			deduplicator.is_duplicate(event)
+		assert deduplicator.is_duplicate(events[0]) == False
+		assert deduplicator.stats()['cached'] == 2
+
+	def test_sqlite_backend_shared_across_instances(cls):
+		first = event_dedup.EventDeduplicator('check-object-triggers', event_dedup.SqliteBackend(cls.database))
+		second = event_dedup.EventDeduplicator('check-object-triggers', event_dedup.SqliteBackend(cls.database))
+		other_function = event_dedup.EventDeduplicator('parse-object-metadata', event_dedup.SqliteBackend(cls.database))
+
+		assert first.is_duplicate(cls.event) == False
+		assert second.is_duplicate(cls.event) == True
+		assert other_function.is_duplicate(cls.event) == False
+
+		first.forget(cls.event)
+		assert second.is_duplicate(cls.event) == True
+		third = event_dedup.EventDeduplicator('check-object-triggers', event_dedup.SqliteBackend(cls.database))
+		assert third.is_duplicate(cls.event) == False
+
+	def test_skip_duplicates_retries_failures(cls):
+		deduplicator = event_dedup.EventDeduplicator('parse-object-metadata')
+		function = mock.Mock(side_effect=[RuntimeError('patch failed'), 'processed'])
+		wrapped = event_dedup.skip_duplicates(deduplicator)(function)
+
+		with cls.assertRaises(RuntimeError):
+			wrapped(cls.event, None)
+		assert wrapped(cls.event, None) == 'processed'
+		assert wrapped(cls.event, None) == None
+		assert function.call_count == 2
+
+	def test_get_deduplicator(cls):
+		with mock.patch.dict(os.environ, {}, clear=True):
+			assert event_dedup.get_deduplicator('parse-object-metadata', enabled=False) == None
+			assert event_dedup.get_deduplicator('parse-object-metadata', enabled=True).backend == None
+
+		with mock.patch.dict(os.environ, {'DEDUP_DATABASE': cls.database, 'DEDUP_CACHE_SIZE': '5'}):
+			deduplicator = event_dedup.get_deduplicator('parse-object-metadata', enabled=False)
+		assert deduplicator.max_entries == 5
+		assert deduplicator.backend.path == cls.database
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import mock
+import subprocess
+
+from unittest import TestCase
+
+import lazy_clients
+
+
+class TestLazy(TestCase):
+
+	def test_created_once_on_first_use(cls):
+		factory = mock.Mock(return_value=mock.Mock(topic_path=mock.Mock(return_value='projects/p/topics/t')))
+		publisher = lazy_clients.Lazy(factory)
+
+		assert publisher.loaded == False
+		factory.assert_not_called()
+
+		assert publisher.topic_path('p', 't') == 'projects/p/topics/t'
+		assert publisher.topic_path('p', 't') == 'projects/p/topics/t'
+		assert publisher.loaded == True
+		factory.assert_called_once()
+
+	def test_reset(cls):
+		factory = mock.Mock(side_effect=['first', 'second'])
+		value = lazy_clients.Lazy(factory)
+
+		assert value.get() == 'first'
+		value.reset()
+		assert value.get() == 'second'
+
+	def test_lazy_config(cls):
+		loader = mock.Mock(return_value={'TOPIC_DB_QUERY': 'trellis-db-query'})
+		config = lazy_clients.LazyConfig(loader)
+
+		assert config.loaded == False
+		assert config['TOPIC_DB_QUERY'] == 'trellis-db-query'
+		assert config.get('MISSING') == None
+		assert dict(config) == {'TOPIC_DB_QUERY': 'trellis-db-query'}
+		loader.assert_called_once()
+
+	def test_trellis_config_download(cls):
+		blob = mock.Mock()
+		blob.download_as_bytes.return_value = b"NEO4J_PORT: 7687\n"
+		storage_client = mock.Mock()
+		storage_client.bucket.return_value.blob.return_value = blob
+		config = lazy_clients.LazyConfig(lazy_clients._load_trellis_config)
+
+		with mock.patch.object(lazy_clients, 'STORAGE_CLIENT', storage_client), \
+			 mock.patch.dict(os.environ, {'CREDENTIALS_BUCKET': 'bucket', 'CREDENTIALS_BLOB': 'trellis.yaml'}):
+			assert config['NEO4J_PORT'] == 7687
+		storage_client.bucket.assert_called_once_with('bucket')
+		storage_client.bucket.return_value.blob.assert_called_once_with('trellis.yaml')
+
+	def test_import_does_not_load_google_cloud(cls):
+		code = "import sys, lazy_clients; print('google.cloud.storage' in sys.modules, 'google.cloud.pubsub' in sys.modules)"
+		output = subprocess.run(
+			[sys.executable, '-c', code],
+			cwd = os.path.dirname(os.path.abspath(__file__)),
+			capture_output = True,
+			text = True,
+			check = True).stdout
+		assert output.strip() == 'False False'
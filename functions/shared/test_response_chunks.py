@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+import json
+import base64
+
+from types import SimpleNamespace
+from unittest import TestCase
+
+from google.api_core import exceptions
+
+import response_chunks
+
+
+class FakeBlob:
+
+	def __init__(self, objects, name):
+		self.objects = objects
+		self.name = name
+
+	def upload_from_string(self, data, if_generation_match=None):
+		if if_generation_match == 0 and self.name in self.objects:
+			raise exceptions.PreconditionFailed('object exists')
+		self.objects[self.name] = data.encode('utf-8') if isinstance(data, str) else data
+
+	def download_as_bytes(self):
+		return self.objects[self.name]
+
+	def delete(self):
+		if self.name not in self.objects:
+			raise exceptions.NotFound('object deleted')
+		del self.objects[self.name]
+
+
+class FakeStorageClient:
+	"""One bucket of objects by name."""
+
+	def __init__(self):
+		self.objects = {}
+
+	def bucket(self, name):
+		return SimpleNamespace(blob=lambda blob_name: FakeBlob(self.objects, blob_name))
+
+	def list_blobs(self, bucket_name, prefix=None):
+		return [FakeBlob(self.objects, name) for name in sorted(self.objects) if name.startswith(prefix)]
+
+
+class TestAggregateParts(TestCase):
+
+	def setUp(cls):
+		cls.message = {
+			'header': {
+				'messageKind': 'queryResponse',
+				'sender': 'db-query',
+				'seedId': 1,
+				'previousEventId': 2,
+			},
+			'body': {
+				'queryName': 'getSampleFastqs',
+				'jobRequest': None,
+				'nodes': [
+					{'id': index, 'labels': ['Fastq'], 'properties': {'uri': f"gs://bucket/SAMPLE/{index:03}.fastq.gz"}}
+					for index in range(100)],
+				'relationship': {},
+				'resultSummary': {'counters': {}},
+			}
+		}
+		cls.context = SimpleNamespace(event_id='3')
+
+	def read_part(cls, data):
+		return response_chunks.QueryResponsePart(cls.context, {'data': base64.b64encode(data)})
+
+	def test_single_part(cls):
+		parts = response_chunks.split_aggregate_message(cls.message, chunk_id='chunk')
+		assert len(parts) == 1
+
+		message = json.loads(parts[0])
+		assert message['header']['chunk'] == {'id': 'chunk', 'index': 0, 'count': 1}
+		assert message['body'] == cls.message['body']
+
+	def test_parts_bounded(cls):
+		parts = response_chunks.split_aggregate_message(cls.message, part_bytes=1000)
+		messages = [response_chunks.decode_message(part) for part in parts]
+
+		assert len(parts) > 5
+		for message in messages:
+			assert len(json.dumps(message['body']['nodes'])) <= 1000
+			assert message['body']['queryName'] == 'getSampleFastqs'
+			assert message['header']['chunk']['count'] == len(parts)
+		assert response_chunks.join_parts(reversed(messages)) == cls.message
+
+	def test_gzip(cls):
+		uncompressed = response_chunks.split_aggregate_message(cls.message)
+		parts = response_chunks.split_aggregate_message(cls.message, encoding=response_chunks.GZIP)
+		assert len(parts[0]) < len(uncompressed[0]) / 2
+
+		message = json.loads(parts[0])
+		assert message['header']['contentEncoding'] == 'gzip'
+		assert isinstance(message['body'], str)
+		assert response_chunks.decode_message(parts[0])['body'] == cls.message['body']
+
+	def test_unknown_encoding(cls):
+		with cls.assertRaises(ValueError):
+			response_chunks.split_aggregate_message(cls.message, encoding='brotli')
+
+	def test_missing_part(cls):
+		parts = response_chunks.split_aggregate_message(cls.message, part_bytes=1000)
+		messages = [response_chunks.decode_message(part) for part in parts[1:]]
+		with cls.assertRaises(ValueError):
+			response_chunks.join_parts(messages)
+
+	def test_read_part(cls):
+		parts = response_chunks.split_aggregate_message(cls.message, part_bytes=1000, encoding=response_chunks.GZIP)
+		query_response = cls.read_part(parts[1])
+
+		assert query_response.query_name == 'getSampleFastqs'
+		assert query_response.event_id == '3'
+		assert query_response.seed_id == 1
+		assert query_response.previous_event_id == 2
+		assert query_response.chunk_index == 1
+		assert query_response.chunk_count == len(parts)
+		offset = len(response_chunks.decode_message(parts[0])['body']['nodes'])
+		assert query_response.nodes == cls.message['body']['nodes'][offset:offset + len(query_response.nodes)]
+
+	def test_read_plain_message(cls):
+		message = dict(cls.message, body=dict(cls.message['body'], nodes=cls.message['body']['nodes'][:1]))
+		query_response = cls.read_part(json.dumps(message).encode('utf-8'))
+
+		assert query_response.nodes == message['body']['nodes']
+		assert query_response.relationship == {}
+		assert query_response.chunk_count == 1
+
+
+class TestPartBuffer(TestAggregateParts):
+
+	def setUp(cls):
+		super().setUp()
+		cls.storage_client = FakeStorageClient()
+		cls.part_buffer = response_chunks.PartBuffer(cls.storage_client, 'bucket')
+		cls.parts = response_chunks.split_aggregate_message(cls.message, part_bytes=2000, encoding=response_chunks.GZIP)
+		cls.events = [{'data': base64.b64encode(part)} for part in cls.parts]
+		cls.handled = []
+
+	def handle(cls, event, part_buffer=None):
+		return response_chunks.handle_query_response(
+													 cls.context,
+													 event,
+													 cls.handled.append,
+													 part_buffer = part_buffer or cls.part_buffer)
+
+	def test_joined_when_complete(cls):
+		assert len(cls.parts) > 2
+		with cls.assertLogs(level='INFO'):
+			for event in reversed(cls.events):
+				cls.handle(event)
+
+		assert len(cls.handled) == 1
+		assert cls.handled[0].nodes == cls.message['body']['nodes']
+		assert cls.handled[0].chunk_count == 1
+		assert cls.handled[0].seed_id == 1
+		# Parts are deleted once processed
+		assert cls.storage_client.objects == {}
+
+	def test_redelivered_part(cls):
+		with cls.assertLogs(level='INFO'):
+			cls.handle(cls.events[0])
+			cls.handle(cls.events[0])
+			for event in cls.events[1:]:
+				cls.handle(event)
+		assert len(cls.handled) == 1
+
+	def test_joined_once(cls):
+		with cls.assertLogs(level='INFO'):
+			for event in cls.events:
+				cls.part_buffer.add(response_chunks.QueryResponsePart(cls.context, event))
+			# Another instance receiving the last part again
+			last_part = response_chunks.QueryResponsePart(cls.context, cls.events[-1])
+			assert cls.part_buffer.add(last_part) is None
+
+	def test_failure_releases_response(cls):
+		def fail(query_response):
+			raise RuntimeError('Publish failed')
+
+		with cls.assertLogs(level='INFO'):
+			for event in cls.events[:-1]:
+				cls.handle(event)
+			with cls.assertRaises(RuntimeError):
+				response_chunks.handle_query_response(cls.context, cls.events[-1], fail, cls.part_buffer)
+			# Redelivery of the last part
+			cls.handle(cls.events[-1])
+		assert len(cls.handled) == 1
+
+	def test_plain_message(cls):
+		message = dict(cls.message, body=dict(cls.message['body'], nodes=cls.message['body']['nodes'][:1]))
+		cls.handle({'data': base64.b64encode(json.dumps(message).encode('utf-8'))})
+		assert cls.handled[0].nodes == message['body']['nodes']
+		assert cls.storage_client.objects == {}
+
+	def test_parts_without_buffer(cls):
+		with cls.assertRaises(ValueError):
+			response_chunks.handle_query_response(cls.context, cls.events[0], cls.handled.append)